@@ -0,0 +1,217 @@
+# Run the knowledge graph pipeline for many entities with bounded concurrency, rate limits and checkpoint/resume
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataRetrieval import retrieve_data, enable_search_cache
+from nlpUtils import extract_entities, extract_relationships_from_entities, extract_relationships_directly, text_to_json, set_rate_limiter
+from rateLimiter import RateLimiter
+from graphStore import GraphStore
+from passageIndex import relevant_text
+from tracing import traced, enable_tracing, disable_tracing, JSONLinesExporter, PrometheusExporter, SummaryExporter
+import threading
+import argparse
+import json
+import time
+import sys
+import os
+
+
+@traced()
+def run_pipeline(query: str, num_results: int = 7, model: str = "gpt-3.5-turbo", json_model: str = "gpt-3.5-turbo", approach: str = "direct", max_data_tokens: int = None, passage_index=None) -> dict:
+   """Run the full pipeline for one entity: data retrieval, relationships extraction and JSON conversion.
+
+   Parameters:
+      query (str): The entity to process.
+      num_results (int): Number of web search results used.
+      model (str): Model used for the data retrieval and the extraction.
+      json_model (str): Model used to convert the relationships into JSON.
+      approach (str): "direct" uses extract_relationships_directly, "entities" extracts the entities first
+         and then the relationships (extract_entities, extract_relationships_from_entities).
+      max_data_tokens (int or None): Only send the passages of the retrieved data most relevant to the query within
+         this token budget to the extraction (see passageIndex.relevant_text). The whole data is sent if None.
+      passage_index (PassageIndex or None): Index the retrieved data is added to, the passages are then selected among
+         all the passages of the index (e.g. also scraped pages). Requires max_data_tokens.
+
+   Returns:
+      dict: The query and its relationships, a list of dicts with 'src', 'relationship' and 'tgt' keys.
+   """
+   data = retrieve_data(query=query, num_results=num_results, model=model)
+   if max_data_tokens is not None:
+      data = relevant_text(query, data, max_tokens=max_data_tokens, index=passage_index)
+
+   if approach == "direct":
+      _, output = extract_relationships_directly(query=query, data=data, model=model)
+   elif approach == "entities":
+      context, output = extract_entities(query=query, data=data, model=model)
+      context.append(output)
+      _, output = extract_relationships_from_entities(query=query, context=context, model=model)
+   else:
+      raise ValueError(f"Unknown approach: {approach}")
+
+   relationships = json.loads(text_to_json(data=output.content, model=json_model, query=query))["relationships"]
+
+   return {"query": query, "relationships": relationships}
+
+
+def load_queries(path: str) -> list:
+   """Read the queries of a batch from a file.
+
+   Parameters:
+      path (str): A JSONL file (one string or object with a 'query' key per line) or a text file (one query per line).
+
+   Returns:
+      list: The queries.
+   """
+   queries = []
+   with open(path, encoding="utf-8") as file:
+      for line in file:
+         line = line.strip()
+         if not line:
+            continue
+         if path.endswith(".jsonl"):
+            item = json.loads(line)
+            line = item["query"] if isinstance(item, dict) else str(item)
+         queries.append(line)
+   return queries
+
+
+def load_checkpoint(output_path: str) -> set:
+   """Return the queries already completed in the output (checkpoint) file of a previous run."""
+   completed = set()
+   if not os.path.exists(output_path):
+      return completed
+
+   with open(output_path, encoding="utf-8") as file:
+      for line in file:
+         try:
+            completed.add(json.loads(line)["query"])
+         except (ValueError, KeyError):
+            # A crash while writing can leave a partial last line, that query is simply processed again
+            continue
+   return completed
+
+
+def run_batch(queries: list, output_path: str, workers: int = 4, requests_per_minute: float = None, tokens_per_minute: float = None, resume: bool = True, store_path: str = None, **pipeline_kwargs) -> dict:
+   """Run the pipeline for a batch of entities. Every result is appended to the output JSONL file as soon as it
+   completes, the file is also the checkpoint used to skip finished entities when the batch is resumed.
+
+   Parameters:
+      queries (list): The entities to process.
+      output_path (str): JSONL file the results are appended to.
+      workers (int): Number of entities processed concurrently.
+      requests_per_minute (float or None): Limit of OpenAI requests per minute.
+      tokens_per_minute (float or None): Limit of OpenAI tokens per minute (counted with numTokens.num_tokens_chat).
+      resume (bool): Skip the entities already in the output file. If False the output file is overwritten.
+      store_path (str or None): If given, the relationships are also upserted into this GraphStore (SQLite file).
+      pipeline_kwargs: Arguments of run_pipeline, e.g. num_results, model, json_model, approach.
+
+   Returns:
+      dict: A summary of the run, with the number of completed and skipped entities, the failed entities and their errors,
+         the elapsed time and the number of retries after 429 errors.
+   """
+   # Skip duplicates and entities completed by a previous run
+   completed = load_checkpoint(output_path) if resume else set()
+   pending = [query for query in dict.fromkeys(queries) if query not in completed]
+
+   limiter = None
+   if requests_per_minute or tokens_per_minute:
+      limiter = RateLimiter(requests_per_minute=requests_per_minute, tokens_per_minute=tokens_per_minute)
+      set_rate_limiter(limiter)
+
+   store = GraphStore(store_path) if store_path else None
+
+   summary = {"completed": 0, "skipped": len(queries) - len(pending), "failed": {}}
+   write_lock = threading.Lock()
+   start_time = time.time()
+
+   try:
+      with open(output_path, "a" if resume else "w", encoding="utf-8") as output, ThreadPoolExecutor(max_workers=workers) as executor:
+         futures = {executor.submit(run_pipeline, query, **pipeline_kwargs): query for query in pending}
+         for future in as_completed(futures):
+            query = futures[future]
+            try:
+               result = future.result()
+            except Exception as ex:
+               summary["failed"][query] = repr(ex)
+               print(f"Failed: {query}: {ex!r}", file=sys.stderr)
+               continue
+
+            if store is not None:
+               store.upsert(result["relationships"], query=query, replace=True)
+            with write_lock:
+               output.write(json.dumps(result) + "\n")
+               output.flush()
+            summary["completed"] += 1
+   finally:
+      if limiter is not None:
+         set_rate_limiter(None)
+
+   summary["elapsed_time"] = round(time.time() - start_time, 1)
+   summary["retries"] = limiter.retries if limiter is not None else 0
+
+   return summary
+
+
+def main(argv: list = None):
+   parser = argparse.ArgumentParser(description="Build the relationships of many entities with the knowledge graph pipeline.")
+   parser.add_argument("queries", help="JSONL file (strings or objects with a 'query' key) or text file with one query per line")
+   parser.add_argument("-o", "--output", required=True, help="JSONL file the results are appended to, also used as the checkpoint")
+   parser.add_argument("-w", "--workers", type=int, default=4, help="number of entities processed concurrently")
+   parser.add_argument("--rpm", type=float, default=None, help="maximum OpenAI requests per minute")
+   parser.add_argument("--tpm", type=float, default=None, help="maximum OpenAI tokens per minute")
+   parser.add_argument("--num-results", type=int, default=7, help="number of web search results")
+   parser.add_argument("--model", default="gpt-3.5-turbo", help="model used for retrieval and extraction")
+   parser.add_argument("--json-model", default="gpt-3.5-turbo", help="model used for the JSON conversion")
+   parser.add_argument("--approach", choices=["direct", "entities"], default="direct", help="extraction approach")
+   parser.add_argument("--max-data-tokens", type=int, default=None, help="only send the most relevant passages of the retrieved data within this token budget")
+   parser.add_argument("--store", default=None, help="SQLite graph store the relationships are also upserted into")
+   parser.add_argument("--search-cache", default=None, help="SQLite file caching the Bing responses between runs")
+   parser.add_argument("--no-resume", action="store_true", help="overwrite the output instead of resuming from it")
+   parser.add_argument("--trace", default=None, help="JSONL file the spans of the stages and API calls are appended to")
+   parser.add_argument("--metrics", default=None, help="file the Prometheus metrics of the spans are written to at the end")
+   parser.add_argument("--profile", action="store_true", help="print the time, tokens, cache hits and retries per stage")
+   args = parser.parse_args(argv)
+
+   if args.search_cache:
+      enable_search_cache(path=args.search_cache)
+
+   exporters = {}
+   if args.trace:
+      exporters["trace"] = JSONLinesExporter(args.trace)
+   if args.metrics:
+      exporters["metrics"] = PrometheusExporter()
+   if args.profile:
+      exporters["profile"] = SummaryExporter()
+   if exporters:
+      enable_tracing(*exporters.values())
+
+   try:
+      summary = run_batch(
+         load_queries(args.queries),
+         output_path=args.output,
+         workers=args.workers,
+         requests_per_minute=args.rpm,
+         tokens_per_minute=args.tpm,
+         resume=not args.no_resume,
+         store_path=args.store,
+         num_results=args.num_results,
+         model=args.model,
+         json_model=args.json_model,
+         approach=args.approach,
+         max_data_tokens=args.max_data_tokens
+      )
+   finally:
+      if exporters:
+         disable_tracing()
+      if "trace" in exporters:
+         exporters["trace"].close()
+      if "metrics" in exporters:
+         exporters["metrics"].write(args.metrics)
+      if "profile" in exporters:
+         print(exporters["profile"].report(), file=sys.stderr)
+   print(json.dumps(summary, indent=3))
+
+   return 1 if summary["failed"] else 0
+
+
+if __name__ == "__main__":
+   sys.exit(main())
@@ -0,0 +1,363 @@
+# Offline benchmarks: the pipeline stages against a local stand-in of the OpenAI and Bing APIs (see fakeServer.py),
+# graph micro-benchmarks on synthetic graphs, and the import time of the modules
+
+from fakeServer import FakeAPIServer, load_fixtures
+from knowledgeGraph import KnowledgeGraph, KnowledgeGraphVisualizer
+from graphQuery import GraphIndex, CompactGraphIndex
+from tracing import percentile, enable_tracing, disable_tracing, SummaryExporter
+from clients import create_openai_client, use_openai_client
+from responseCache import DEFAULT_CACHE_DIR
+from numTokens import get_encoding
+import subprocess
+import tracemalloc
+import tempfile
+import warnings
+import argparse
+import random
+import json
+import time
+import sys
+import os
+
+# The queries of test.ipynb
+DEFAULT_QUERIES = ["Yigit Ihlamur", "Elon Musk", "Donald Trump", "Revolut", "SpaceX", "Hugging Face", "Vela Partners", "Berbatov", "Anthropic", "Sam Altman"]
+
+# The pipeline counts tokens with tiktoken, which downloads its BPE files on first use. They are kept in this
+# directory (unless TIKTOKEN_CACHE_DIR is set) so that, once seeded by a run with network access, the benchmark runs offline
+TIKTOKEN_CACHE_DIR = os.path.join(DEFAULT_CACHE_DIR, "tiktoken")
+
+# Import time budgets (p50, in milliseconds) of the modules imported by services and workers
+IMPORT_BUDGETS = {
+   "clients": 50,
+   "nlpUtils": 300,
+   "dataRetrieval": 600,
+   "knowledgeGraph": 600,
+   "graphStore": 600,
+   "bulkIngest": 600,
+   "batchRunner": 1000,
+   "graphExpansion": 1000,
+   "cli": 50
+}
+# Modules that must only be imported on first use (API client, visualization)
+LAZY_MODULES = ("openai", "matplotlib")
+
+
+class Benchmark:
+   """Collects the latency of every call of each stage, the throughput and the peak memory allocated by a call."""
+
+   def __init__(self, memory: bool = True):
+      """
+      Parameters:
+         memory (bool): Measure the peak memory of each stage with tracemalloc, in an extra call (tracemalloc slows the
+            calls down, so the timed calls run without it).
+      """
+      self.memory = memory
+      self.results = []
+
+   def measure(self, stage: str, function, inputs: list, repeat: int = 1, items=None) -> list:
+      """Call a function on every input, `repeat` times, and record the stats of the stage.
+
+      Parameters:
+         stage (str): Name of the stage.
+         function (callable): Called with each input.
+         inputs (list): The inputs.
+         repeat (int): Number of passes over the inputs.
+         items (callable or None): Number of items processed by a call (e.g. edges), called with its input, for the
+            throughput. Calls are counted by default.
+
+      Returns:
+         list: The outputs of the last pass.
+      """
+      latencies = []
+      count = 0
+      for _ in range(repeat):
+         outputs = []
+         for value in inputs:
+            start = time.perf_counter()
+            outputs.append(function(value))
+            latencies.append(time.perf_counter() - start)
+            count += items(value) if items is not None else 1
+
+      peak_memory = None
+      if self.memory and inputs:
+         tracemalloc.start()
+         try:
+            function(inputs[0])
+            peak_memory = tracemalloc.get_traced_memory()[1]
+         finally:
+            tracemalloc.stop()
+
+      self.record(stage, latencies, count, peak_memory)
+      return outputs
+
+   def record(self, stage: str, latencies: list, count: int, peak_memory: int = None):
+      """Record the stats of a stage measured by the caller (latencies in seconds, count of items processed)."""
+      elapsed = sum(latencies)
+      self.results.append({
+         "stage": stage,
+         "runs": len(latencies),
+         "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+         "p95_ms": round(percentile(latencies, 95) * 1000, 3),
+         "throughput_per_s": round(count / elapsed, 2) if elapsed else None,
+         "peak_memory_mib": round(peak_memory / 2**20, 2) if peak_memory is not None else None
+      })
+
+
+def format_result(result: dict) -> str:
+   memory = f"{result['peak_memory_mib']:>10.2f}" if result["peak_memory_mib"] is not None else f"{'-':>10}"
+   throughput = f"{result['throughput_per_s']:>14,.2f}" if result["throughput_per_s"] is not None else f"{'-':>14}"
+   return f"{result['stage']:<48}{result['runs']:>6}{result['p50_ms']:>12,.2f}{result['p95_ms']:>12,.2f}{throughput}{memory}"
+
+
+def format_results(results: list) -> str:
+   header = f"{'stage':<48}{'runs':>6}{'p50 ms':>12}{'p95 ms':>12}{'throughput/s':>14}{'peak MiB':>10}"
+   return "\n".join([header] + [format_result(result) for result in results])
+
+
+def render(knowledge_graph: KnowledgeGraph, **kwargs):
+   """Visualize a knowledge graph without displaying it (Agg backend)."""
+   # matplotlib is an optional dependency, only needed by this stage
+   import matplotlib
+   matplotlib.use("Agg")
+   import matplotlib.pyplot as plt
+   with warnings.catch_warnings():
+      # plt.show() warns that the Agg backend is non-interactive
+      warnings.simplefilter("ignore", UserWarning)
+      KnowledgeGraphVisualizer(knowledge_graph).visualize(**kwargs)
+   plt.close("all")
+
+
+def benchmark_pipeline(server: FakeAPIServer, queries: list, repeat: int = 1, num_results: int = 7, model: str = "gpt-3.5-turbo", workers: int = 4, memory: bool = True) -> dict:
+   """Benchmark the pipeline stages against a FakeAPIServer: retrieve_data, the extract_* functions, text_to_json,
+   the knowledge graph construction and visualization, and the batch runner.
+
+   Parameters:
+      server (FakeAPIServer): The started server.
+      queries (list): The entities.
+      repeat (int): Number of passes over the queries for each stage.
+      num_results (int): Number of web search results.
+      model (str): Model name sent to the server.
+      workers (int): Number of workers of the batch runner.
+      memory (bool): Measure the peak memory of the stages.
+
+   Returns:
+      dict: The stats of the stages ('results') and the number of requests received by the server ('requests').
+   """
+   # The pipeline modules read the API settings from the environment, point them to the server
+   with server.patched_environment():
+      from dataRetrieval import retrieve_data
+      from nlpUtils import extract_entities, extract_relationships_from_entities, extract_relationships_directly, extract_relationships_chunked, text_to_json, text_to_json_llm
+      from batchRunner import run_batch
+
+      # A client reading the patched environment, instead of the shared client if it was already created
+      with use_openai_client(create_openai_client()):
+         benchmark = Benchmark(memory=memory)
+         data = benchmark.measure("retrieve_data", lambda query: retrieve_data(query, num_results=num_results, model=model), queries, repeat=repeat)
+         inputs = list(zip(queries, data))
+
+         entities = benchmark.measure("extract_entities", lambda item: extract_entities(item[0], item[1], model=model), inputs, repeat=repeat)
+         contexts = [(query, context + [output]) for query, (context, output) in zip(queries, entities)]
+         benchmark.measure("extract_relationships_from_entities", lambda item: extract_relationships_from_entities(item[0], context=item[1], model=model), contexts, repeat=repeat)
+
+         outputs = benchmark.measure("extract_relationships_directly", lambda item: extract_relationships_directly(item[0], item[1], model=model), inputs, repeat=repeat)
+         benchmark.measure("extract_relationships_chunked (200-token chunks)", lambda item: extract_relationships_chunked(item[0], item[1], model=model, json_model=model, max_chunk_tokens=200), inputs, repeat=repeat)
+
+         texts = [(query, output.content) for query, (_, output) in zip(queries, outputs)]
+         jsons = benchmark.measure("text_to_json (local parse)", lambda item: text_to_json(item[1], model=model, query=item[0]), texts, repeat=repeat)
+         benchmark.measure("text_to_json_llm", lambda item: text_to_json_llm(item[1], model=model), texts, repeat=repeat)
+
+         relationships = [json.loads(output)["relationships"] for output in jsons]
+         benchmark.measure("KnowledgeGraph (per query)", KnowledgeGraph, relationships, repeat=repeat, items=len)
+         merged = KnowledgeGraph([rel for rels in relationships for rel in rels])
+         benchmark.measure("visualize (all queries)", render, [merged], repeat=repeat)
+
+         # Throughput of the full pipeline with concurrent workers
+         with tempfile.TemporaryDirectory() as directory:
+            start = time.perf_counter()
+            summary = run_batch(queries, output_path=os.path.join(directory, "results.jsonl"), workers=workers, resume=False, num_results=num_results, model=model, json_model=model)
+            benchmark.record(f"run_batch ({workers} workers)", [time.perf_counter() - start], summary["completed"])
+
+   return {"results": benchmark.results, "requests": dict(server.counts)}
+
+
+def synthetic_relationships(num_edges: int, num_entities: int = None, seed: int = 0) -> list:
+   """Random relationships with a skewed degree distribution (a few hubs, many entities with few relationships).
+
+   Parameters:
+      num_edges (int): Number of relationships.
+      num_entities (int or None): Number of entities, num_edges / 5 by default.
+      seed (int): Seed of the random generator.
+
+   Returns:
+      list: Dicts with 'src', 'relationship' and 'tgt' keys.
+   """
+   rng = random.Random(seed)
+   num_entities = num_entities or max(2, num_edges // 5)
+   labels = ["founded", "invested in", "works at", "located in", "partnered with", "acquired", "studied at", "advises"]
+   return [
+      {"src": f"Entity {int(num_entities * rng.random() ** 2)}", "relationship": rng.choice(labels), "tgt": f"Entity {rng.randrange(num_entities)}"}
+      for _ in range(num_edges)
+   ]
+
+
+def benchmark_graph(sizes: list = (10**3, 10**4, 10**5, 10**6), num_queries: int = 1000, memory: bool = True, seed: int = 0) -> dict:
+   """Graph micro-benchmarks on synthetic graphs of the given numbers of edges: construction with both backends,
+   query index construction, k-hop neighborhoods and shortest paths.
+
+   Parameters:
+      sizes (list): The numbers of edges.
+      num_queries (int): Number of neighborhood and path queries per size.
+      memory (bool): Measure the peak memory of the stages.
+      seed (int): Seed of the synthetic graphs and queries.
+
+   Returns:
+      dict: The stats of the stages ('results').
+   """
+   benchmark = Benchmark(memory=memory)
+   rng = random.Random(seed)
+
+   for size in sizes:
+      relationships = synthetic_relationships(size, seed=seed)
+      suffix = f" [{size:,} edges]"
+      for backend in ("networkx", "compact"):
+         graphs = benchmark.measure("KnowledgeGraph " + backend + suffix, lambda rels: KnowledgeGraph(rels, backend=backend), [relationships], items=len)
+      knowledge_graph = graphs[0]
+      del graphs
+
+      # The compact graph, indexed as the networkx backend does (edges copied into lists) and over its columns
+      indexes = {
+         "GraphIndex": benchmark.measure("GraphIndex" + suffix, lambda kg: GraphIndex(kg.edges()), [knowledge_graph], items=lambda kg: size)[0],
+         "CompactGraphIndex": benchmark.measure("CompactGraphIndex" + suffix, lambda kg: CompactGraphIndex(kg.store), [knowledge_graph], items=lambda kg: size)[0]
+      }
+      entities = knowledge_graph.store.nodes()
+      sample = [rng.choice(entities) for _ in range(num_queries)]
+      pairs = [(rng.choice(entities), rng.choice(entities)) for _ in range(num_queries)]
+      for name, index in indexes.items():
+         benchmark.measure(f"{name} neighborhood k=1" + suffix, lambda entity: index.neighborhood(entity, k=1), sample)
+         benchmark.measure(f"{name} neighborhood k=2, 1000 entities" + suffix, lambda entity: index.neighborhood(entity, k=2, max_entities=1000), sample)
+         benchmark.measure(f"{name} shortest_path" + suffix, lambda pair: index.shortest_path(*pair), pairs)
+
+   return {"results": benchmark.results}
+
+
+def measure_import(module: str) -> tuple:
+   """Import a module in a new interpreter, without the OpenAI API key (importing must not need it).
+
+   Returns:
+      tuple: The import time in seconds and the LAZY_MODULES it loaded.
+   """
+   code = (
+      "import time, sys, json\n"
+      "start = time.perf_counter()\n"
+      f"import {module}\n"
+      "elapsed = time.perf_counter() - start\n"
+      f"print(json.dumps([elapsed, [name for name in {LAZY_MODULES!r} if name in sys.modules]]))"
+   )
+   environment = {key: value for key, value in os.environ.items() if key != "OPENAI_API_KEY"}
+   directory = os.path.dirname(os.path.abspath(__file__))
+   output = subprocess.run([sys.executable, "-c", code], cwd=directory, env=environment, capture_output=True, text=True, check=True).stdout
+   elapsed, loaded = json.loads(output.splitlines()[-1])
+   return elapsed, loaded
+
+
+def benchmark_imports(budgets: dict = None, repeat: int = 5) -> dict:
+   """Cold import time of the modules (each import in a new interpreter), checked against their budgets.
+
+   Parameters:
+      budgets (dict): Module name to p50 budget in milliseconds, IMPORT_BUDGETS by default.
+      repeat (int): Number of imports of each module.
+
+   Returns:
+      dict: The stats of the imports ('results') and the modules over budget or loading LAZY_MODULES ('failures').
+   """
+   budgets = budgets or IMPORT_BUDGETS
+   benchmark = Benchmark(memory=False)
+   failures = []
+   for module, budget in budgets.items():
+      measurements = [measure_import(module) for _ in range(repeat)]
+      benchmark.record(f"import {module} (budget {budget} ms)", [elapsed for elapsed, _ in measurements], repeat)
+      p50 = benchmark.results[-1]["p50_ms"]
+      loaded = sorted({name for _, names in measurements for name in names})
+      if p50 > budget or loaded:
+         failures.append({"module": module, "p50_ms": p50, "budget_ms": budget, "loaded": loaded})
+   return {"results": benchmark.results, "failures": failures}
+
+
+def main(argv: list = None):
+   parser = argparse.ArgumentParser(description="Offline benchmarks of the knowledge graph pipeline and graph operations.")
+   parser.add_argument("-o", "--output", default=None, help="JSON file the results are written to")
+   parser.add_argument("--no-memory", action="store_true", help="don't measure the peak memory (faster)")
+   subparsers = parser.add_subparsers(dest="suite", required=True)
+
+   pipeline = subparsers.add_parser("pipeline", help="pipeline stages against a local fake OpenAI/Bing server")
+   pipeline.add_argument("--queries", default=None, help="file of queries (see batchRunner.load_queries), the queries of test.ipynb by default")
+   pipeline.add_argument("--repeat", type=int, default=1, help="number of passes over the queries")
+   pipeline.add_argument("--latency", type=float, default=0.2, help="time to first token of a completion, in seconds")
+   pipeline.add_argument("--search-latency", type=float, default=0.1, help="latency of a Bing request, in seconds")
+   pipeline.add_argument("--tokens-per-second", type=float, default=100.0, help="generation rate of the completions")
+   pipeline.add_argument("--jitter", type=float, default=0.0, help="relative random variation of the latencies")
+   pipeline.add_argument("--error-rate", type=float, default=0.0, help="probability of a 429 error per completion")
+   pipeline.add_argument("--fixtures", default=None, help="JSON file of recorded responses (see fakeServer.load_fixtures)")
+   pipeline.add_argument("--num-results", type=int, default=7, help="number of web search results")
+   pipeline.add_argument("-w", "--workers", type=int, default=4, help="number of workers of the batch runner")
+   pipeline.add_argument("--trace", action="store_true", help="also trace the pipeline and report the stats of the spans (nested stages and API calls)")
+
+   graph = subparsers.add_parser("graph", help="graph micro-benchmarks on synthetic graphs")
+   graph.add_argument("--sizes", type=int, nargs="+", default=[10**3, 10**4, 10**5, 10**6], help="numbers of edges")
+   graph.add_argument("--num-queries", type=int, default=1000, help="number of neighborhood and path queries per size")
+
+   imports = subparsers.add_parser("imports", help="cold import time of the modules, checked against their budgets")
+   imports.add_argument("--repeat", type=int, default=5, help="number of imports of each module")
+   imports.add_argument("--modules", nargs="+", default=None, help="modules measured, those of IMPORT_BUDGETS by default")
+   imports.add_argument("--budget", type=float, default=None, help="budget in milliseconds of the --modules")
+   args = parser.parse_args(argv)
+
+   if args.suite == "pipeline":
+      os.environ.setdefault("TIKTOKEN_CACHE_DIR", TIKTOKEN_CACHE_DIR)
+      try:
+         get_encoding()
+      except Exception as error:
+         print(f"The tiktoken encoding can't be loaded ({type(error).__name__}). Run the benchmark once with network access to "
+               f"seed {os.environ['TIKTOKEN_CACHE_DIR']}, or set TIKTOKEN_CACHE_DIR to a directory with the BPE files.", file=sys.stderr)
+         return 1
+      if args.queries:
+         from batchRunner import load_queries
+         queries = load_queries(args.queries)
+      else:
+         queries = DEFAULT_QUERIES
+      fixtures = load_fixtures(args.fixtures) if args.fixtures else None
+      server = FakeAPIServer(latency=args.latency, search_latency=args.search_latency, tokens_per_second=args.tokens_per_second, jitter=args.jitter, error_rate=args.error_rate, fixtures=fixtures)
+      spans = SummaryExporter() if args.trace else None
+      if spans:
+         enable_tracing(spans)
+      try:
+         with server:
+            report = benchmark_pipeline(server, queries, repeat=args.repeat, num_results=args.num_results, workers=args.workers, memory=not args.no_memory)
+      finally:
+         disable_tracing()
+      if spans:
+         report["spans"] = spans.summary()
+   elif args.suite == "imports":
+      budgets = None
+      if args.modules:
+         budgets = {module: args.budget or IMPORT_BUDGETS.get(module, 1000) for module in args.modules}
+      report = benchmark_imports(budgets, repeat=args.repeat)
+   else:
+      report = benchmark_graph(sizes=args.sizes, num_queries=args.num_queries, memory=not args.no_memory)
+
+   print(format_results(report["results"]))
+   if "spans" in report:
+      print()
+      print(spans.report())
+   if args.output:
+      with open(args.output, "w", encoding="utf-8") as file:
+         json.dump(report, file, indent=3)
+
+   for failure in report.get("failures", ()):
+      reason = f"loads {', '.join(failure['loaded'])}" if failure["loaded"] else f"{failure['p50_ms']:.0f} ms > {failure['budget_ms']} ms"
+      print(f"import {failure['module']}: over budget ({reason})", file=sys.stderr)
+   return 1 if report.get("failures") else 0
+
+
+if __name__ == "__main__":
+   sys.exit(main())
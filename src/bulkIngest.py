@@ -0,0 +1,256 @@
+# Bulk ingestion of saved relationship files (text_to_json outputs, batchRunner results) into one merged graph
+
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from knowledgeGraph import KnowledgeGraph
+from graphStore import GraphStore
+from nlpUtils import is_relationship
+import itertools
+import argparse
+import warnings
+import json
+import time
+import glob
+import sys
+import os
+
+EXTENSIONS = (".json", ".jsonl")
+# Maximum size of the parts of a JSONL file parsed at once, so that the memory used doesn't grow with the size of the files
+CHUNK_BYTES = 4 * 2**20
+
+
+def iter_files(paths) -> iter:
+   """Yield the JSON and JSONL files of paths (files, directories searched recursively, or glob patterns), in order.
+   Paths that don't exist or match no file are reported with a warning.
+
+   Parameters:
+      paths (iterable of str, or str): The paths, or a single path.
+   """
+   if isinstance(paths, (str, os.PathLike)):
+      paths = [paths]
+   for path in map(os.fspath, paths):
+      if os.path.isdir(path):
+         for directory, subdirectories, files in os.walk(path):
+            subdirectories.sort()
+            for name in sorted(files):
+               if name.endswith(EXTENSIONS):
+                  yield os.path.join(directory, name)
+      elif os.path.isfile(path):
+         yield path
+      else:
+         matches = [match for match in sorted(glob.glob(path, recursive=True)) if match.endswith(EXTENSIONS) and os.path.isfile(match)]
+         if not matches:
+            warnings.warn(f"No JSON or JSONL file found at {path}")
+         yield from matches
+
+
+def iter_chunks(files, chunk_bytes: int = CHUNK_BYTES) -> iter:
+   """Split files into the (path, start, end) byte ranges parsed at once: parts of about chunk_bytes of a JSONL file,
+   a JSON file as a whole (a single document)."""
+   for path in files:
+      size = os.path.getsize(path)
+      if not path.endswith(".jsonl") or size <= chunk_bytes:
+         yield path, 0, size
+      else:
+         for start in range(0, size, chunk_bytes):
+            yield path, start, min(start + chunk_bytes, size)
+
+
+def iter_records(value):
+   """Yield the (query, relationships) records of a parsed JSON value: an object with a 'relationships' list (and an
+   optional 'query', e.g. a batchRunner result), a list of relationships, or a list of such objects."""
+   if isinstance(value, dict):
+      if isinstance(value.get("relationships"), list):
+         yield value.get("query"), value["relationships"]
+   elif isinstance(value, list):
+      if value and all(isinstance(item, dict) and "relationships" in item for item in value):
+         for item in value:
+            yield from iter_records(item)
+      else:
+         yield None, value
+
+
+def iter_lines(file, start: int, end: int) -> iter:
+   """Yield the lines of a binary file that start in the byte range [start, end). The line running over the start
+   belongs to the previous range."""
+   if start > 0:
+      file.seek(start - 1)
+      file.readline()
+   while file.tell() < end:
+      line = file.readline()
+      if not line:
+         break
+      yield line
+
+
+def parse_file(path: str, start: int = 0, end: int = None) -> dict:
+   """Parse a relationship file, or the lines of a JSONL file starting in a byte range (see iter_chunks), in a worker
+   process. Lines that can't be decoded or parsed (e.g. a partial last line left by a crash) are counted and skipped.
+
+   Parameters:
+      path (str): The file.
+      start (int): Start of the byte range.
+      end (int or None): End of the byte range, the end of the file if None.
+
+   Returns:
+      dict: The file, the size of the range, whether the range ends the file, its records as
+         (query, [(src, relationship, tgt), ...]) tuples, and the number of invalid lines and relationships skipped.
+   """
+   size = os.path.getsize(path)
+   end = size if end is None else end
+   records = []
+   invalid_lines = 0
+   invalid_relationships = 0
+
+   def add(value):
+      nonlocal invalid_relationships
+      for query, relationships in iter_records(value):
+         valid = [(rel["src"], rel["relationship"], rel["tgt"]) for rel in relationships if is_relationship(rel)]
+         invalid_relationships += len(relationships) - len(valid)
+         records.append((query, valid))
+
+   with open(path, "rb") as file:
+      if path.endswith(".jsonl"):
+         for line in iter_lines(file, start, end):
+            if not line.strip():
+               continue
+            try:
+               add(json.loads(line.decode("utf-8")))
+            except ValueError:
+               invalid_lines += 1
+      else:
+         try:
+            add(json.loads(file.read().decode("utf-8")))
+         except ValueError:
+            invalid_lines += 1
+
+   return {"path": path, "bytes": end - start, "last": end >= size, "records": records, "invalid_lines": invalid_lines, "invalid_relationships": invalid_relationships}
+
+
+def iter_parsed(paths, workers: int = None, window: int = None, chunk_bytes: int = CHUNK_BYTES) -> iter:
+   """Parse files in a process pool and yield the results as they complete, one per chunk of a file (see iter_chunks).
+   At most `window` chunks are parsed or waiting to be consumed at a time, so memory doesn't grow with the number or
+   the size of the files.
+
+   Parameters:
+      paths (iterable of str): The files, can be a generator.
+      workers (int or None): Number of worker processes, the number of CPUs by default. 0 parses in this process
+         (the default on a single CPU, where the pool only adds the cost of sending the results between processes).
+      window (int or None): Maximum number of chunks in flight, 2 * workers by default.
+      chunk_bytes (int): Maximum size of the chunks of the JSONL files.
+   """
+   chunks = iter_chunks(paths, chunk_bytes=chunk_bytes)
+   if workers is None:
+      workers = os.cpu_count() or 1
+      workers = workers if workers > 1 else 0
+   if workers == 0:
+      yield from itertools.starmap(parse_file, chunks)
+      return
+
+   window = window or 2 * workers
+   with ProcessPoolExecutor(max_workers=workers) as executor:
+      pending = set()
+      exhausted = False
+      while pending or not exhausted:
+         while not exhausted and len(pending) < window:
+            chunk = next(chunks, None)
+            if chunk is None:
+               exhausted = True
+            else:
+               pending.add(executor.submit(parse_file, *chunk))
+         if not pending:
+            break
+         done, pending = wait(pending, return_when=FIRST_COMPLETED)
+         for future in done:
+            yield future.result()
+
+
+def ingest(paths, knowledge_graph: KnowledgeGraph = None, workers: int = None, window: int = None, store: GraphStore = None, on_progress=None) -> tuple:
+   """Stream relationship files into one merged graph. The files are parsed in a process pool (see iter_parsed) and
+   their relationships added to the graph as they arrive, each edge tagged with its provenance: `source_file` and, if
+   known, `source_query`.
+
+   Parameters:
+      paths (iterable of str, or str): Files, directories or glob patterns (or a single one), see iter_files.
+      knowledge_graph (KnowledgeGraph or None): The graph merged into, a new graph with the compact backend by default.
+      workers (int or None): Number of worker processes, see iter_parsed.
+      window (int or None): Maximum number of chunks of files in flight, see iter_parsed.
+      store (GraphStore or None): Store the relationships are also upserted into (per query, or per file if unknown).
+      on_progress (callable or None): Called with the stats after each chunk of a file.
+
+   Returns:
+      tuple: The graph and the stats (files, records, relationships, invalid lines and relationships, bytes, elapsed
+         time, throughput).
+   """
+   knowledge_graph = knowledge_graph if knowledge_graph is not None else KnowledgeGraph(backend="compact")
+   stats = {"files": 0, "records": 0, "relationships": 0, "invalid_lines": 0, "invalid_relationships": 0, "bytes": 0}
+   start_time = time.perf_counter()
+
+   for parsed in iter_parsed(iter_files(paths), workers=workers, window=window):
+      for query, relationships in parsed["records"]:
+         provenance = {"source_file": parsed["path"]}
+         if query is not None:
+            provenance["source_query"] = query
+         for source, relationship, target in relationships:
+            knowledge_graph.add_entity(source)
+            knowledge_graph.add_entity(target)
+            knowledge_graph.add_relationship(source, target, relationship, **provenance)
+         if store is not None:
+            store.upsert([{"src": src, "relationship": rel, "tgt": tgt} for src, rel, tgt in relationships], query=query if query is not None else parsed["path"])
+         stats["records"] += 1
+         stats["relationships"] += len(relationships)
+
+      stats["files"] += parsed["last"]
+      for key in ("invalid_lines", "invalid_relationships", "bytes"):
+         stats[key] += parsed[key]
+      if on_progress is not None:
+         on_progress(throughput(stats, time.perf_counter() - start_time))
+
+   return knowledge_graph, throughput(stats, time.perf_counter() - start_time)
+
+
+def throughput(stats: dict, elapsed_time: float) -> dict:
+   elapsed_time = max(elapsed_time, 1e-9)
+   return {
+      **stats,
+      "elapsed_time": round(elapsed_time, 3),
+      "files_per_second": round(stats["files"] / elapsed_time, 1),
+      "relationships_per_second": round(stats["relationships"] / elapsed_time, 1),
+      "megabytes_per_second": round(stats["bytes"] / elapsed_time / 2**20, 2)
+   }
+
+
+def main(argv: list = None):
+   parser = argparse.ArgumentParser(description="Merge saved relationship files (JSON or JSONL) into one graph.")
+   parser.add_argument("paths", nargs="+", help="files, directories or glob patterns")
+   parser.add_argument("-o", "--output", default=None, help="JSONL file the merged relationships are written to, with their provenance")
+   parser.add_argument("--store", default=None, help="SQLite graph store the relationships are also upserted into")
+   parser.add_argument("-w", "--workers", type=int, default=None, help="number of worker processes parsing the files (0: no pool)")
+   parser.add_argument("--backend", choices=["networkx", "compact"], default="compact", help="storage of the merged graph")
+   args = parser.parse_args(argv)
+
+   # Number of files at the last report, the stats are reported after each chunk of a file
+   reported = 0
+
+   def report(stats):
+      nonlocal reported
+      if stats["files"] % 100 == 0 and stats["files"] != reported:
+         reported = stats["files"]
+         print(f"{stats['files']} files, {stats['relationships']} relationships ({stats['relationships_per_second']:.0f}/s)", file=sys.stderr)
+
+   store = GraphStore(args.store) if args.store else None
+   knowledge_graph, stats = ingest(args.paths, knowledge_graph=KnowledgeGraph(backend=args.backend), workers=args.workers, store=store, on_progress=report)
+   if store is not None:
+      store.close()
+
+   if args.output:
+      with open(args.output, "w", encoding="utf-8") as file:
+         for source, target, relationship, attributes in knowledge_graph.edges(data=True):
+            file.write(json.dumps({"src": source, "relationship": relationship, "tgt": target, **attributes}) + "\n")
+
+   stats["entities"] = knowledge_graph.store.number_of_nodes()
+   print(json.dumps(stats, indent=3))
+   return 0
+
+
+if __name__ == "__main__":
+   sys.exit(main())
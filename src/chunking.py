@@ -0,0 +1,138 @@
+# Split retrieved text into chunks that fit a token budget, on snippet boundaries
+
+from numTokens import num_tokens_str, num_tokens_batch
+import re
+
+SENTENCE_BOUNDARY = re.compile(r"(?<=[.!?])\s+")
+
+
+def split_snippets(data: str, separator: str = "\n\n") -> list:
+   """Split the text returned by dataRetrieval.retrieve_data into its snippets.
+
+   Parameters:
+      data (str): The text.
+      separator (str): The separator between the snippets.
+
+   Returns:
+      list: The non-empty snippets.
+   """
+   return [snippet.strip() for snippet in data.split(separator) if snippet.strip()]
+
+
+def split_oversized(snippet: str, max_tokens: int, model: str = "gpt-4") -> list:
+   """Split a snippet longer than max_tokens on sentence boundaries, sentences that are still too long are cut by words.
+
+   Parameters:
+      snippet (str): The snippet.
+      max_tokens (int): The token budget of each part.
+      model (str): The model used for encoding.
+
+   Returns:
+      list: The parts of the snippet.
+   """
+   pieces = []
+   for sentence in SENTENCE_BOUNDARY.split(snippet):
+      if num_tokens_str(sentence, model=model) <= max_tokens:
+         pieces.append(sentence)
+         continue
+      words = sentence.split()
+      # Words are at least one token each, so at most max_tokens words per piece (halved until the piece fits)
+      step = max_tokens
+      start = 0
+      while start < len(words):
+         piece = " ".join(words[start:start + step])
+         if num_tokens_str(piece, model=model) > max_tokens:
+            if step > 1:
+               step //= 2
+               continue
+            # A single word over the budget (e.g. a URL or a base64 blob) is cut by characters
+            pieces += split_characters(piece, max_tokens=max_tokens, model=model)
+         else:
+            pieces.append(piece)
+         start += step
+
+   return pack(pieces, max_tokens=max_tokens, model=model, separator=" ")
+
+
+def split_characters(text: str, max_tokens: int, model: str = "gpt-4") -> list:
+   """Cut a text without spaces into parts of at most max_tokens tokens."""
+   parts = []
+   while text:
+      size = len(text)
+      tokens = num_tokens_str(text[:size], model=model)
+      while tokens > max_tokens:
+         size = max(1, min(size - 1, size * max_tokens // tokens))
+         tokens = num_tokens_str(text[:size], model=model)
+      parts.append(text[:size])
+      text = text[size:]
+   return parts
+
+
+def pack(pieces: list, max_tokens: int, model: str = "gpt-4", separator: str = "\n\n") -> list:
+   """Greedily pack consecutive pieces of text into chunks of at most max_tokens tokens.
+
+   Parameters:
+      pieces (list): The pieces of text, each one within the budget.
+      max_tokens (int): The token budget of a chunk.
+      model (str): The model used for encoding.
+      separator (str): The separator between the pieces of a chunk.
+
+   Returns:
+      list: The chunks.
+   """
+   separator_tokens = num_tokens_str(separator, model=model)
+   chunks = []
+   current = []
+   current_tokens = 0
+
+   for piece, tokens in zip(pieces, num_tokens_batch(pieces, model=model)):
+      if current and current_tokens + separator_tokens + tokens > max_tokens:
+         chunks.append(separator.join(current))
+         current = []
+         current_tokens = 0
+      current_tokens += tokens + (separator_tokens if current else 0)
+      current.append(piece)
+
+   if current:
+      chunks.append(separator.join(current))
+
+   return chunks
+
+
+def split_text(data: str, max_tokens: int, model: str = "gpt-4", separator: str = "\n\n") -> list:
+   """Split the text into its snippets, snippets longer than max_tokens are split on sentence boundaries.
+
+   Parameters:
+      data (str): The text, e.g. returned by dataRetrieval.retrieve_data.
+      max_tokens (int): The token budget of a piece.
+      model (str): The model used for encoding.
+      separator (str): The separator between the snippets.
+
+   Returns:
+      list: The pieces.
+   """
+   pieces = []
+   snippets = split_snippets(data, separator=separator)
+   for snippet, tokens in zip(snippets, num_tokens_batch(snippets, model=model)):
+      if tokens <= max_tokens:
+         pieces.append(snippet)
+      else:
+         pieces += split_oversized(snippet, max_tokens=max_tokens, model=model)
+   return pieces
+
+
+def chunk_text(data: str, max_tokens: int = 2000, model: str = "gpt-4", separator: str = "\n\n") -> list:
+   """Split the text into chunks of at most max_tokens tokens. Snippets are kept whole whenever they fit,
+   longer ones are split on sentence boundaries.
+
+   Parameters:
+      data (str): The text, e.g. returned by dataRetrieval.retrieve_data.
+      max_tokens (int): The token budget of a chunk.
+      model (str): The model used for encoding.
+      separator (str): The separator between the snippets.
+
+   Returns:
+      list: The chunks.
+   """
+   pieces = split_text(data, max_tokens=max_tokens, model=model, separator=separator)
+   return pack(pieces, max_tokens=max_tokens, model=model, separator=separator)
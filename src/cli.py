@@ -0,0 +1,45 @@
+# Command line entry point (`kga`): dispatches to the command line of the modules, imported only when their command runs
+
+import importlib
+import sys
+
+# Command name to (module, description), the module has a main(argv) function
+COMMANDS = {
+   "batch": ("batchRunner", "run the pipeline for a batch of entities"),
+   "expand": ("graphExpansion", "expand a knowledge graph over several hops"),
+   "ingest": ("bulkIngest", "merge saved relationship files into one graph"),
+   "benchmark": ("benchmark", "offline benchmarks (pipeline, graph, imports)")
+}
+
+
+def usage() -> str:
+   lines = ["usage: kga <command> [options]", "", "commands:"]
+   lines += [f"  {name:<12}{description}" for name, (_, description) in COMMANDS.items()]
+   lines += ["", "Run `kga <command> --help` for the options of a command."]
+   return "\n".join(lines)
+
+
+def main(argv: list = None) -> int:
+   """Run a command, e.g. `kga batch queries.jsonl -o results.jsonl`.
+
+   Parameters:
+      argv (list or None): The arguments, sys.argv[1:] by default.
+
+   Returns:
+      int: The exit status of the command.
+   """
+   argv = sys.argv[1:] if argv is None else list(argv)
+   if not argv or argv[0] in ("-h", "--help"):
+      print(usage())
+      return 0
+   if argv[0] not in COMMANDS:
+      print(usage(), file=sys.stderr)
+      print(f"\nkga: unknown command '{argv[0]}'", file=sys.stderr)
+      return 2
+
+   module, _ = COMMANDS[argv[0]]
+   return importlib.import_module(module).main(argv[1:])
+
+
+if __name__ == "__main__":
+   sys.exit(main())
@@ -0,0 +1,184 @@
+# Shared API clients, created on first use (importing the pipeline modules doesn't need API keys or the openai package)
+
+from concurrent.futures import Future
+from contextlib import contextmanager
+import contextvars
+import threading
+import atexit
+
+# The shared OpenAI client, see get_openai_client
+openai_client = None
+openai_client_lock = threading.Lock()
+
+# Event loop of the synchronous wrappers of the async code (see run_coroutine), running in a daemon thread, and the HTTP
+# client used on it, whose keep-alive connections are reused by all the calls
+event_loop = None
+http_client = None
+event_loop_lock = threading.Lock()
+
+# HTTP clients of the other event loops running the async code (e.g. an application awaiting retrieve_data_async on its
+# own loop), one per loop since httpx clients are bound to the loop of their connections
+loop_http_clients = {}
+loop_http_clients_lock = threading.Lock()
+
+
+def create_openai_client(**kwargs):
+   """Create a new OpenAI client, e.g. with a base_url, timeout or max_retries.
+
+   Parameters:
+      kwargs: Arguments of openai.OpenAI. The API key and base URL default to the environment variables.
+
+   Returns:
+      OpenAI: The client.
+   """
+   from openai import OpenAI
+   return OpenAI(**kwargs)
+
+
+def get_openai_client():
+   """The OpenAI client shared by all the API calls, created on first use. It is thread-safe and keeps a pool of
+   keep-alive connections, so it is reused by all the threads instead of creating a client per call.
+
+   Returns:
+      OpenAI: The client, or the client set with set_openai_client.
+   """
+   global openai_client
+   client = openai_client
+   if client is None:
+      with openai_client_lock:
+         if openai_client is None:
+            openai_client = create_openai_client()
+         client = openai_client
+   return client
+
+
+def set_openai_client(client):
+   """Replace the shared OpenAI client, e.g. with a client pointed to a local server, or a stand-in exposing
+   chat.completions.create (and embeddings.create for OpenAIEmbedder).
+
+   Parameters:
+      client (OpenAI or None): The client, None to create a new one on next use (e.g. after changing the environment).
+
+   Returns:
+      OpenAI or None: The previous client.
+   """
+   global openai_client
+   with openai_client_lock:
+      previous, openai_client = openai_client, client
+   return previous
+
+
+@contextmanager
+def use_openai_client(client):
+   """Use a client as the shared OpenAI client within a `with` block, the previous client is restored on exit."""
+   previous = set_openai_client(client)
+   try:
+      yield client
+   finally:
+      set_openai_client(previous)
+
+
+def get_event_loop():
+   """The shared event loop, started in a daemon thread on first use."""
+   # Imported on first use like the clients, asyncio would be most of the import time of this module
+   import asyncio
+   global event_loop
+   with event_loop_lock:
+      if event_loop is None:
+         loop = asyncio.new_event_loop()
+         threading.Thread(target=loop.run_forever, name="clients-event-loop", daemon=True).start()
+         event_loop = loop
+      return event_loop
+
+
+def run_coroutine(coroutine):
+   """Run a coroutine on the shared event loop and wait for its result, from any thread (including one running its own
+   event loop, e.g. Jupyter). The coroutine runs in a copy of the context of the caller (e.g. its current span).
+
+   Parameters:
+      coroutine (coroutine): The coroutine to run.
+
+   Returns:
+      The result of the coroutine.
+   """
+   import asyncio
+   loop = get_event_loop()
+   try:
+      running = asyncio.get_running_loop()
+   except RuntimeError:
+      running = None
+   if running is loop:
+      coroutine.close()
+      raise RuntimeError("run_coroutine can't wait for a coroutine from the shared event loop itself, await it instead")
+
+   future = Future()
+
+   def start():
+      # The task copies the current context, i.e. the context of the caller
+      task = asyncio.ensure_future(coroutine)
+
+      def done(task):
+         if task.cancelled():
+            future.cancel()
+         elif task.exception() is not None:
+            future.set_exception(task.exception())
+         else:
+            future.set_result(task.result())
+
+      task.add_done_callback(done)
+
+   loop.call_soon_threadsafe(start, context=contextvars.copy_context())
+   return future.result()
+
+
+def get_http_client():
+   """The HTTP client of the running event loop, created on first use: the client of the shared event loop (see
+   run_coroutine), or a client per other loop. It keeps a pool of keep-alive connections reused by all the requests
+   of the loop, and must only be used by coroutines running on it. The clients of the other loops are dropped once
+   their loop is closed (they can't be closed without it).
+
+   Returns:
+      httpx.AsyncClient: The client.
+   """
+   global http_client
+   import httpx
+   if on_event_loop():
+      if http_client is None:
+         http_client = httpx.AsyncClient()
+      return http_client
+
+   import asyncio
+   loop = asyncio.get_running_loop()
+   with loop_http_clients_lock:
+      client = loop_http_clients.get(loop)
+      if client is None:
+         for closed in [other for other in loop_http_clients if other.is_closed()]:
+            del loop_http_clients[closed]
+         client = loop_http_clients[loop] = httpx.AsyncClient()
+      return client
+
+
+def on_event_loop() -> bool:
+   """Whether the caller runs on the shared event loop."""
+   if event_loop is None:
+      return False
+   import asyncio
+   try:
+      return asyncio.get_running_loop() is event_loop
+   except RuntimeError:
+      return False
+
+
+@atexit.register
+def close_clients():
+   """Close the HTTP client and stop the shared event loop (at exit). They are created again on next use."""
+   global event_loop, http_client
+   with event_loop_lock:
+      loop, event_loop = event_loop, None
+   if loop is None:
+      return
+   import asyncio
+   client, http_client = http_client, None
+   if client is not None:
+      asyncio.run_coroutine_threadsafe(client.aclose(), loop).result(timeout=5)
+   loop.call_soon_threadsafe(loop.stop)
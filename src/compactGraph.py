@@ -0,0 +1,145 @@
+# Compact storage of a knowledge graph: interned entities and relationship labels, array-based edge columns
+
+from array import array
+import networkx as nx
+import numpy as np
+
+
+class CompactGraph:
+   """Directed multigraph storing interned entity and relationship label IDs in array columns, one row per edge.
+   Exposes the subset of the networkx MultiDiGraph API used by KnowledgeGraph (add_node, add_edge, number_of_nodes, ...),
+   the CSR adjacency and the networkx export are built lazily."""
+
+   def __init__(self):
+      # Interning tables: ID -> string and string -> ID
+      self.entities = []
+      self.entity_ids = {}
+      self.labels = []
+      self.label_ids = {}
+
+      # Edge columns
+      self.sources = array("q")
+      self.targets = array("q")
+      self.relationships = array("q")
+
+      # Optional edge attributes (e.g. provenance): a column of interned value IDs per key, -1 where the edge doesn't
+      # have the attribute
+      self.attributes = {}
+      self.values = []
+      self.value_ids = {}
+
+      # CSR adjacency per direction ("out", "in")
+      self.__csr = {}
+      self.__networkx = None
+
+   def __intern_entity(self, entity) -> int:
+      entity_id = self.entity_ids.get(entity)
+      if entity_id is None:
+         entity_id = len(self.entities)
+         self.entity_ids[entity] = entity_id
+         self.entities.append(entity)
+         self.__csr = {}
+         self.__networkx = None
+      return entity_id
+
+   def __intern_label(self, label) -> int:
+      label_id = self.label_ids.get(label)
+      if label_id is None:
+         label_id = len(self.labels)
+         self.label_ids[label] = label_id
+         self.labels.append(label)
+      return label_id
+
+   def add_node(self, entity) -> int:
+      """Add an entity (if new) and return its ID."""
+      return self.__intern_entity(entity)
+
+   def __intern_value(self, value) -> int:
+      value_id = self.value_ids.get(value)
+      if value_id is None:
+         value_id = len(self.values)
+         self.value_ids[value] = value_id
+         self.values.append(value)
+      return value_id
+
+   def add_edge(self, source, target, relationship, **attributes) -> int:
+      """Add an edge (adding its entities if new) and return its ID. The attribute values must be hashable, they are
+      interned like the entities."""
+      edge_id = len(self.sources)
+      for key in attributes:
+         if key not in self.attributes:
+            self.attributes[key] = array("q", [-1]) * edge_id
+      for key, column in self.attributes.items():
+         column.append(self.__intern_value(attributes[key]) if key in attributes else -1)
+
+      self.sources.append(self.__intern_entity(source))
+      self.targets.append(self.__intern_entity(target))
+      self.relationships.append(self.__intern_label(relationship))
+      self.__csr = {}
+      self.__networkx = None
+      return edge_id
+
+   def edge_attributes(self, edge_id: int) -> dict:
+      """The attributes of an edge, without the relationship."""
+      return {key: self.values[column[edge_id]] for key, column in self.attributes.items() if column[edge_id] >= 0}
+
+   def has_node(self, entity) -> bool:
+      return entity in self.entity_ids
+
+   def number_of_nodes(self) -> int:
+      return len(self.entities)
+
+   def number_of_edges(self) -> int:
+      return len(self.sources)
+
+   def nodes(self):
+      return list(self.entities)
+
+   def edges(self, data: bool = False):
+      """Yield the edges as (source, target, relationship) tuples, in insertion order, or (source, target, relationship,
+      attributes) tuples if data is True."""
+      entities, labels = self.entities, self.labels
+      if data:
+         for edge_id, (source, target, relationship) in enumerate(zip(self.sources, self.targets, self.relationships)):
+            yield entities[source], entities[target], labels[relationship], self.edge_attributes(edge_id)
+         return
+      for source, target, relationship in zip(self.sources, self.targets, self.relationships):
+         yield entities[source], entities[target], labels[relationship]
+
+   def csr(self, direction: str = "out") -> tuple:
+      """Return the out-adjacency (or the in-adjacency if direction is "in") in CSR form, built on first use after a change.
+
+      Returns:
+         tuple: `offsets` (number of entities + 1) and `edge_ids` (number of edges) arrays. The IDs of the edges out of
+            (or into) entity i are edge_ids[offsets[i]:offsets[i + 1]], in insertion order.
+      """
+      csr = self.__csr.get(direction)
+      if csr is None:
+         column = self.sources if direction == "out" else self.targets
+         ends = np.frombuffer(column, dtype=np.int64) if len(column) else np.zeros(0, dtype=np.int64)
+         edge_ids = np.argsort(ends, kind="stable")
+         offsets = np.zeros(len(self.entities) + 1, dtype=np.int64)
+         np.cumsum(np.bincount(ends, minlength=len(self.entities)), out=offsets[1:])
+         csr = self.__csr[direction] = (offsets, edge_ids)
+      return csr
+
+   def out_edges(self, entity):
+      """Yield the (target, relationship) pairs of the edges out of an entity."""
+      offsets, edge_ids = self.csr()
+      entity_id = self.entity_ids[entity]
+      for edge_id in edge_ids[offsets[entity_id]:offsets[entity_id + 1]]:
+         yield self.entities[self.targets[edge_id]], self.labels[self.relationships[edge_id]]
+
+   def to_networkx(self) -> nx.MultiDiGraph:
+      """Export to a networkx MultiDiGraph (with a 'relationship' attribute per edge), cached until the graph changes.
+      The exported graph should be treated as read-only."""
+      if self.__networkx is None:
+         graph = nx.MultiDiGraph()
+         graph.add_nodes_from(self.entities)
+         graph.add_edges_from((source, target, {**attributes, "relationship": relationship}) for source, target, relationship, attributes in self.edges(data=True))
+         self.__networkx = graph
+      return self.__networkx
+
+   def nbytes(self) -> int:
+      """Approximate memory used by the edge columns (excluding the interned strings)."""
+      return sum(column.itemsize * len(column) for column in (self.sources, self.targets, self.relationships, *self.attributes.values()))
@@ -1,15 +1,62 @@
-from openai import OpenAI
+from nlpUtils import create_completion
+from tracing import traced, current_span
+from deduplication import deduplicate_passages
+from responseCache import SearchCache
+from clients import run_coroutine, get_http_client
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
+import functools
+import threading
+import asyncio
+import warnings
 import requests
+import httpx
 import os 
 
 
 # TODO: Future Development
 # - Receive additional input for topic / type of the relationships wanted, # e.g., only show investments, locations, co-workers, etc.
 # - Investigate other search APIs or knowledge bases to diversify results, # e.g., Google Search API, SerpApi, Crunchbase API
-# - Implement web page scraping to get more information and use OpenAI’s text embeddings for searching
+# - Implement web page scraping to get more information, searched with passageIndex.PassageIndex (e.g. with OpenAIEmbedder)
 
 
-client = OpenAI()
+# Per-source timeouts (in seconds) used by the concurrent retrieval path
+SOURCE_TIMEOUTS = {
+   "bing_entity_search": 10.0,
+   "bing_web_search": 10.0,
+   "generate_additional_data": 60.0
+}
+
+# Optional cache of the Bing responses, see enable_search_cache
+search_cache = None
+
+# Worker threads of the OpenAI calls of the async path (see generate_additional_data_async), created on first use. A
+# call whose timeout expires keeps running in its thread until the client's own timeout, so they are kept apart from
+# the default executor of the event loop (also used for DNS resolution)
+GENERATION_WORKERS = 32
+generation_executor = None
+generation_executor_lock = threading.Lock()
+
+
+def enable_search_cache(**kwargs) -> SearchCache:
+   """Cache the Bing Search responses, with single-flight coalescing of identical concurrent requests and
+   stale-while-revalidate.
+
+   Parameters:
+      kwargs: Arguments of SearchCache, e.g. ttl, stale_ttl, max_entries, path (disk tier).
+
+   Returns:
+      SearchCache: The cache, its stats() method reports the hits, misses and coalesced requests.
+   """
+   global search_cache
+   search_cache = SearchCache(**kwargs)
+   return search_cache
+
+
+def disable_search_cache():
+   global search_cache
+   search_cache = None
+
 
 # take the input from the user and pre-process it
 def process_input() -> str:
@@ -18,19 +65,86 @@ def process_input() -> str:
    return query
 
 
-def retrieve_data(query: str, num_results: int = 7, model: str = "gpt-3.5-turbo"):
-   """Retrieve information about the query. Uses Bing Web Search, Bing Entity Search, OpenAI GPT model
+def retrieve_data(query: str, num_results: int = 7, model: str = "gpt-3.5-turbo", timeouts: dict = None, dedup: bool = False):
+   """Retrieve information about the query. Uses Bing Web Search, Bing Entity Search, OpenAI GPT model.
+   Synchronous wrapper around retrieve_data_async, the sources are queried concurrently.
     
    Parameters:
       query (str): The search query.
       num_results (int): Number of search results to return. Defaults to 7.
       model (str): Model to use, defaults to "gpt-3.5-turbo".
+      timeouts (dict): Per-source timeouts in seconds, overrides SOURCE_TIMEOUTS.
+      dedup (bool): Remove the near-duplicate passages and the sentences repeated across passages (off by default as it
+         changes the returned text), see deduplication.deduplicate_passages.
    
    Returns:
       str: The information collected."""
-   # Retrieve web resources using Bing and combine the results in a single string
-   bing_entity_search_results = bing_entity_search(query)
-   bing_web_search_results = bing_web_search(query, num_results=num_results)
+   return run_sync(retrieve_data_async(query=query, num_results=num_results, model=model, timeouts=timeouts, dedup=dedup))
+
+
+@traced("retrieve_data")
+async def retrieve_data_async(query: str, num_results: int = 7, model: str = "gpt-3.5-turbo", timeouts: dict = None, http_client: httpx.AsyncClient = None, dedup: bool = False):
+   """Retrieve information about the query concurrently from Bing Entity Search, Bing Web Search and an OpenAI GPT model.
+   A source that fails or exceeds its timeout is skipped with a warning, the remaining results are still returned.
+
+   Parameters:
+      query (str): The search query.
+      num_results (int): Number of search results to return. Defaults to 7.
+      model (str): Model to use, defaults to "gpt-3.5-turbo".
+      timeouts (dict): Per-source timeouts in seconds, overrides SOURCE_TIMEOUTS.
+      http_client (httpx.AsyncClient): Pooled keep-alive client for the Bing requests. Defaults to the client of the
+         running event loop (clients.get_http_client), shared by the calls on that loop.
+      dedup (bool): Remove the near-duplicate passages and the sentences repeated across passages (off by default as it
+         changes the returned text), see deduplication.deduplicate_passages.
+
+   Returns:
+      str: The information collected."""
+   timeouts = {**SOURCE_TIMEOUTS, **(timeouts or {})}
+
+   http_client = http_client or get_http_client()
+
+   # Fan out the three sources and wait for all of them (each bounded by its own timeout)
+   sources = {
+      "bing_entity_search": bing_entity_search_async(query, http_client=http_client),
+      "bing_web_search": bing_web_search_async(query, num_results=num_results, http_client=http_client),
+      "generate_additional_data": generate_additional_data_async(query=query, model=model)
+   }
+   results = await asyncio.gather(
+      *[asyncio.wait_for(coroutine, timeout=timeouts[source]) for source, coroutine in sources.items()],
+      return_exceptions=True
+   )
+
+   results = dict(zip(sources, results))
+
+   # Keep the partial results if only some of the sources failed
+   errors = {source: result for source, result in results.items() if isinstance(result, BaseException)}
+   current_span().set("failed_sources", len(errors))
+   if len(errors) == len(results):
+      raise next(iter(errors.values()))
+   for source, error in errors.items():
+      warnings.warn(f"{source} failed for query {query!r}: {error!r}")
+
+   return combine_results(
+      bing_entity_search_results=results["bing_entity_search"] if "bing_entity_search" not in errors else {},
+      bing_web_search_results=results["bing_web_search"] if "bing_web_search" not in errors else {},
+      additional_generated_data=results["generate_additional_data"] if "generate_additional_data" not in errors else "",
+      dedup=dedup
+   )
+
+
+def combine_results(bing_entity_search_results: dict, bing_web_search_results: dict, additional_generated_data: str, dedup: bool = False) -> str:
+   """Combine the results of the different sources in a single string.
+
+   Parameters:
+      bing_entity_search_results (dict): The results returned by Bing Entity Search API.
+      bing_web_search_results (dict): The results returned by Bing Web Search API.
+      additional_generated_data (str): The text generated by the OpenAI GPT model.
+      dedup (bool): Remove the near-duplicate passages and repeated sentences (the generated text is preferred, then
+         the entity descriptions, then the snippets). The tokens saved are recorded on the current span.
+
+   Returns:
+      str: The combined results.
+   """
    combined_results = []
 
    # Retrieve entity information if any
@@ -39,21 +153,104 @@ def retrieve_data(query: str, num_results: int = 7, model: str = "gpt-3.5-turbo"
          combined_results.append(str(entity['description']))
 
    # Retrieve top web search snippets
-   for result in bing_web_search_results["webPages"]["value"]:
-      combined_results.append(str(result['snippet']))
+   if "webPages" in bing_web_search_results:
+      for result in bing_web_search_results["webPages"]["value"]:
+         combined_results.append(str(result['snippet']))
+
+   if dedup:
+      passages = ([additional_generated_data] if additional_generated_data else []) + combined_results
+      passages, stats = deduplicate_passages(passages)
+      trace = current_span()
+      for key in ("duplicates", "repeated_sentences", "tokens_saved"):
+         trace.set(key, stats[key])
+      if additional_generated_data:
+         additional_generated_data, combined_results = passages[0], passages[1:]
+      else:
+         combined_results = passages
 
    # Flatten the list into a single string
    combined_results = '\n\n'.join(combined_results)
 
-   # Generate additional from OpenAI GPT's model if possible
-   additional_generated_data = generate_additional_data(query=query, model=model)
-
-   # Append the additional data
-   combined_results = additional_generated_data + '\n\n' + combined_results
+   # Append the additional data from OpenAI GPT's model if any
+   if additional_generated_data:
+      combined_results = additional_generated_data + '\n\n' + combined_results
 
    return combined_results
 
 
+def run_sync(coroutine):
+   """Run a coroutine to completion from synchronous code, on the shared event loop (see clients.run_coroutine), so
+   that the Bing requests of all the calls reuse the keep-alive connections of the shared HTTP client.
+   Works both without an event loop and inside a running one (e.g. Jupyter).
+
+   Parameters:
+      coroutine (coroutine): The coroutine to run.
+
+   Returns:
+      The result of the coroutine.
+   """
+   return run_coroutine(coroutine)
+
+
+def bing_request(path: str, query: str, exact: bool = True, **params) -> tuple:
+   """Construct a request to the Bing Search API.
+
+   Parameters:
+      path (str): The API path, e.g. "/v7.0/search".
+      query (str): The search query.
+      exact (bool): Whether to perform an exact search. Defaults to True.
+      params: Additional query parameters.
+
+   Returns:
+      tuple: The endpoint, headers and query parameters of the request.
+   """
+   subscription_key = os.environ['BING_SEARCH_V7_SUBSCRIPTION_KEY']
+   endpoint = os.environ['BING_SEARCH_V7_ENDPOINT'] + path
+
+   # Exact expression search
+   query = f'"{query}"' if exact else query
+
+   params = { 'q': query, 'mkt': 'en-US', **params }
+   headers = { 'Ocp-Apim-Subscription-Key': subscription_key }
+
+   return endpoint, headers, params
+
+
+def bing_fetch(endpoint: str, headers: dict, params: dict) -> dict:
+   response = requests.get(endpoint, headers=headers, params=params)
+   response.raise_for_status()
+   return response.json()
+
+
+def bing_get(endpoint: str, headers: dict, params: dict) -> dict:
+   """Send a request to the Bing Search API, through the search cache if it is enabled.
+
+   Returns:
+      dict: The JSON response.
+   """
+   if search_cache is None:
+      return bing_fetch(endpoint, headers, params)
+   return search_cache.fetch(search_cache.key(endpoint, params), lambda: bing_fetch(endpoint, headers, params))
+
+
+async def bing_get_async(endpoint: str, headers: dict, params: dict, http_client: httpx.AsyncClient) -> dict:
+   """Send a request to the Bing Search API without blocking the event loop, through the search cache if it is enabled
+   (stale responses are then revalidated in a background thread).
+
+   Returns:
+      dict: The JSON response.
+   """
+   async def fetch():
+      response = await http_client.get(endpoint, headers=headers, params=params)
+      response.raise_for_status()
+      return response.json()
+
+   if search_cache is None:
+      return await fetch()
+   return await search_cache.afetch(search_cache.key(endpoint, params), fetch, refetch=lambda: bing_fetch(endpoint, headers, params))
+
+
+@traced()
 def bing_web_search(query: str, num_results: int, exact: bool = True) -> dict:
    """Perform a web search using Bing Web Search API
     
@@ -65,26 +262,18 @@ def bing_web_search(query: str, num_results: int, exact: bool = True) -> dict:
    Returns:
       dict: The search results returned by Bing Web Search API.
    """
-   subscription_key = os.environ['BING_SEARCH_V7_SUBSCRIPTION_KEY']
-   endpoint = os.environ['BING_SEARCH_V7_ENDPOINT'] + "/v7.0/search"
-
-   # Exact expression search
-   query = f'"{query}"' if exact else query
-
    # Construct a request
-   params = { 'q': query, 'mkt': 'en-US', 'count': num_results }
-   headers = { 'Ocp-Apim-Subscription-Key': subscription_key }
+   endpoint, headers, params = bing_request("/v7.0/search", query, exact=exact, count=num_results)
 
    # Call the API
    try:
-      response = requests.get(endpoint, headers=headers, params=params) # default 10 results
-      response.raise_for_status()
-      search_results = response.json()
+      search_results = bing_get(endpoint, headers, params) # default 10 results
       return search_results
    except Exception as ex:
       raise ex
 
 
+@traced()
 def bing_entity_search(query: str, exact: bool = True) -> dict:
    """Use Bing Entity Search API to get more relevant query information
     
@@ -95,27 +284,54 @@ def bing_entity_search(query: str, exact: bool = True) -> dict:
    Returns:
       dict: The search results returned by Bing Entity Search API.
    """
-   subscription_key = os.environ['BING_SEARCH_V7_SUBSCRIPTION_KEY']
-   endpoint = os.environ['BING_SEARCH_V7_ENDPOINT'] + "/v7.0/entities"
-
-   # Exact expression search
-   query = f'"{query}"' if exact else query
-
    # Construct a request
-   params = { 'q': query, 'mkt': 'en-US' }
-   headers = { 'Ocp-Apim-Subscription-Key': subscription_key }
+   endpoint, headers, params = bing_request("/v7.0/entities", query, exact=exact)
 
    # Call the API
    try:
-      response = requests.get(endpoint, headers=headers, params=params)
-      response.raise_for_status()
-      search_results = response.json()
+      search_results = bing_get(endpoint, headers, params)
       return search_results
    except Exception as ex:
       # print(search_results)
       raise ex
 
 
+@traced("bing_web_search")
+async def bing_web_search_async(query: str, num_results: int, exact: bool = True, http_client: httpx.AsyncClient = None) -> dict:
+   """Perform a web search using Bing Web Search API without blocking the event loop
+    
+   Parameters:
+      query (str): The search query.
+      num_results (int): Number of search results to return.
+      exact (bool): Whether to perform an exact search. Defaults to True.
+      http_client (httpx.AsyncClient): Client used to send the request.
+   
+   Returns:
+      dict: The search results returned by Bing Web Search API.
+   """
+   endpoint, headers, params = bing_request("/v7.0/search", query, exact=exact, count=num_results)
+
+   return await bing_get_async(endpoint, headers, params, http_client)
+
+
+@traced("bing_entity_search")
+async def bing_entity_search_async(query: str, exact: bool = True, http_client: httpx.AsyncClient = None) -> dict:
+   """Use Bing Entity Search API to get more relevant query information without blocking the event loop
+    
+   Parameters:
+      query (str): The search query.
+      exact (bool): Whether to perform an exact search. Defaults to True.
+      http_client (httpx.AsyncClient): Client used to send the request.
+   
+   Returns:
+      dict: The search results returned by Bing Entity Search API.
+   """
+   endpoint, headers, params = bing_request("/v7.0/entities", query, exact=exact)
+
+   return await bing_get_async(endpoint, headers, params, http_client)
+
+
+@traced()
 def generate_additional_data(query: str, model: str = "gpt-3.5-turbo") -> str:
    """Generate additional data about the query using OpenAI GPT model.
 
@@ -133,10 +349,36 @@ def generate_additional_data(query: str, model: str = "gpt-3.5-turbo") -> str:
    # You must return an empty response if information isn't available.
    msg_list = f"""Identify important, specific entities related to {query}. These entities could include specific people, companies, locations, universities, professional affiliations, etc., but not attributes of {query}. Extract the relevant relationships between {query} and the entities you identified.\nYou must return an empty response if information isn't available."""
 
-   completion = client.chat.completions.create(
-      model=model,
-      messages=[{"role": "user", "content": msg_list}]
-   )
+   completion = create_completion({
+      "model": model,
+      "messages": [{"role": "user", "content": msg_list}]
+   })
 
    return completion.choices[0].message.content
 
+
+
+def get_generation_executor() -> ThreadPoolExecutor:
+   """The executor of generate_additional_data_async, GENERATION_WORKERS threads created on first use."""
+   global generation_executor
+   with generation_executor_lock:
+      if generation_executor is None:
+         generation_executor = ThreadPoolExecutor(max_workers=GENERATION_WORKERS, thread_name_prefix="generate-additional-data")
+      return generation_executor
+
+
+async def generate_additional_data_async(query: str, model: str = "gpt-3.5-turbo") -> str:
+   """Generate additional data about the query using OpenAI GPT model without blocking the event loop.
+   The shared (thread-safe, pooled) OpenAI client, see clients.get_openai_client, is called from a thread of the
+   generation executor (see get_generation_executor), in a copy of the context of the caller.
+
+   Parameters:
+      query (str): The search query.
+      model (str): Model to use, defaults to "gpt-3.5-turbo".
+
+   Returns:
+      str: The generated text.
+   """
+   loop = asyncio.get_running_loop()
+   context = contextvars.copy_context()
+   return await loop.run_in_executor(get_generation_executor(), functools.partial(context.run, generate_additional_data, query=query, model=model))
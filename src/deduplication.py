@@ -0,0 +1,218 @@
+# Near-duplicate elimination of the retrieved passages (shingling, MinHash and LSH) before they are sent in prompts
+
+from numTokens import num_tokens_batch, estimate_tokens
+import numpy as np
+import zlib
+import re
+
+WORD = re.compile(r"\w+")
+# End of a sentence followed by the start of another one, so that abbreviations such as "Inc. is" aren't boundaries
+# (the whitespace is captured, so that the sentences of a passage can be joined again with their original separators)
+SENTENCE_BOUNDARY = re.compile(r"(?<=[.!?])(\s+)(?=[\"'“(]?[A-Z0-9])")
+
+# Odd 64-bit multiplier combining the hashes of the words of a shingle
+SHINGLE_MULTIPLIER = np.uint64(0x9E3779B97F4A7C15)
+
+
+def word_hashes(text: str) -> np.ndarray:
+   """Deterministic 32-bit hashes of the lowercased words of a text."""
+   return np.array([zlib.crc32(word.encode("utf-8")) for word in WORD.findall(text.casefold())], dtype=np.uint64)
+
+
+def shingle_hashes(text: str, size: int = 5) -> np.ndarray:
+   """64-bit hashes of the word shingles (sequences of `size` consecutive words) of a text, a text shorter than a
+   shingle is a single shingle."""
+   words = word_hashes(text)
+   if len(words) == 0:
+      return words
+   size = min(size, len(words))
+   count = len(words) - size + 1
+   hashes = np.zeros(count, dtype=np.uint64)
+   for offset in range(size):
+      hashes = hashes * SHINGLE_MULTIPLIER + words[offset:offset + count]
+   return np.unique(hashes)
+
+
+def lsh_parameters(num_perm: int, threshold: float) -> tuple:
+   """Number of bands and rows per band of the LSH index: the divisor of num_perm whose S-curve threshold
+   (1/bands)^(1/rows) is the closest to (but not above) the similarity threshold, so that few near-duplicates are missed.
+
+   Returns:
+      tuple: (bands, rows).
+   """
+   candidates = [(num_perm // rows, rows) for rows in range(1, num_perm + 1) if num_perm % rows == 0]
+   below = [(bands, rows) for bands, rows in candidates if (1 / bands) ** (1 / rows) <= threshold]
+   return max(below or candidates[:1], key=lambda parameters: (1 / parameters[0]) ** (1 / parameters[1]))
+
+
+class MinHashLSH:
+   """Index of the passages kept so far: MinHash signatures of their shingles and LSH buckets (bands of the
+   signatures), so that each new passage is only compared to the passages it shares a bucket with. Adding n passages is
+   linear in their total length."""
+
+   def __init__(self, threshold: float = 0.8, num_perm: int = 128, shingle_size: int = 5, seed: int = 0):
+      """
+      Parameters:
+         threshold (float): Minimum estimated Jaccard similarity of the shingles of two passages to be near-duplicates.
+         num_perm (int): Number of hash functions of the signatures.
+         shingle_size (int): Number of words of a shingle.
+         seed (int): Seed of the hash functions.
+      """
+      self.threshold = threshold
+      self.shingle_size = shingle_size
+      rng = np.random.default_rng(seed)
+      # Multiply-add-shift hash functions, the multipliers are odd
+      self.multipliers = rng.integers(0, 2**63, num_perm, dtype=np.uint64) * np.uint64(2) + np.uint64(1)
+      self.increments = rng.integers(0, 2**63, num_perm, dtype=np.uint64)
+      self.bands, self.rows = lsh_parameters(num_perm, threshold)
+      self.buckets = {}
+      self.signatures = {}
+
+   def signature(self, text: str) -> np.ndarray:
+      """MinHash signature of the shingles of a text, shape (num_perm,), None if the text has no words."""
+      shingles = shingle_hashes(text, self.shingle_size)
+      if len(shingles) == 0:
+         return None
+      hashes = (shingles[:, None] * self.multipliers[None, :] + self.increments[None, :]) >> np.uint64(32)
+      return hashes.min(axis=0).astype(np.uint32)
+
+   def __band_keys(self, signature: np.ndarray):
+      for band in range(self.bands):
+         yield band, signature[band * self.rows:(band + 1) * self.rows].tobytes()
+
+   def query(self, signature: np.ndarray):
+      """The key of the most similar indexed passage with a similarity >= threshold, or None.
+
+      Returns:
+         tuple: (key, estimated similarity), or (None, 0.0).
+      """
+      candidates = set()
+      for band_key in self.__band_keys(signature):
+         candidates.update(self.buckets.get(band_key, ()))
+
+      best, best_similarity = None, 0.0
+      for key in candidates:
+         similarity = float(np.mean(self.signatures[key] == signature))
+         if similarity >= self.threshold and similarity > best_similarity:
+            best, best_similarity = key, similarity
+      return best, best_similarity
+
+   def insert(self, key, signature: np.ndarray):
+      self.signatures[key] = signature
+      for band_key in self.__band_keys(signature):
+         self.buckets.setdefault(band_key, []).append(key)
+
+
+def normalize_sentence(sentence: str) -> str:
+   return " ".join(WORD.findall(sentence.casefold()))
+
+
+def deduplicate_passages(passages: list, threshold: float = 0.8, keep: str = "first", sentences: bool = True, min_sentence_words: int = 6, num_perm: int = 128, shingle_size: int = 5, model: str = "gpt-4") -> tuple:
+   """Remove the near-duplicate passages, and the sentences repeated across passages.
+
+   1. Sentences of at least min_sentence_words words already seen in an earlier passage (same words, ignoring case and
+      punctuation) are removed, e.g. the same sentence quoted by several sites.
+   2. Passages whose shingles have an estimated Jaccard similarity >= threshold with a passage kept earlier are removed
+      (MinHash and LSH, see MinHashLSH).
+
+   Parameters:
+      passages (list): The passages, in order of preference (e.g. the generated text, entity descriptions, snippets).
+      threshold (float): Minimum similarity of two near-duplicate passages.
+      keep (str): "first" keeps the first passage of near-duplicates, "longest" the longest one (at the position of
+         the first, so the order is unchanged).
+      sentences (bool): Also remove the repeated sentences.
+      min_sentence_words (int): Shorter sentences are never removed as repeated.
+      num_perm (int): Number of hash functions of the MinHash signatures.
+      shingle_size (int): Number of words of a shingle.
+      model (str): The model used to count the tokens saved.
+
+   Returns:
+      tuple: The kept passages (list) and the stats (dict): passages, duplicates (passages removed), repeated_sentences
+         and tokens_saved (tokens of the removed text).
+   """
+   if keep not in ("first", "longest"):
+      raise ValueError(f"Unknown keep: {keep}")
+
+   index = MinHashLSH(threshold=threshold, num_perm=num_perm, shingle_size=shingle_size)
+   seen_sentences = set()
+   kept = []
+   removed = []
+   repeated_sentences = 0
+
+   for passage in passages:
+      if sentences:
+         # Sentences and the whitespace separating them alternate
+         split = SENTENCE_BOUNDARY.split(passage)
+         parts = []
+         repeated = 0
+         # Sentences repeated within the passage are kept, only those of the earlier passages are removed
+         keys = set()
+         for i in range(0, len(split), 2):
+            sentence = split[i]
+            key = normalize_sentence(sentence)
+            if key.count(" ") + 1 >= min_sentence_words and key in seen_sentences:
+               removed.append(sentence)
+               repeated += 1
+            else:
+               keys.add(key)
+               # A kept sentence is preceded by its own separator (e.g. a newline), not the one of a removed sentence
+               if parts:
+                  parts.append(split[i - 1])
+               parts.append(sentence)
+         seen_sentences |= keys
+         if repeated:
+            repeated_sentences += repeated
+            if not parts:
+               continue
+            passage = "".join(parts)
+
+      signature = index.signature(passage)
+      if signature is None:
+         kept.append(passage)
+         continue
+
+      duplicate, _ = index.query(signature)
+      if duplicate is None:
+         index.insert(len(kept), signature)
+         kept.append(passage)
+      elif keep == "longest" and len(passage) > len(kept[duplicate]):
+         removed.append(kept[duplicate])
+         kept[duplicate] = passage
+         index.insert(duplicate, signature)
+      else:
+         removed.append(passage)
+
+   stats = {
+      "passages": len(passages),
+      "duplicates": len(passages) - len(kept),
+      "repeated_sentences": repeated_sentences,
+      "tokens_saved": count_tokens(removed, model=model)
+   }
+   return kept, stats
+
+
+def count_tokens(texts: list, model: str = "gpt-4") -> int:
+   """Total number of tokens of texts, for the stats: estimated if the encoding can't be loaded (tiktoken downloads it on
+   first use), so that deduplicating never fails offline."""
+   if not texts:
+      return 0
+   try:
+      return sum(num_tokens_batch(texts, model=model))
+   except Exception:
+      return sum(estimate_tokens(text) for text in texts)
+
+
+def deduplicate_text(data: str, separator: str = "\n\n", **kwargs) -> tuple:
+   """Remove the near-duplicate passages of a text, e.g. returned by dataRetrieval.retrieve_data (with the default dedup=False).
+
+   Parameters:
+      data (str): The text.
+      separator (str): The separator between the passages.
+      kwargs: Options of deduplicate_passages.
+
+   Returns:
+      tuple: The deduplicated text (str) and the stats (dict), see deduplicate_passages.
+   """
+   passages = [passage.strip() for passage in data.split(separator) if passage.strip()]
+   kept, stats = deduplicate_passages(passages, **kwargs)
+   return separator.join(kept), stats
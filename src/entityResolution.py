@@ -0,0 +1,152 @@
+# Entity resolution: merge the different spellings of an entity into a single canonical entity
+
+from collections import defaultdict
+import unicodedata
+import math
+import re
+
+# Legal forms and articles ignored when comparing entity names, e.g. "Tesla, Inc." and "Tesla"
+IGNORED_TOKENS = {"the", "inc", "incorporated", "corp", "corporation", "co", "company", "ltd", "limited", "llc", "plc", "gmbh", "ag", "sa"}
+NON_ALPHANUMERIC = re.compile(r"[^0-9a-z]+")
+# Period after a single letter, removed so that initialisms match their spelling without periods ("S.A.", "J.P. Morgan")
+INITIALISM_PERIOD = re.compile(r"\b([a-z])\.")
+
+
+def normalize_entity(name: str) -> str:
+   """Normalize an entity name: accents, case, punctuation, possessives, legal forms and articles are removed.
+
+   Parameters:
+      name (str): The entity name, e.g. "Tesla, Inc.".
+
+   Returns:
+      str: The normalized name, e.g. "tesla".
+   """
+   name = unicodedata.normalize("NFKD", name)
+   name = "".join(char for char in name if not unicodedata.combining(char)).casefold()
+   name = INITIALISM_PERIOD.sub(r"\1", name)
+   name = name.replace("&", " and ").replace("'s ", " ").replace("’s ", " ")
+   if name.endswith("'s") or name.endswith("’s"):
+      name = name[:-2]
+
+   tokens = NON_ALPHANUMERIC.sub(" ", name).split()
+   kept = [token for token in tokens if token not in IGNORED_TOKENS]
+   # Keep the name as is if it only consists of ignored tokens
+   return " ".join(kept or tokens)
+
+
+def character_ngrams(key: str, n: int = 3) -> set:
+   """Character n-grams of a normalized name (spaces removed, padded at both ends)."""
+   padded = "#" + key.replace(" ", "") + "#"
+   if len(padded) <= n:
+      return {padded}
+   return {padded[i:i + n] for i in range(len(padded) - n + 1)}
+
+
+class EntityResolver:
+   """Resolve entity names to canonical entities at insert time:
+   1. Alias table: surface forms already seen or registered with add_alias.
+   2. Exact match of the normalized name.
+   3. Fuzzy match: the candidates sharing character n-grams with the name (blocking, via an inverted index from n-gram to
+      normalized names) are scored with the n-gram Jaccard similarity, the best one above the threshold is used.
+      A name with a Jaccard similarity >= threshold shares at least ceil(threshold * |ngrams|) n-grams, so only the
+      |ngrams| - ceil(threshold * |ngrams|) + 1 rarest n-grams of the name need to be looked up (prefix filtering).
+   Otherwise the name becomes a new canonical entity. The surface forms of each canonical entity are kept."""
+
+   def __init__(self, threshold: float = 0.85, ngram_size: int = 3, max_block_size: int = 1000):
+      """
+      Parameters:
+         threshold (float): Minimum Jaccard similarity of the n-grams of two names to merge them.
+         ngram_size (int): Size of the character n-grams.
+         max_block_size (int): N-grams shared by more names than this are too common to be informative and aren't used
+            to find candidates, which keeps the lookups fast as the number of entities grows.
+      """
+      self.threshold = threshold
+      self.ngram_size = ngram_size
+      self.max_block_size = max_block_size
+      self.aliases = {}
+      self.canonical = {}
+      self.surface_forms = defaultdict(set)
+      self.blocks = defaultdict(list)
+      self.ngrams = {}
+
+   def __fuzzy_match(self, key: str):
+      ngrams = character_ngrams(key, self.ngram_size)
+      probes = len(ngrams) - math.ceil(self.threshold * len(ngrams)) + 1
+      rarest = sorted(ngrams, key=lambda ngram: len(self.blocks.get(ngram, ())))[:probes]
+
+      candidates = set()
+      for ngram in rarest:
+         block = self.blocks.get(ngram)
+         if block and len(block) <= self.max_block_size:
+            candidates.update(block)
+
+      # Names whose sizes differ too much can't reach the threshold
+      min_size, max_size = self.threshold * len(ngrams), len(ngrams) / self.threshold
+      best, best_score = None, self.threshold
+      for candidate in candidates:
+         other = self.ngrams[candidate]
+         if not min_size <= len(other) <= max_size:
+            continue
+         shared = len(ngrams & other)
+         score = shared / (len(ngrams) + len(other) - shared)
+         if score >= best_score:
+            best, best_score = candidate, score
+      return best
+
+   def __register(self, key: str, name: str):
+      self.canonical[key] = name
+      if key in self.ngrams:
+         return
+      ngrams = character_ngrams(key, self.ngram_size)
+      self.ngrams[key] = ngrams
+      for ngram in ngrams:
+         self.blocks[ngram].append(key)
+
+   def lookup(self, name: str):
+      """Return the canonical entity of a name without registering it, None if it doesn't match any entity."""
+      if name in self.aliases:
+         return self.aliases[name]
+      key = normalize_entity(name)
+      if key in self.canonical:
+         return self.canonical[key]
+      match = self.__fuzzy_match(key)
+      return self.canonical[match] if match is not None else None
+
+   def resolve(self, name: str) -> str:
+      """Return the canonical entity of a name, registering the name as a new entity if it doesn't match any.
+
+      Parameters:
+         name (str): The entity name as found in the text.
+
+      Returns:
+         str: The canonical entity (the first surface form seen).
+      """
+      canonical = self.aliases.get(name)
+      if canonical is not None:
+         return canonical
+
+      key = normalize_entity(name)
+      canonical = self.canonical.get(key)
+      if canonical is None:
+         match = self.__fuzzy_match(key)
+         if match is not None:
+            canonical = self.canonical[match]
+         else:
+            canonical = name
+            self.__register(key, name)
+
+      self.aliases[name] = canonical
+      self.surface_forms[canonical].add(name)
+      return canonical
+
+   def add_alias(self, alias: str, entity: str):
+      """Register an alias of an entity, e.g. add_alias("Tesla Motors", "Tesla").
+
+      Parameters:
+         alias (str): The alternative name.
+         entity (str): The entity, resolved to its canonical entity.
+      """
+      canonical = self.resolve(entity)
+      self.aliases[alias] = canonical
+      self.surface_forms[canonical].add(alias)
+      self.__register(normalize_entity(alias), canonical)
@@ -0,0 +1,308 @@
+# Local stand-in for the OpenAI Chat Completions and Bing Search APIs, used to benchmark the pipeline offline
+
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from numTokens import num_tokens_str, num_tokens_chat
+import contextlib
+import threading
+import random
+import json
+import time
+import zlib
+import os
+import re
+
+FIRST_WORDS = ["Apex", "Blue", "Cedar", "Delta", "Ember", "Falcon", "Granite", "Harbor", "Iron", "Juniper", "Keystone", "Lumen",
+   "Maple", "Nova", "Orbit", "Pioneer", "Quantum", "Redwood", "Summit", "Titan", "Unity", "Vertex", "Willow", "Zenith"]
+SECOND_WORDS = ["Capital", "Labs", "University", "Partners", "Robotics", "Ventures", "Institute", "Systems", "Holdings", "Foundation",
+   "Energy", "Media", "Health", "Analytics", "Dynamics", "Group"]
+RELATIONSHIPS = ["founded", "invested in", "works at", "located in", "partnered with", "acquired", "studied at", "advises", "leads", "owns"]
+
+# Patterns used to recognize the prompts of nlpUtils and dataRetrieval, and the query they are about
+QUERY_PATTERNS = [
+   re.compile(r"entities related to (.+?) that are mentioned"),
+   re.compile(r"relationships between (.+?) and the entities"),
+   re.compile(r"entities related to (.+?)\. These entities")
+]
+RELATIONSHIP_LINE = re.compile(r"^\s*(?:\d+[.)]\s*)?(.+?)\s+-\s+(.+?)\s+-\s+(.+?)\s*\.?$")
+
+
+def synthetic_entities(query: str, count: int = 12) -> list:
+   """Deterministic (entity, relationship) pairs related to a query."""
+   rng = random.Random(zlib.crc32(query.encode("utf-8")))
+   entities = {}
+   while len(entities) < count:
+      entities[f"{rng.choice(FIRST_WORDS)} {rng.choice(SECOND_WORDS)}"] = rng.choice(RELATIONSHIPS)
+   return list(entities.items())
+
+
+class FakeAPIServer:
+   """HTTP server answering the OpenAI Chat Completions (including streaming and JSON mode) and Bing Web/Entity Search
+   requests of the pipeline, with synthetic responses consistent across the stages (the same entities for a query in
+   the search results and the completions) or responses recorded in fixtures.
+
+   The latency of a completion is the base latency plus its number of tokens divided by the token rate, so that longer
+   outputs take longer like with the real API. Rate limit (429) errors can be injected. Requests are counted by endpoint."""
+
+   def __init__(self, latency: float = 0.2, search_latency: float = 0.1, tokens_per_second: float = 100.0, jitter: float = 0.0, error_rate: float = 0.0, entities_per_query: int = 12, fixtures: dict = None, seed: int = 0, port: int = 0):
+      """
+      Parameters:
+         latency (float): Time to first token of a completion, in seconds.
+         search_latency (float): Latency of a Bing request, in seconds.
+         tokens_per_second (float): Generation rate of the completions (None for no generation time).
+         jitter (float): Relative random variation of the latencies, e.g. 0.2 for +-20%.
+         error_rate (float): Probability of answering a completion request with a 429 error.
+         entities_per_query (int): Number of synthetic entities related to each query.
+         fixtures (dict or None): Recorded responses, used before the synthetic ones (see load_fixtures).
+         seed (int): Seed of the jitter and the injected errors.
+         port (int): Port to listen on, 0 for any free port.
+      """
+      self.latency = latency
+      self.search_latency = search_latency
+      self.tokens_per_second = tokens_per_second
+      self.jitter = jitter
+      self.error_rate = error_rate
+      self.entities_per_query = entities_per_query
+      self.fixtures = fixtures or {}
+      self.port = port
+      self.counts = {"chat": 0, "search": 0, "entities": 0, "errors": 0}
+      self.__rng = random.Random(seed)
+      self.__lock = threading.Lock()
+      self.__server = None
+
+   @property
+   def url(self) -> str:
+      return f"http://127.0.0.1:{self.port}"
+
+   def environment(self) -> dict:
+      """Environment variables pointing the OpenAI and Bing clients to the server."""
+      return {
+         "OPENAI_BASE_URL": self.url + "/v1",
+         "OPENAI_API_KEY": "fake-key",
+         "BING_SEARCH_V7_ENDPOINT": self.url,
+         "BING_SEARCH_V7_SUBSCRIPTION_KEY": "fake-key"
+      }
+
+   @contextlib.contextmanager
+   def patched_environment(self):
+      """Set the environment variables of environment() inside the with block."""
+      previous = {key: os.environ.get(key) for key in self.environment()}
+      os.environ.update(self.environment())
+      try:
+         yield self
+      finally:
+         for key, value in previous.items():
+            if value is None:
+               os.environ.pop(key, None)
+            else:
+               os.environ[key] = value
+
+   def start(self) -> "FakeAPIServer":
+      server = self
+
+      class Handler(BaseHTTPRequestHandler):
+         protocol_version = "HTTP/1.1"
+
+         def log_message(self, *args):
+            pass
+
+         def do_GET(self):
+            server.handle_search(self)
+
+         def do_POST(self):
+            server.handle_chat(self)
+
+      self.__server = ThreadingHTTPServer(("127.0.0.1", self.port), Handler)
+      self.__server.daemon_threads = True
+      self.port = self.__server.server_address[1]
+      threading.Thread(target=self.__server.serve_forever, daemon=True).start()
+      return self
+
+   def stop(self):
+      if self.__server is not None:
+         self.__server.shutdown()
+         self.__server.server_close()
+         self.__server = None
+
+   def __enter__(self):
+      return self.start()
+
+   def __exit__(self, *exc_info):
+      self.stop()
+
+   def __count(self, endpoint: str):
+      with self.__lock:
+         self.counts[endpoint] += 1
+
+   def __sleep(self, seconds: float):
+      if self.jitter:
+         with self.__lock:
+            seconds *= 1 + self.__rng.uniform(-self.jitter, self.jitter)
+      if seconds > 0:
+         time.sleep(seconds)
+
+   @staticmethod
+   def __send_json(handler, body: dict, status: int = 200, headers: dict = None):
+      data = json.dumps(body).encode("utf-8")
+      handler.send_response(status)
+      handler.send_header("Content-Type", "application/json")
+      handler.send_header("Content-Length", str(len(data)))
+      for key, value in (headers or {}).items():
+         handler.send_header(key, value)
+      handler.end_headers()
+      handler.wfile.write(data)
+
+   # Bing Search
+
+   def handle_search(self, handler):
+      url = urlparse(handler.path)
+      params = parse_qs(url.query)
+      query = params.get("q", [""])[0].strip('"')
+      self.__sleep(self.search_latency)
+
+      if url.path.endswith("/search"):
+         self.__count("search")
+         body = self.fixtures.get("search", {}).get(query) or self.web_search_response(query, int(params.get("count", ["10"])[0]))
+      elif url.path.endswith("/entities"):
+         self.__count("entities")
+         body = self.fixtures.get("entities", {}).get(query) or self.entity_search_response(query)
+      else:
+         self.__send_json(handler, {"error": {"message": "Not found"}}, status=404)
+         return
+      self.__send_json(handler, body)
+
+   def web_search_response(self, query: str, count: int) -> dict:
+      entities = synthetic_entities(query, self.entities_per_query)
+      snippets = []
+      for i in range(count):
+         entity, relationship = entities[i % len(entities)]
+         other, other_relationship = entities[(i + 1) % len(entities)]
+         snippets.append({"snippet": f"{query} {relationship} {entity} according to recent reports. The company also {other_relationship} {other}, which {query} mentioned in an interview."})
+      return {"webPages": {"value": snippets}}
+
+   def entity_search_response(self, query: str) -> dict:
+      entities = synthetic_entities(query, self.entities_per_query)
+      description = " ".join(f"{query} {relationship} {entity}." for entity, relationship in entities[:3])
+      return {"entities": {"value": [{"description": description}]}}
+
+   # OpenAI Chat Completions
+
+   def handle_chat(self, handler):
+      length = int(handler.headers.get("Content-Length", 0))
+      request = json.loads(handler.rfile.read(length))
+      self.__count("chat")
+
+      with self.__lock:
+         rate_limited = self.error_rate and self.__rng.random() < self.error_rate
+      if rate_limited:
+         self.__count("errors")
+         self.__send_json(handler, {"error": {"message": "Rate limit reached", "type": "requests", "code": "rate_limit_exceeded"}}, status=429, headers={"retry-after-ms": "10"})
+         return
+
+      content = self.completion_content(request)
+      max_tokens = request.get("max_tokens")
+      # Estimated counts, the server runs offline (tiktoken downloads its BPE files on first use)
+      completion_tokens = num_tokens_str(content, estimate=True)
+      finish_reason = "stop"
+      if max_tokens is not None and completion_tokens > max_tokens:
+         # Truncate the output like the API does, by characters proportionally to the tokens
+         content = content[:len(content) * max_tokens // completion_tokens]
+         completion_tokens = max_tokens
+         finish_reason = "length"
+      messages = [{key: value for key, value in message.items() if isinstance(value, str)} for message in request["messages"]]
+      usage = {"prompt_tokens": num_tokens_chat(messages, estimate=True), "completion_tokens": completion_tokens, "total_tokens": 0}
+      usage["total_tokens"] = usage["prompt_tokens"] + completion_tokens
+      generation_time = completion_tokens / self.tokens_per_second if self.tokens_per_second else 0.0
+
+      self.__sleep(self.latency)
+      if request.get("stream"):
+         include_usage = (request.get("stream_options") or {}).get("include_usage")
+         self.__stream(handler, request["model"], content, finish_reason, generation_time, usage if include_usage else None)
+         return
+
+      self.__sleep(generation_time)
+      self.__send_json(handler, {
+         "id": "chatcmpl-fake",
+         "object": "chat.completion",
+         "created": int(time.time()),
+         "model": request["model"],
+         "choices": [{"index": 0, "finish_reason": finish_reason, "message": {"role": "assistant", "content": content}}],
+         "usage": usage
+      })
+
+   def __stream(self, handler, model: str, content: str, finish_reason: str, generation_time: float, usage: dict = None):
+      handler.send_response(200)
+      handler.send_header("Content-Type", "text/event-stream")
+      handler.send_header("Transfer-Encoding", "chunked")
+      handler.end_headers()
+
+      def send(data: str):
+         event = f"data: {data}\n\n".encode("utf-8")
+         handler.wfile.write(b"%x\r\n%s\r\n" % (len(event), event))
+         handler.wfile.flush()
+
+      # Deltas of about 4 characters (one token), paced at the token rate
+      deltas = [content[i:i + 4] for i in range(0, len(content), 4)] or [""]
+      delay = generation_time / len(deltas)
+      try:
+         for i, delta in enumerate(deltas):
+            chunk = {"id": "chatcmpl-fake", "object": "chat.completion.chunk", "created": int(time.time()), "model": model,
+               "choices": [{"index": 0, "delta": {"content": delta}, "finish_reason": finish_reason if i == len(deltas) - 1 else None}]}
+            send(json.dumps(chunk))
+            self.__sleep(delay)
+         # With stream_options include_usage, the usage comes in a last chunk without choices
+         if usage is not None:
+            send(json.dumps({"id": "chatcmpl-fake", "object": "chat.completion.chunk", "created": int(time.time()), "model": model, "choices": [], "usage": usage}))
+         send("[DONE]")
+         handler.wfile.write(b"0\r\n\r\n")
+         handler.wfile.flush()
+      except (BrokenPipeError, ConnectionResetError):
+         # The client closed the stream early
+         pass
+
+   def completion_content(self, request: dict) -> str:
+      """The content of the completion of a request: the first matching fixture, otherwise a synthetic answer
+      recognized from the prompt (relationships, entities, JSON or Python list conversion, generated data)."""
+      messages = request["messages"]
+      system = next((message.get("content") or "" for message in messages if message.get("role") == "system"), "")
+      last = messages[-1].get("content") or ""
+
+      for fixture in self.fixtures.get("chat", []):
+         if re.search(fixture["pattern"], last):
+            return fixture["content"]
+
+      if request.get("response_format", {}).get("type") == "json_object":
+         return json.dumps({"relationships": [{"src": src, "relationship": rel, "tgt": tgt} for src, rel, tgt in self.__parse_lines(last)]})
+      if "list of tuples" in system:
+         return repr(self.__parse_lines(last))
+
+      query = self.__prompt_query(messages)
+      entities = synthetic_entities(query, self.entities_per_query)
+      if last.startswith("Identify all unique specific entities"):
+         return "\n".join(f"{i + 1}. {entity}" for i, (entity, _) in enumerate(entities))
+      if "relationships between" in last:
+         return "\n".join(f"{i + 1}. {query} - {relationship} - {entity}" for i, (entity, relationship) in enumerate(entities))
+      return " ".join(f"{query} {relationship} {entity}." for entity, relationship in entities)
+
+   @staticmethod
+   def __prompt_query(messages: list) -> str:
+      for message in reversed(messages):
+         for pattern in QUERY_PATTERNS:
+            match = pattern.search(message.get("content") or "")
+            if match:
+               return match.group(1)
+      return "Unknown"
+
+   @staticmethod
+   def __parse_lines(text: str) -> list:
+      return [match.groups() for match in map(RELATIONSHIP_LINE.match, text.splitlines()) if match]
+
+
+def load_fixtures(path: str) -> dict:
+   """Load recorded responses for FakeAPIServer from a JSON file with the optional keys:
+   - "chat": list of {"pattern": regex searched in the last message, "content": completion content}
+   - "search": Bing Web Search responses by query
+   - "entities": Bing Entity Search responses by query
+   """
+   with open(path, encoding="utf-8") as file:
+      return json.load(file)
@@ -0,0 +1,381 @@
+# Multi-hop expansion of a knowledge graph: the entities found by previous extractions are processed in turn
+
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from collections import defaultdict
+from knowledgeGraph import KnowledgeGraph
+from batchRunner import run_pipeline
+from dataRetrieval import enable_search_cache
+from nlpUtils import track_token_usage
+from graphStore import GraphStore
+import itertools
+import argparse
+import heapq
+import json
+import time
+import sys
+import os
+
+
+class GraphExpander:
+   """Expand a knowledge graph beyond the one-hop star around its query. The entities of the graph are scheduled on a
+   priority frontier, the best ones are processed concurrently with batchRunner.run_pipeline (retrieval and extraction)
+   and their relationships are merged into the same graph. The entities they bring in are added to the frontier one hop
+   deeper. Each entity is expanded at most once, its canonical entity is used if the graph has a resolver.
+
+   The expansion stops when the frontier is empty or a budget is reached: depth (hops from the query), number of
+   expanded entities, tokens or cost. The state is saved after every expanded entity so that an interrupted expansion
+   can be resumed, and progress is reported through a callback and stats()."""
+
+   def __init__(self, knowledge_graph: KnowledgeGraph, seeds=None, expanded=(), max_depth: int = 2, max_entities: int = 50, max_tokens: int = None, max_cost: float = None, prices: tuple = (0.0005, 0.0015), priority="degree", workers: int = 4, state_path: str = None, resume: bool = True, store: GraphStore = None, on_progress=None, **pipeline_kwargs):
+      """
+      Parameters:
+         knowledge_graph (KnowledgeGraph): The graph to expand, e.g. built for a query. Updated in place.
+         seeds (iterable of str or None): The entities to expand first (1 hop from the query), all the entities of the
+            graph by default.
+         expanded (iterable of str): Entities already expanded, e.g. the query the graph was built for.
+         max_depth (int): Maximum number of hops from the query of the expanded entities (the seeds are at depth 1).
+         max_entities (int): Maximum number of entities expanded, including the failed ones (the query isn't counted).
+         max_tokens (int or None): Token budget (prompt and completion tokens reported by the API).
+         max_cost (float or None): Cost budget, computed with `prices`.
+         prices (tuple): Prices of 1000 prompt and completion tokens (gpt-3.5-turbo by default).
+         priority (str or callable): Order of the frontier. "degree" expands the entities with the most relationships in
+            the graph first, "relevance" the ones related to the most expanded entities (weighted by 1 / (depth + 1) of
+            these entities, so the ones close to the query count more). A callable is called with the entity, its depth
+            and the knowledge graph and returns a score, higher scores first. Ties are expanded breadth-first.
+         workers (int): Number of entities expanded concurrently.
+         state_path (str or None): JSON file the state is saved to after every expanded entity.
+         resume (bool): If the state file exists, restore the expansion from it (the relationships it contains are added
+            to the graph, so pass the graph as it was before the expansion) instead of starting from the seeds.
+         store (GraphStore or None): If given, the relationships of every expanded entity are also upserted into it.
+         on_progress (callable or None): Called with a dict after every expanded entity, with 'entity', 'depth',
+            'relationships' (number added), 'tokens', 'error' (None on success) and 'stats' (see stats()) keys.
+         pipeline_kwargs: Arguments of run_pipeline, e.g. num_results, model, json_model, approach.
+      """
+      if priority not in ("degree", "relevance") and not callable(priority):
+         raise ValueError(f"Unknown priority: {priority}")
+
+      self.knowledge_graph = knowledge_graph
+      self.max_depth = max_depth
+      self.max_entities = max_entities
+      self.max_tokens = max_tokens
+      self.max_cost = max_cost
+      self.prices = prices
+      self.priority = priority
+      self.workers = workers
+      self.state_path = state_path
+      self.store = store
+      self.on_progress = on_progress
+      self.pipeline_kwargs = pipeline_kwargs
+
+      # Expanded entities and their depth, failed entities and their error
+      self.expanded = {}
+      self.failed = {}
+      # Frontier: heap of (-score, depth, sequence number, entity), entries whose score is outdated are skipped
+      self.frontier = []
+      self.queued = {}
+      self.scores = {}
+      self.running = {}
+      self.relevance = defaultdict(float)
+      self.results = []
+      self.usage = {"requests": 0, "prompt_tokens": 0, "completion_tokens": 0}
+      self.relationships_added = 0
+      self.stop_reason = None
+      self.elapsed_time = 0.0
+      self.__sequence = itertools.count()
+
+      if state_path is not None and resume and os.path.exists(state_path):
+         self.load_state()
+         return
+
+      for entity in expanded:
+         self.expanded[self.knowledge_graph.canonical_entity(entity)] = 0
+      if seeds is None:
+         seeds = list(self.knowledge_graph.store.nodes())
+      for entity in seeds:
+         self.enqueue(entity, depth=1)
+
+   @property
+   def total_tokens(self) -> int:
+      return self.usage["prompt_tokens"] + self.usage["completion_tokens"]
+
+   @property
+   def cost(self) -> float:
+      prompt_price, completion_price = self.prices
+      return (self.usage["prompt_tokens"] * prompt_price + self.usage["completion_tokens"] * completion_price) / 1000
+
+   def score(self, entity, depth: int) -> float:
+      if self.priority == "degree":
+         return self.knowledge_graph.index.degree(entity)
+      if self.priority == "relevance":
+         return self.relevance[entity]
+      return self.priority(entity, depth, self.knowledge_graph)
+
+   def enqueue(self, entity, depth: int) -> bool:
+      """Add an entity to the frontier, or update its priority if it is already queued.
+
+      Returns:
+         bool: False if the entity was already visited (expanded, failed or running) or is beyond the depth limit.
+      """
+      entity = self.knowledge_graph.canonical_entity(entity)
+      if entity in self.expanded or entity in self.failed or entity in self.running or depth > self.max_depth:
+         return False
+
+      depth = min(depth, self.queued.get(entity, depth))
+      score = self.score(entity, depth)
+      if self.queued.get(entity) == depth and self.scores.get(entity) == score:
+         return True
+      self.queued[entity] = depth
+      self.scores[entity] = score
+      heapq.heappush(self.frontier, (-score, depth, next(self.__sequence), entity))
+      return True
+
+   def __pop(self):
+      while self.frontier:
+         score, depth, _, entity = heapq.heappop(self.frontier)
+         # Skip the entries replaced by a higher priority or a lower depth
+         if self.queued.get(entity) == depth and self.scores.get(entity) == -score:
+            del self.queued[entity]
+            del self.scores[entity]
+            return entity, depth
+      return None, None
+
+   def __budget_reason(self):
+      """The budget preventing a new expansion from starting, None if there is none."""
+      expansions = sum(1 for depth in self.expanded.values() if depth > 0) + len(self.failed) + len(self.running)
+      if expansions >= self.max_entities:
+         return "max_entities"
+
+      # Reserve the average usage of an expansion for each running one, so that the budgets are overshot by at most
+      # the usage of the last expansion started
+      finished = len(self.results) + len(self.failed)
+      expected = (len(self.running) + 1) / finished if finished else 0
+      if self.max_tokens is not None and self.total_tokens * (1 + expected) >= self.max_tokens:
+         return "max_tokens"
+      if self.max_cost is not None and self.cost * (1 + expected) >= self.max_cost:
+         return "max_cost"
+      return None
+
+   def __expand(self, entity):
+      with track_token_usage() as usage:
+         result = run_pipeline(entity, **self.pipeline_kwargs)
+      return result, usage
+
+   def record(self, entity, depth: int, relationships: list, usage=None):
+      """Record an expanded entity: its relationships are added to the graph and the entities they bring in are added to
+      the frontier one hop deeper. Also used to start from the query, e.g. record(query, 0, relationships) on an empty graph.
+
+      Parameters:
+         entity (str): The expanded entity.
+         depth (int): Its number of hops from the query.
+         relationships (list of dicts): Its relationships, with 'src', 'relationship' and 'tgt' keys.
+         usage (nlpUtils.TokenUsage or None): The tokens used to expand it.
+      """
+      entity = self.knowledge_graph.canonical_entity(entity)
+      self.expanded[entity] = depth
+      self.results.append({"query": entity, "depth": depth, "relationships": relationships})
+      if usage is not None:
+         for key, value in usage.to_dict().items():
+            self.usage[key] += value
+      self.__merge(entity, depth, relationships)
+
+   def __merge(self, entity, depth: int, relationships: list, enqueue: bool = True):
+      related = set()
+      for rel in relationships:
+         self.knowledge_graph.add_entity(rel['src'])
+         self.knowledge_graph.add_entity(rel['tgt'])
+         self.knowledge_graph.add_relationship(rel['src'], rel['tgt'], rel['relationship'])
+         related.add(self.knowledge_graph.canonical_entity(rel['src']))
+         related.add(self.knowledge_graph.canonical_entity(rel['tgt']))
+      related.discard(self.knowledge_graph.canonical_entity(entity))
+      self.relationships_added += len(relationships)
+      if not enqueue:
+         return
+
+      for other in related:
+         self.relevance[other] += 1 / (depth + 1)
+         self.enqueue(other, depth + 1)
+      # The degree (or custom score) of the queued entities of these relationships changed
+      for other in related:
+         if other in self.queued:
+            self.enqueue(other, self.queued[other])
+
+   def run(self) -> dict:
+      """Expand the graph until the frontier is empty or a budget is reached.
+
+      Returns:
+         dict: The stats of the expansion (see stats()).
+      """
+      start_time = time.time() - self.elapsed_time
+      self.stop_reason = None
+
+      with ThreadPoolExecutor(max_workers=self.workers) as executor:
+         futures = {}
+         while True:
+            while len(futures) < self.workers:
+               reason = self.__budget_reason()
+               entity, depth = (None, None) if reason else self.__pop()
+               if entity is None:
+                  self.stop_reason = self.stop_reason or reason or ("frontier" if not futures else None)
+                  break
+               self.running[entity] = depth
+               futures[executor.submit(self.__expand, entity)] = entity
+
+            if not futures:
+               break
+
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+               entity = futures.pop(future)
+               depth = self.running.pop(entity)
+               error = None
+               added = 0
+               try:
+                  result, usage = future.result()
+               except Exception as ex:
+                  error = repr(ex)
+                  self.failed[entity] = error
+                  tokens = 0
+               else:
+                  tokens = usage.total_tokens
+                  self.record(entity, depth, result["relationships"], usage=usage)
+                  added = len(result["relationships"])
+                  if self.store is not None:
+                     self.store.upsert(result["relationships"], query=entity, replace=True)
+
+               self.elapsed_time = time.time() - start_time
+               self.save_state()
+               if self.on_progress is not None:
+                  self.on_progress({"entity": entity, "depth": depth, "relationships": added, "tokens": tokens, "error": error, "stats": self.stats()})
+
+      self.stop_reason = self.stop_reason or "frontier"
+      self.elapsed_time = time.time() - start_time
+      self.save_state()
+      return self.stats()
+
+   def stats(self) -> dict:
+      """Progress of the expansion: entities expanded, failed, running and queued, relationships added, API usage and cost,
+      elapsed time and the reason the expansion stopped (None while running)."""
+      depths = defaultdict(int)
+      for depth in self.expanded.values():
+         depths[depth] += 1
+      return {
+         "expanded": sum(count for depth, count in depths.items() if depth > 0),
+         "failed": len(self.failed),
+         "running": len(self.running),
+         "queued": len(self.queued),
+         "expanded_per_depth": dict(sorted(depths.items())),
+         "relationships_added": self.relationships_added,
+         **self.usage,
+         "total_tokens": self.total_tokens,
+         "cost": round(self.cost, 6),
+         "elapsed_time": round(self.elapsed_time, 1),
+         "stop_reason": self.stop_reason
+      }
+
+   def save_state(self):
+      """Write the state to the state file (if any). The running entities are saved as queued, so they are expanded
+      again when the expansion is resumed."""
+      if self.state_path is None:
+         return
+      frontier = dict(self.queued)
+      frontier.update(self.running)
+      state = {
+         "expanded": [entity for entity, depth in self.expanded.items() if depth == 0],
+         "failed": self.failed,
+         "frontier": [[entity, depth] for entity, depth in frontier.items()],
+         "relevance": self.relevance,
+         "results": self.results,
+         "usage": self.usage,
+         "elapsed_time": self.elapsed_time
+      }
+      # Write a temporary file first so that a crash never leaves a partial state
+      temporary_path = self.state_path + ".tmp"
+      with open(temporary_path, "w", encoding="utf-8") as file:
+         json.dump(state, file)
+      os.replace(temporary_path, self.state_path)
+
+   def load_state(self):
+      """Restore the state from the state file: the relationships of the expanded entities are added to the graph and
+      the frontier is rebuilt."""
+      with open(self.state_path, encoding="utf-8") as file:
+         state = json.load(file)
+
+      for entity in state["expanded"]:
+         self.expanded[entity] = 0
+      for result in state["results"]:
+         self.expanded[result["query"]] = result["depth"]
+         self.results.append(result)
+         self.__merge(result["query"], result["depth"], result["relationships"], enqueue=False)
+      self.failed = state["failed"]
+      self.relevance.update(state["relevance"])
+      self.usage = state["usage"]
+      self.elapsed_time = state["elapsed_time"]
+      for entity, depth in state["frontier"]:
+         self.enqueue(entity, depth)
+
+
+def main(argv: list = None):
+   parser = argparse.ArgumentParser(description="Build the knowledge graph of an entity and expand it to the entities it is related to.")
+   parser.add_argument("query", help="the entity the graph is built for")
+   parser.add_argument("-o", "--output", required=True, help="JSON file the expanded relationships are written to")
+   parser.add_argument("--state", default=None, help="JSON file the expansion state is saved to, and resumed from")
+   parser.add_argument("--store", default=None, help="SQLite graph store the relationships are also upserted into")
+   parser.add_argument("--search-cache", default=None, help="SQLite file caching the Bing responses between runs")
+   parser.add_argument("--depth", type=int, default=2, help="maximum number of hops from the query")
+   parser.add_argument("--max-entities", type=int, default=50, help="maximum number of entities expanded")
+   parser.add_argument("--max-tokens", type=int, default=None, help="maximum number of OpenAI tokens")
+   parser.add_argument("--max-cost", type=float, default=None, help="maximum cost of the OpenAI tokens")
+   parser.add_argument("--priority", choices=["degree", "relevance"], default="degree", help="order of the frontier")
+   parser.add_argument("-w", "--workers", type=int, default=4, help="number of entities expanded concurrently")
+   parser.add_argument("--num-results", type=int, default=7, help="number of web search results")
+   parser.add_argument("--model", default="gpt-3.5-turbo", help="model used for retrieval and extraction")
+   parser.add_argument("--json-model", default="gpt-3.5-turbo", help="model used for the JSON conversion")
+   parser.add_argument("--approach", choices=["direct", "entities"], default="direct", help="extraction approach")
+   parser.add_argument("--max-data-tokens", type=int, default=None, help="only send the most relevant passages of the retrieved data within this token budget")
+   args = parser.parse_args(argv)
+
+   if args.search_cache:
+      enable_search_cache(path=args.search_cache)
+
+   pipeline_kwargs = {"num_results": args.num_results, "model": args.model, "json_model": args.json_model, "approach": args.approach, "max_data_tokens": args.max_data_tokens}
+   store = GraphStore(args.store) if args.store else None
+
+   def report(progress):
+      status = "failed: " + progress["error"] if progress["error"] else f"{progress['relationships']} relationships"
+      print(f"[depth {progress['depth']}] {progress['entity']}: {status} ({progress['stats']['total_tokens']} tokens)", file=sys.stderr)
+
+   knowledge_graph = KnowledgeGraph()
+   expander = GraphExpander(
+      knowledge_graph,
+      seeds=[],
+      max_depth=args.depth,
+      max_entities=args.max_entities,
+      max_tokens=args.max_tokens,
+      max_cost=args.max_cost,
+      priority=args.priority,
+      workers=args.workers,
+      state_path=args.state,
+      store=store,
+      on_progress=report,
+      **pipeline_kwargs
+   )
+   # The relationships of the query are part of the state, so they aren't extracted again when resuming
+   if not expander.results:
+      with track_token_usage() as usage:
+         result = run_pipeline(args.query, **pipeline_kwargs)
+      expander.record(args.query, 0, result["relationships"], usage=usage)
+      if store is not None:
+         store.upsert(result["relationships"], query=args.query, replace=True)
+
+   stats = expander.run()
+
+   relationships = [{"src": source, "relationship": relationship, "tgt": target} for source, target, relationship in knowledge_graph.edges()]
+   with open(args.output, "w", encoding="utf-8") as file:
+      json.dump({"query": args.query, "relationships": relationships}, file, indent=3)
+   print(json.dumps(stats, indent=3))
+
+   return 0
+
+
+if __name__ == "__main__":
+   sys.exit(main())
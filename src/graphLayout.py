@@ -0,0 +1,240 @@
+# Force-directed layout of large graphs (NumPy), cached and refined incrementally, and selection of the nodes to display
+
+import numpy as np
+
+
+def weighted_repulsion(positions: np.ndarray, sources: np.ndarray, masses: np.ndarray, k: float) -> np.ndarray:
+   """Displacements of nodes repelled by sources of the given masses, k^2 * mass / distance along each node-source vector.
+   Computed with matrix products: sum_j w_ij (p_i - s_j) = p_i * sum_j w_ij - (W @ s)_i.
+
+   Parameters:
+      positions (np.ndarray): The positions of the nodes, shape (n, 2).
+      sources (np.ndarray): The positions of the sources, shape (m, 2).
+      masses (np.ndarray): The masses of the sources, shape (m,).
+      k (float): The optimal distance between nodes.
+
+   Returns:
+      np.ndarray: The displacements and the matrix of weights (to cancel some pairs), shapes (n, 2) and (n, m).
+   """
+   distance2 = (positions * positions).sum(axis=1)[:, None] + (sources * sources).sum(axis=1)[None, :] - 2 * positions @ sources.T
+   weights = (k * k) * masses / np.maximum(distance2, 1e-6)
+   return positions * weights.sum(axis=1)[:, None] - weights @ sources, weights
+
+
+def repulsion_exact(positions: np.ndarray, k: float, block_size: int = 1024) -> np.ndarray:
+   """Repulsive displacements (k^2 / distance between every pair of nodes), computed by blocks of rows to bound memory."""
+   displacement = np.zeros_like(positions)
+   masses = np.ones(len(positions))
+   for start in range(0, len(positions), block_size):
+      displacement[start:start + block_size], _ = weighted_repulsion(positions[start:start + block_size], positions, masses, k)
+   return displacement
+
+
+def repulsion_grid(positions: np.ndarray, k: float, nodes_per_cell: int = 64, block_size: int = 1024) -> np.ndarray:
+   """Approximate repulsive displacements (Barnes-Hut style): the nodes are binned on a grid, each node is repelled
+   exactly by the nodes of its own cell and by the other cells as a whole (their number of nodes at their center of mass).
+
+   Parameters:
+      positions (np.ndarray): The positions, shape (number of nodes, 2).
+      k (float): The optimal distance between nodes.
+      nodes_per_cell (int): Average number of nodes per cell, sets the size of the grid.
+      block_size (int): Number of nodes processed at once.
+
+   Returns:
+      np.ndarray: The displacements, shape (number of nodes, 2).
+   """
+   size = max(2, int(np.sqrt(len(positions) / nodes_per_cell)))
+   low = positions.min(axis=0)
+   span = np.maximum(positions.max(axis=0) - low, 1e-9)
+   cell_xy = np.minimum(((positions - low) / span * size).astype(np.int64), size - 1)
+   cells = cell_xy[:, 0] * size + cell_xy[:, 1]
+
+   # Number of nodes and center of mass of the non-empty cells
+   counts = np.bincount(cells, minlength=size * size)
+   occupied = np.flatnonzero(counts)
+   masses = counts[occupied].astype(positions.dtype)
+   centers = np.stack([np.bincount(cells, weights=positions[:, axis], minlength=size * size)[occupied] for axis in (0, 1)], axis=1) / masses[:, None]
+   # Column of each node's own cell among the occupied cells
+   own_cell = np.searchsorted(occupied, cells)
+
+   displacement = np.zeros_like(positions)
+   for start in range(0, len(positions), block_size):
+      block = positions[start:start + block_size]
+      block_displacement, weights = weighted_repulsion(block, centers, masses, k)
+      # Remove the contribution of the node's own cell
+      own = own_cell[start:start + block_size]
+      own_weights = weights[np.arange(len(block)), own]
+      displacement[start:start + block_size] = block_displacement - (block - centers[own]) * own_weights[:, None]
+
+   # Exact repulsion between the nodes of the same cell
+   order = np.argsort(cells, kind="stable")
+   bounds = np.cumsum(counts[occupied])
+   for end, count in zip(bounds, counts[occupied]):
+      if count > 1:
+         members = order[end - count:end]
+         displacement[members] += repulsion_exact(positions[members], k)
+
+   return displacement
+
+
+def force_layout(num_nodes: int, sources, targets, positions: np.ndarray = None, iterations: int = 50, temperature: float = 0.1, fixed: np.ndarray = None, exact_max_nodes: int = 500, seed: int = None) -> np.ndarray:
+   """Fruchterman-Reingold force-directed layout, vectorized with NumPy. The repulsion is exact for graphs of at most
+   exact_max_nodes nodes (quadratic) and approximated on a grid above (see repulsion_grid).
+
+   Parameters:
+      num_nodes (int): Number of nodes, identified by their index.
+      sources, targets (array-like of int): The edges (undirected for the layout).
+      positions (np.ndarray or None): Initial positions, shape (num_nodes, 2), random in the unit square if None.
+      iterations (int): Number of iterations.
+      temperature (float): Maximum displacement of a node at the first iteration, decreasing linearly to 0.
+      fixed (np.ndarray or None): Boolean mask of the nodes that don't move.
+      exact_max_nodes (int): Maximum number of nodes for the exact repulsion.
+      seed (int or None): Seed of the random initial positions.
+
+   Returns:
+      np.ndarray: The positions, shape (num_nodes, 2).
+   """
+   rng = np.random.default_rng(seed)
+   positions = rng.random((num_nodes, 2)) if positions is None else np.array(positions, dtype=float)
+   if num_nodes < 2:
+      return positions
+
+   sources = np.asarray(sources, dtype=np.int64)
+   targets = np.asarray(targets, dtype=np.int64)
+   k = 1 / np.sqrt(num_nodes)
+   cooling = temperature / (iterations + 1)
+
+   for _ in range(iterations):
+      if num_nodes <= exact_max_nodes:
+         displacement = repulsion_exact(positions, k)
+      else:
+         displacement = repulsion_grid(positions, k)
+
+      # Attraction along the edges (distance^2 / k)
+      delta = positions[sources] - positions[targets]
+      force = delta * (np.sqrt((delta * delta).sum(axis=1)) / k)[:, None]
+      for axis in (0, 1):
+         displacement[:, axis] += np.bincount(targets, weights=force[:, axis], minlength=num_nodes) - np.bincount(sources, weights=force[:, axis], minlength=num_nodes)
+
+      # Limit the displacements to the temperature
+      length = np.maximum(np.sqrt((displacement * displacement).sum(axis=1)), 1e-9)
+      step = displacement * (np.minimum(length, temperature) / length)[:, None]
+      if fixed is not None:
+         step[fixed] = 0
+      positions += step
+      temperature -= cooling
+
+   return positions
+
+
+class ForceLayout:
+   """Layout of the graphs displayed by KnowledgeGraphVisualizer, with the positions cached by node. A graph whose nodes
+   all have a position and that didn't change since it was laid out isn't laid out again. When nodes are added,
+   they start next to their neighbors and the layout is only refined, at a lower temperature."""
+
+   def __init__(self, iterations: int = 50, refine_iterations: int = 15, exact_max_nodes: int = 500, seed: int = None):
+      """
+      Parameters:
+         iterations (int): Number of iterations of a layout from scratch.
+         refine_iterations (int): Number of iterations when only some nodes are new.
+         exact_max_nodes (int): Maximum number of nodes for the exact repulsion, see force_layout.
+         seed (int or None): Seed of the random positions.
+      """
+      self.iterations = iterations
+      self.refine_iterations = refine_iterations
+      self.exact_max_nodes = exact_max_nodes
+      self.positions = {}
+      self.__rng = np.random.default_rng(seed)
+      self.__laid_out = None
+
+   def __call__(self, graph) -> dict:
+      """Return the positions of the nodes of a networkx graph.
+
+      Parameters:
+         graph (nx.Graph): The graph, e.g. the aggregated graph of KnowledgeGraphVisualizer.
+
+      Returns:
+         dict: The positions (np.ndarray of shape (2,)) by node.
+      """
+      nodes = list(graph.nodes())
+      signature = (tuple(nodes), graph.number_of_edges())
+      if signature == self.__laid_out:
+         return {node: self.positions[node] for node in nodes}
+
+      node_ids = {node: i for i, node in enumerate(nodes)}
+      edges = np.array([(node_ids[source], node_ids[target]) for source, target in graph.edges() if source != target], dtype=np.int64).reshape(-1, 2)
+      known = np.array([node in self.positions for node in nodes], dtype=bool)
+
+      if not known.any():
+         positions = force_layout(len(nodes), edges[:, 0], edges[:, 1], positions=self.__rng.random((len(nodes), 2)), iterations=self.iterations, exact_max_nodes=self.exact_max_nodes)
+      else:
+         positions = np.array([self.positions.get(node, (0.0, 0.0)) for node in nodes], dtype=float)
+         if not known.all():
+            self.__place_new_nodes(graph, nodes, node_ids, positions, known)
+         # Move the nodes by a fraction of the optimal distance only, so that the known nodes stay about where they were
+         temperature = 0.5 / np.sqrt(len(nodes))
+         positions = force_layout(len(nodes), edges[:, 0], edges[:, 1], positions=positions, iterations=self.refine_iterations, temperature=temperature, exact_max_nodes=self.exact_max_nodes)
+
+      for node, position in zip(nodes, positions):
+         self.positions[node] = position
+      self.__laid_out = signature
+      return {node: self.positions[node] for node in nodes}
+
+   def __place_new_nodes(self, graph, nodes, node_ids, positions, known):
+      # New nodes start at the center of their positioned neighbors (slightly jittered), or at random
+      low, high = positions[known].min(axis=0), positions[known].max(axis=0)
+      jitter = 0.1 / np.sqrt(len(nodes))
+      undirected = graph.to_undirected(as_view=True)
+      for i in np.flatnonzero(~known):
+         neighbors = [node_ids[neighbor] for neighbor in undirected.neighbors(nodes[i])]
+         neighbors = [j for j in neighbors if known[j]]
+         if neighbors:
+            positions[i] = positions[neighbors].mean(axis=0) + self.__rng.normal(scale=jitter, size=2)
+         else:
+            positions[i] = low + self.__rng.random(2) * (high - low)
+
+
+def select_nodes(graph, num_nodes: int, highlight_entities=(), by: str = "centrality") -> list:
+   """Select the most important nodes of a graph to display.
+
+   Parameters:
+      graph (nx.Graph): The graph.
+      num_nodes (int): Number of nodes selected.
+      highlight_entities (iterable): Nodes that are always selected (if in the graph).
+      by (str): "centrality" selects the nodes with the highest degree centrality, "distance" the nodes closest (in hops,
+         ignoring the direction of the edges) to the highlighted nodes, the ones with the highest degree first.
+
+   Returns:
+      list: The selected nodes.
+   """
+   if by not in ("centrality", "distance"):
+      raise ValueError(f"Unknown selection: {by}")
+
+   highlighted = [node for node in dict.fromkeys(highlight_entities) if node in graph]
+   degrees = dict(graph.degree())
+
+   if by == "distance" and highlighted:
+      # Multi-source breadth-first search from the highlighted nodes, level by level until enough nodes are reached
+      distances = {node: 0 for node in highlighted}
+      frontier = highlighted
+      undirected = graph.to_undirected(as_view=True)
+      while frontier and len(distances) < num_nodes:
+         next_frontier = []
+         for node in frontier:
+            for neighbor in undirected.neighbors(node):
+               if neighbor not in distances:
+                  distances[neighbor] = distances[node] + 1
+                  next_frontier.append(neighbor)
+         frontier = next_frontier
+      # Nodes at the same distance are ordered by degree, unreachable nodes last
+      unreachable = len(graph) + 1
+      ranked = sorted(graph.nodes(), key=lambda node: (distances.get(node, unreachable), -degrees[node]))
+   else:
+      ranked = sorted(graph.nodes(), key=lambda node: -degrees[node])
+
+   selected = dict.fromkeys(highlighted)
+   for node in ranked:
+      if len(selected) >= num_nodes:
+         break
+      selected[node] = None
+   return list(selected)
@@ -0,0 +1,341 @@
+# Indexes and queries over the relationships of a knowledge graph: relationship filters, k-hop neighborhoods, paths
+
+from array import array
+from collections import defaultdict
+import numpy as np
+
+
+def normalize_label(label: str) -> str:
+   """Normalize a relationship label for lookups (case-insensitive, extra whitespace ignored)."""
+   return " ".join(label.split()).casefold()
+
+
+class GraphIndex:
+   """Inverted index from relationship label to edges and per-entity in/out edge lists, maintained incrementally
+   as edges are added. Edges are identified by their insertion order."""
+
+   def __init__(self, edges=()):
+      """
+      Parameters:
+         edges (iterable of tuples): Initial (source, target, relationship) edges, or (source, target, relationship, key)
+            edges where key identifies the edge in the graph storage (e.g. the key of a nx.MultiDiGraph edge).
+      """
+      self.edges = []
+      self.keys = []
+      self.entities = set()
+      self.by_label = defaultdict(list)
+      self.out_edges = defaultdict(list)
+      self.in_edges = defaultdict(list)
+      for edge in edges:
+         self.add_edge(*edge)
+
+   def add_entity(self, entity):
+      self.entities.add(entity)
+
+   def add_edge(self, source, target, relationship, key=None) -> int:
+      edge_id = len(self.edges)
+      self.edges.append((source, target, relationship))
+      self.keys.append(key)
+      self.entities.add(source)
+      self.entities.add(target)
+      self.by_label[normalize_label(relationship)].append(edge_id)
+      self.out_edges[source].append(edge_id)
+      self.in_edges[target].append(edge_id)
+      return edge_id
+
+   def has_entity(self, entity) -> bool:
+      return entity in self.entities
+
+   def number_of_edges(self) -> int:
+      return len(self.edges)
+
+   def edge(self, edge_id: int) -> tuple:
+      """The (source, target, relationship) tuple of an edge."""
+      return self.edges[edge_id]
+
+   def degree(self, entity) -> int:
+      """Number of edges from and to an entity."""
+      return len(self.out_edges.get(entity, ())) + len(self.in_edges.get(entity, ()))
+
+   def labels(self) -> list:
+      """The distinct (normalized) relationship labels."""
+      return list(self.by_label)
+
+   def matching_labels(self, relationships) -> set:
+      """Resolve a relationship filter into the set of matching normalized labels.
+
+      Parameters:
+         relationships (iterable of str or callable): Labels to keep, or a predicate called on each distinct normalized
+            label, e.g. lambda label: "invest" in label.
+
+      Returns:
+         set: The matching labels.
+      """
+      labels = self.labels()
+      if callable(relationships):
+         return {label for label in labels if relationships(label)}
+      return {normalize_label(label) for label in relationships} & set(labels)
+
+   def edges_with_relationship(self, relationships) -> list:
+      """Return the IDs of the edges whose relationship matches the filter (see matching_labels), in insertion order."""
+      edge_ids = []
+      for label in self.matching_labels(relationships):
+         edge_ids += self.by_label[label]
+      return sorted(edge_ids)
+
+   def incident_edges(self, entity, direction: str = "both"):
+      """Yield (edge ID, neighbor) pairs of the edges of an entity.
+
+      Parameters:
+         entity: The entity.
+         direction (str): "out" (edges from the entity), "in" (edges to the entity) or "both".
+      """
+      if direction in ("out", "both"):
+         for edge_id in self.out_edges.get(entity, ()):
+            yield edge_id, self.edges[edge_id][1]
+      if direction in ("in", "both"):
+         for edge_id in self.in_edges.get(entity, ()):
+            yield edge_id, self.edges[edge_id][0]
+
+   def edge_filter(self, relationships):
+      """Predicate on the edge IDs keeping the edges matching a relationship filter (see matching_labels), None without a
+      filter."""
+      if relationships is None:
+         return None
+      labels = self.matching_labels(relationships)
+      return lambda edge_id: normalize_label(self.edges[edge_id][2]) in labels
+
+   def neighborhood(self, entity, k: int = 1, direction: str = "both", relationships=None, max_entities: int = None) -> tuple:
+      """Breadth-first k-hop neighborhood of an entity.
+
+      Parameters:
+         entity: The center entity.
+         k (int): Maximum number of hops.
+         direction (str): "out", "in" or "both".
+         relationships (iterable of str or callable or None): Only follow the edges matching this filter.
+         max_entities (int or None): Stop expanding once this many entities are reached.
+
+      Returns:
+         tuple: The set of entities and the sorted list of IDs of the edges traversed (edges between entities of the
+            neighborhood that weren't traversed aren't included).
+      """
+      if not self.has_entity(entity):
+         return set(), []
+
+      keep = self.edge_filter(relationships)
+      visited = {entity}
+      edge_ids = set()
+      frontier = [entity]
+
+      for _ in range(k):
+         next_frontier = []
+         for current in frontier:
+            for edge_id, neighbor in self.incident_edges(current, direction):
+               if keep is not None and not keep(edge_id):
+                  continue
+               if neighbor not in visited:
+                  if max_entities is not None and len(visited) >= max_entities:
+                     continue
+                  visited.add(neighbor)
+                  next_frontier.append(neighbor)
+               edge_ids.add(edge_id)
+         frontier = next_frontier
+         if not frontier:
+            break
+
+      return visited, sorted(edge_ids)
+
+   def shortest_path(self, source, target, direction: str = "both", relationships=None):
+      """Shortest path (in number of hops) between two entities, found with a bidirectional breadth-first search
+      (the smaller frontier is expanded first, which only visits a small part of large graphs).
+
+      Parameters:
+         source: The first entity.
+         target: The last entity.
+         direction (str): "out" follows the edges forward, "in" backward, "both" ignores their direction.
+         relationships (iterable of str or callable or None): Only follow the edges matching this filter.
+
+      Returns:
+         list or None: The entities of the path, None if there is no path.
+      """
+      if not self.has_entity(source) or not self.has_entity(target):
+         return None
+      if source == target:
+         return [source]
+
+      keep = self.edge_filter(relationships)
+      reverse = {"out": "in", "in": "out", "both": "both"}[direction]
+      # Parents of the entities reached from the source and from the target
+      forward_parents = {source: None}
+      backward_parents = {target: None}
+      forward_frontier = [source]
+      backward_frontier = [target]
+
+      while forward_frontier and backward_frontier:
+         expand_forward = len(forward_frontier) <= len(backward_frontier)
+         if expand_forward:
+            frontier, parents, others, edge_direction = forward_frontier, forward_parents, backward_parents, direction
+         else:
+            frontier, parents, others, edge_direction = backward_frontier, backward_parents, forward_parents, reverse
+         next_frontier = []
+         meeting = None
+
+         for current in frontier:
+            for edge_id, neighbor in self.incident_edges(current, edge_direction):
+               if neighbor in parents or (keep is not None and not keep(edge_id)):
+                  continue
+               parents[neighbor] = current
+               if neighbor in others:
+                  meeting = neighbor
+                  break
+               next_frontier.append(neighbor)
+            if meeting is not None:
+               break
+
+         if meeting is not None:
+            # Join the half from the source to the meeting entity and the half from the meeting entity to the target
+            path = []
+            current = meeting
+            while current is not None:
+               path.append(current)
+               current = forward_parents[current]
+            path.reverse()
+            current = backward_parents[meeting]
+            while current is not None:
+               path.append(current)
+               current = backward_parents[current]
+            return path
+
+         if expand_forward:
+            forward_frontier = next_frontier
+         else:
+            backward_frontier = next_frontier
+
+      return None
+
+   def all_simple_paths(self, source, target, max_depth: int = 3, limit: int = 100, direction: str = "both", relationships=None) -> list:
+      """Simple paths (without repeated entities) between two entities, found with a depth-first search.
+
+      Parameters:
+         source: The first entity.
+         target: The last entity.
+         max_depth (int): Maximum number of hops of a path.
+         limit (int): Maximum number of paths returned.
+         direction (str): "out", "in" or "both".
+         relationships (iterable of str or callable or None): Only follow the edges matching this filter.
+
+      Returns:
+         list: The paths, each one a list of entities. Parallel edges yield a single path.
+      """
+      if not self.has_entity(source) or not self.has_entity(target):
+         return []
+
+      keep = self.edge_filter(relationships)
+      paths = []
+      path = [source]
+      on_path = {source}
+      # Stack of neighbor iterators, one per entity of the current path
+      stack = [iter(self.incident_edges(source, direction))]
+
+      while stack and len(paths) < limit:
+         neighbor = None
+         for edge_id, candidate in stack[-1]:
+            if candidate not in on_path and (keep is None or keep(edge_id)):
+               neighbor = candidate
+               break
+
+         if neighbor is None:
+            stack.pop()
+            on_path.discard(path.pop())
+            continue
+
+         if neighbor == target:
+            if path + [target] not in paths:
+               paths.append(path + [target])
+         elif len(path) < max_depth:
+            path.append(neighbor)
+            on_path.add(neighbor)
+            stack.append(iter(self.incident_edges(neighbor, direction)))
+
+      return paths
+
+
+class CompactGraphIndex(GraphIndex):
+   """GraphIndex over the columns of a CompactGraph: the edges are read from its interned ID columns and CSR adjacency
+   instead of being copied into Python lists, only the degrees of the entities are kept (and maintained as edges are
+   added to the graph). Edge IDs are those of the CompactGraph."""
+
+   def __init__(self, graph):
+      """
+      Parameters:
+         graph (CompactGraph): The indexed graph, add_entity and add_edge must be called after adding to it.
+      """
+      self.graph = graph
+      self.out_degrees = self.__degrees(graph.sources)
+      self.in_degrees = self.__degrees(graph.targets)
+
+   def __degrees(self, column):
+      ends = np.frombuffer(column, dtype=np.int64) if len(column) else np.zeros(0, dtype=np.int64)
+      degrees = array("q")
+      degrees.frombytes(np.bincount(ends, minlength=self.graph.number_of_nodes()).astype(np.int64).tobytes())
+      return degrees
+
+   def add_entity(self, entity):
+      missing = self.graph.number_of_nodes() - len(self.out_degrees)
+      if missing > 0:
+         self.out_degrees.extend([0] * missing)
+         self.in_degrees.extend([0] * missing)
+
+   def add_edge(self, source, target, relationship, key=None) -> int:
+      self.add_entity(source)
+      self.out_degrees[self.graph.entity_ids[source]] += 1
+      self.in_degrees[self.graph.entity_ids[target]] += 1
+      return self.graph.number_of_edges() - 1
+
+   def has_entity(self, entity) -> bool:
+      return self.graph.has_node(entity)
+
+   def number_of_edges(self) -> int:
+      return self.graph.number_of_edges()
+
+   def edge(self, edge_id: int) -> tuple:
+      graph = self.graph
+      return graph.entities[graph.sources[edge_id]], graph.entities[graph.targets[edge_id]], graph.labels[graph.relationships[edge_id]]
+
+   def degree(self, entity) -> int:
+      entity_id = self.graph.entity_ids.get(entity)
+      if entity_id is None or entity_id >= len(self.out_degrees):
+         return 0
+      return self.out_degrees[entity_id] + self.in_degrees[entity_id]
+
+   def labels(self) -> list:
+      return list(dict.fromkeys(normalize_label(label) for label in self.graph.labels))
+
+   def __label_ids(self, relationships) -> set:
+      labels = self.matching_labels(relationships)
+      return {label_id for label_id, label in enumerate(self.graph.labels) if normalize_label(label) in labels}
+
+   def edges_with_relationship(self, relationships) -> list:
+      label_ids = np.fromiter(self.__label_ids(relationships), dtype=np.int64)
+      column = self.graph.relationships
+      relationships = np.frombuffer(column, dtype=np.int64) if len(column) else np.zeros(0, dtype=np.int64)
+      return np.flatnonzero(np.isin(relationships, label_ids)).tolist()
+
+   def incident_edges(self, entity, direction: str = "both"):
+      graph = self.graph
+      entity_id = graph.entity_ids.get(entity)
+      if entity_id is None:
+         return
+      for edge_direction, ends in (("out", graph.targets), ("in", graph.sources)):
+         if direction not in (edge_direction, "both"):
+            continue
+         offsets, edge_ids = graph.csr(edge_direction)
+         for edge_id in edge_ids[offsets[entity_id]:offsets[entity_id + 1]].tolist():
+            yield edge_id, graph.entities[ends[edge_id]]
+
+   def edge_filter(self, relationships):
+      if relationships is None:
+         return None
+      label_ids = self.__label_ids(relationships)
+      column = self.graph.relationships
+      return lambda edge_id: column[edge_id] in label_ids
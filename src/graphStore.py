@@ -0,0 +1,210 @@
+# Persistent store of knowledge graph relationships in a SQLite file
+
+from knowledgeGraph import KnowledgeGraph
+import threading
+import sqlite3
+import time
+import os
+
+
+class GraphStore:
+   """Relationships stored on disk with the query (entity) they were extracted for and the time of the last upsert.
+   Lookups by source, target, relationship and query are indexed, so subgraphs are loaded without reading the whole store.
+   Safe to share between threads (one connection per thread) and processes (SQLite locking in WAL mode)."""
+
+   def __init__(self, path: str):
+      """
+      Parameters:
+         path (str): The SQLite file, created if it doesn't exist.
+      """
+      self.path = path
+      self.__local = threading.local()
+
+      directory = os.path.dirname(os.path.abspath(path))
+      os.makedirs(directory, exist_ok=True)
+
+      with self.__connection() as connection:
+         connection.execute("PRAGMA journal_mode=WAL")
+         connection.execute("""CREATE TABLE IF NOT EXISTS relationships (
+            src TEXT NOT NULL,
+            relationship TEXT NOT NULL,
+            tgt TEXT NOT NULL,
+            query TEXT NOT NULL,
+            updated_at REAL NOT NULL,
+            UNIQUE (src, relationship, tgt, query)
+         )""")
+         connection.execute("CREATE INDEX IF NOT EXISTS relationships_src ON relationships (src)")
+         connection.execute("CREATE INDEX IF NOT EXISTS relationships_tgt ON relationships (tgt)")
+         connection.execute("CREATE INDEX IF NOT EXISTS relationships_relationship ON relationships (relationship COLLATE NOCASE)")
+         connection.execute("CREATE INDEX IF NOT EXISTS relationships_query ON relationships (query, updated_at)")
+
+   def __connection(self) -> sqlite3.Connection:
+      # SQLite connections can't be shared between threads, keep one per thread
+      connection = getattr(self.__local, "connection", None)
+      if connection is None:
+         connection = sqlite3.connect(self.path, timeout=30)
+         connection.row_factory = sqlite3.Row
+         # Durable enough in WAL mode (a power loss can only lose the last transactions), with fewer fsyncs per upsert
+         connection.execute("PRAGMA synchronous=NORMAL")
+         self.__local.connection = connection
+      return connection
+
+   def upsert(self, relationships, query: str = "", timestamp: float = None, replace: bool = False) -> int:
+      """Insert relationships, or update the timestamp of the ones already stored for the query.
+
+      Parameters:
+         relationships (iterable of dicts): The relationships with 'src', 'relationship' and 'tgt' keys.
+         query (str): The query (entity) the relationships were extracted for.
+         timestamp (float or None): Time of the extraction, defaults to now.
+         replace (bool): Delete the relationships previously stored for the query first.
+
+      Returns:
+         int: The number of relationships upserted.
+      """
+      timestamp = time.time() if timestamp is None else timestamp
+      rows = [(rel['src'], rel['relationship'], rel['tgt'], query, timestamp) for rel in relationships]
+
+      with self.__connection() as connection:
+         if replace:
+            connection.execute("DELETE FROM relationships WHERE query = ?", (query,))
+         connection.executemany(
+            """INSERT INTO relationships (src, relationship, tgt, query, updated_at) VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (src, relationship, tgt, query) DO UPDATE SET updated_at = excluded.updated_at""",
+            rows
+         )
+      return len(rows)
+
+   def delete(self, query: str) -> int:
+      """Delete the relationships stored for a query and return their number."""
+      with self.__connection() as connection:
+         return connection.execute("DELETE FROM relationships WHERE query = ?", (query,)).rowcount
+
+   def find(self, src: str = None, tgt: str = None, relationship: str = None, query: str = None, since: float = None, limit: int = None) -> list:
+      """Find the stored relationships matching all the given filters (indexed lookups).
+
+      Parameters:
+         src (str or None): The source entity.
+         tgt (str or None): The target entity.
+         relationship (str or None): The relationship label (case-insensitive).
+         query (str or None): The query the relationships were extracted for.
+         since (float or None): Only relationships upserted at or after this time.
+         limit (int or None): Maximum number of relationships returned.
+
+      Returns:
+         list: Dicts with 'src', 'relationship', 'tgt', 'query' and 'updated_at' keys.
+      """
+      conditions, params = [], []
+      for column, value in (("src", src), ("tgt", tgt), ("query", query)):
+         if value is not None:
+            conditions.append(f"{column} = ?")
+            params.append(value)
+      if relationship is not None:
+         conditions.append("relationship = ? COLLATE NOCASE")
+         params.append(relationship)
+      if since is not None:
+         conditions.append("updated_at >= ?")
+         params.append(since)
+
+      sql = "SELECT src, relationship, tgt, query, updated_at FROM relationships"
+      if conditions:
+         sql += " WHERE " + " AND ".join(conditions)
+      if limit is not None:
+         sql += " LIMIT ?"
+         params.append(limit)
+
+      return [dict(row) for row in self.__connection().execute(sql, params)]
+
+   def neighborhood(self, entity: str, k: int = 1, max_relationships: int = None) -> list:
+      """Relationships within k hops of an entity (in both directions), one indexed lookup per hop.
+
+      Parameters:
+         entity (str): The center entity.
+         k (int): Maximum number of hops.
+         max_relationships (int or None): Stop once this many relationships are loaded.
+
+      Returns:
+         list: Dicts with 'src', 'relationship', 'tgt', 'query' and 'updated_at' keys.
+      """
+      connection = self.__connection()
+      visited = {entity}
+      frontier = [entity]
+      seen = set()
+      relationships = []
+
+      for _ in range(k):
+         next_frontier = []
+         # Stay below the SQLite limit on the number of parameters
+         for start in range(0, len(frontier), 500):
+            batch = frontier[start:start + 500]
+            placeholders = ",".join("?" * len(batch))
+            rows = connection.execute(
+               f"""SELECT rowid, src, relationship, tgt, query, updated_at FROM relationships WHERE src IN ({placeholders})
+               UNION SELECT rowid, src, relationship, tgt, query, updated_at FROM relationships WHERE tgt IN ({placeholders})""",
+               batch + batch
+            )
+            for row in rows:
+               if row["rowid"] in seen:
+                  continue
+               seen.add(row["rowid"])
+               relationships.append({key: row[key] for key in ("src", "relationship", "tgt", "query", "updated_at")})
+               if max_relationships is not None and len(relationships) >= max_relationships:
+                  return relationships
+               for neighbor in (row["src"], row["tgt"]):
+                  if neighbor not in visited:
+                     visited.add(neighbor)
+                     next_frontier.append(neighbor)
+         frontier = next_frontier
+         if not frontier:
+            break
+
+      return relationships
+
+   def queries(self) -> dict:
+      """The stored queries and the time of their last upsert."""
+      rows = self.__connection().execute("SELECT query, MAX(updated_at) FROM relationships GROUP BY query")
+      return {query: updated_at for query, updated_at in rows}
+
+   def __len__(self):
+      return self.__connection().execute("SELECT COUNT(*) FROM relationships").fetchone()[0]
+
+   def load(self, knowledge_graph: KnowledgeGraph = None, entity: str = None, k: int = 1, provenance: bool = True, **filters) -> KnowledgeGraph:
+      """Bulk-load stored relationships into a knowledge graph. Rows are streamed from the store, not materialized.
+      A relationship stored for several queries is loaded as one edge per query.
+
+      Parameters:
+         knowledge_graph (KnowledgeGraph or None): The graph to add the relationships to, a new one if None.
+         entity (str or None): If given, only load the k-hop neighborhood of this entity.
+         k (int): Number of hops of the neighborhood.
+         provenance (bool): Set the provenance of the rows as edge attributes: `source_query` (unless empty) and
+            `updated_at`.
+         filters: Filters of find (src, tgt, relationship, query, since, limit), used when no entity is given.
+
+      Returns:
+         KnowledgeGraph: The knowledge graph.
+      """
+      knowledge_graph = KnowledgeGraph() if knowledge_graph is None else knowledge_graph
+
+      if entity is not None:
+         rows = self.neighborhood(entity, k=k)
+      elif filters:
+         rows = self.find(**filters)
+      else:
+         rows = self.__connection().execute("SELECT src, relationship, tgt, query, updated_at FROM relationships")
+
+      for row in rows:
+         attributes = {}
+         if provenance:
+            if row['query']:
+               attributes['source_query'] = row['query']
+            attributes['updated_at'] = row['updated_at']
+         knowledge_graph.add_entity(row['src'])
+         knowledge_graph.add_entity(row['tgt'])
+         knowledge_graph.add_relationship(row['src'], row['tgt'], row['relationship'], **attributes)
+
+      return knowledge_graph
+
+   def close(self):
+      connection = getattr(self.__local, "connection", None)
+      if connection is not None:
+         connection.close()
+         self.__local.connection = None
@@ -1,36 +1,221 @@
+from compactGraph import CompactGraph
+from graphQuery import GraphIndex, CompactGraphIndex
+from entityResolution import EntityResolver
+from graphLayout import ForceLayout, select_nodes
+from tracing import span, traced
 import networkx as nx
-import matplotlib.pyplot as plt
 
 class KnowledgeGraph:
-   def __init__(self, relationships):
+   def __init__(self, relationships=(), backend="networkx", resolver: EntityResolver = None):
       """
       Parameters:
          relationships (list of dicts): Each dictionary should contain 'src', 'tgt', and 'relationship' keys.
+            Can be empty, e.g. to grow the graph while the relationships are streamed.
+         backend (str): "networkx" stores the graph in a nx.MultiDiGraph, "compact" in a CompactGraph 
+            (interned entities and relationship labels, array-based edges) which uses less memory for large graphs.
+         resolver (EntityResolver or None): If given, entity names are resolved at insert time so that the different
+            spellings of an entity (e.g. "Tesla" and "Tesla, Inc.") are merged into a single node.
       """
-      # self.__graph = nx.DiGraph()
-      self.__graph = nx.MultiDiGraph()
-      self.__build_knowledge_graph(relationships)
+      if backend == "networkx":
+         # self.__graph = nx.DiGraph()
+         self.__graph = nx.MultiDiGraph()
+      elif backend == "compact":
+         self.__graph = CompactGraph()
+      else:
+         raise ValueError(f"Unknown backend: {backend}")
+      self.__backend = backend
+      self.__resolver = resolver
+      # Query index, built on first use and then maintained incrementally
+      self.__index = None
+      with span("knowledge_graph_build", backend=backend) as trace:
+         self.__build_knowledge_graph(relationships)
+         trace.set("edges", self.__graph.number_of_edges())
 
    @property
    def graph(self):
+      """The graph as a nx.MultiDiGraph, the compact backend is exported to networkx on demand."""
+      if isinstance(self.__graph, CompactGraph):
+         return self.__graph.to_networkx()
       return self.__graph
 
+   @property
+   def store(self):
+      """The underlying storage, a nx.MultiDiGraph or a CompactGraph."""
+      return self.__graph
+
+   @property
+   def index(self) -> GraphIndex:
+      """The query index (relationship label to edges, per-entity in/out edges), built on first use. The index of the
+      compact backend reads the edges from its columns (see CompactGraphIndex)."""
+      if self.__index is None:
+         with span("knowledge_graph_index", edges=self.__graph.number_of_edges()):
+            if isinstance(self.__graph, CompactGraph):
+               self.__index = CompactGraphIndex(self.__graph)
+            else:
+               edges = self.__graph.edges(keys=True, data="relationship")
+               self.__index = GraphIndex((source, target, relationship, key) for source, target, key, relationship in edges)
+               for entity in self.__graph.nodes():
+                  self.__index.add_entity(entity)
+      return self.__index
+
+   def edges(self, data=False):
+      """Yield the relationships as (source, target, relationship) tuples, or (source, target, relationship, attributes)
+      tuples if data is True (the attributes of the edge other than the relationship, e.g. its provenance)."""
+      if isinstance(self.__graph, CompactGraph):
+         yield from self.__graph.edges(data=data)
+      elif data:
+         for source, target, attributes in self.__graph.edges(data=True):
+            yield source, target, attributes["relationship"], {key: value for key, value in attributes.items() if key != "relationship"}
+      else:
+         yield from self.__graph.edges(data="relationship")
+
    def __build_knowledge_graph(self, relationships):
+      self.add_relationships(relationships)
+
+   def add_relationships(self, relationships, **attributes):
+      """Add relationships (dicts with 'src', 'tgt' and 'relationship' keys) and their entities.
+
+      Parameters:
+         relationships (iterable of dicts): The relationships, can be a generator.
+         attributes: Attributes set on every added edge, e.g. source_query="Tesla".
+      """
       for rel in relationships:
          self.add_entity(rel['src'])
          self.add_entity(rel['tgt'])
-         self.add_relationship(rel['src'], rel['tgt'], rel['relationship'])
+         self.add_relationship(rel['src'], rel['tgt'], rel['relationship'], **attributes)
+
+   def merge(self, other, **attributes):
+      """Merge another graph into this one: its entities (resolved with the resolver of this graph, if any) and its
+      relationships with their attributes.
+
+      Parameters:
+         other (KnowledgeGraph or iterable of dicts): The graph, or relationships as dicts with 'src', 'tgt' and
+            'relationship' keys.
+         attributes: Attributes set on the merged edges, those of the edges of the other graph take precedence.
+
+      Returns:
+         KnowledgeGraph: This graph.
+      """
+      if not isinstance(other, KnowledgeGraph):
+         self.add_relationships(other, **attributes)
+         return self
+
+      with span("knowledge_graph_merge", edges=other.store.number_of_edges()):
+         for entity in other.store.nodes():
+            self.add_entity(entity)
+         for source, target, relationship, edge_attributes in other.edges(data=True):
+            self.add_relationship(source, target, relationship, **{**attributes, **edge_attributes})
+      return self
+
+   @property
+   def resolver(self):
+      return self.__resolver
+
+   def canonical_entity(self, entity):
+      """The node of an entity name, i.e. its canonical entity if a resolver is used (the name itself if unknown)."""
+      if self.__resolver is None:
+         return entity
+      canonical = self.__resolver.lookup(entity)
+      return entity if canonical is None else canonical
+
+   def aliases(self, entity):
+      """The surface forms merged into an entity (only the entity itself without a resolver)."""
+      entity = self.canonical_entity(entity)
+      if self.__resolver is None:
+         return {entity}
+      return set(self.__resolver.surface_forms.get(entity, {entity}))
 
    def add_entity(self, entity):
-      self.__graph.add_node(entity)
+      if self.__resolver is not None:
+         entity = self.__resolver.resolve(entity)
+      if isinstance(self.__graph, CompactGraph) or self.__resolver is None:
+         self.__graph.add_node(entity)
+      else:
+         # Keep the original surface forms on the node
+         self.__graph.add_node(entity, aliases=self.__resolver.surface_forms[entity])
+      if self.__index is not None:
+         self.__index.add_entity(entity)
 
-   def add_relationship(self, source, target, relationship):
-      self.__graph.add_edge(source, target, relationship=relationship)
+   def add_relationship(self, source, target, relationship, **attributes):
+      """Add a relationship between two entities. Attributes (e.g. provenance: source_query, source_file) are stored
+      on the edge."""
+      if self.__resolver is not None:
+         source = self.__resolver.resolve(source)
+         target = self.__resolver.resolve(target)
+      key = self.__graph.add_edge(source, target, relationship=relationship, **attributes)
+      if self.__index is not None:
+         self.__index.add_edge(source, target, relationship, key)
+
+   def __edge_attributes(self, edge_id) -> dict:
+      if isinstance(self.__graph, CompactGraph):
+         return self.__graph.edge_attributes(edge_id)
+      source, target, _ = self.__index.edge(edge_id)
+      attributes = self.__graph.edges[source, target, self.__index.keys[edge_id]]
+      return {key: value for key, value in attributes.items() if key != "relationship"}
+
+   def __subgraph(self, edge_ids, entities=()):
+      """Subgraph of edges of the index, with their attributes and the resolver of this graph (the aliases of its
+      entities are kept)."""
+      index = self.index
+      subgraph = KnowledgeGraph(backend=self.__backend, resolver=self.__resolver)
+      for entity in entities:
+         subgraph.add_entity(entity)
+      for edge_id in edge_ids:
+         source, target, relationship = index.edge(edge_id)
+         subgraph.add_entity(source)
+         subgraph.add_entity(target)
+         subgraph.add_relationship(source, target, relationship, **self.__edge_attributes(edge_id))
+      return subgraph
+
+   def filter_relationships(self, relationships):
+      """Subgraph with only the relationships matching a filter, e.g. only investments, locations or co-workers.
+
+      Parameters:
+         relationships (iterable of str or callable): Relationship labels to keep (case-insensitive), or a predicate called on
+            each distinct normalized label, e.g. lambda label: "invest" in label.
+
+      Returns:
+         KnowledgeGraph: The subgraph.
+      """
+      return self.__subgraph(self.index.edges_with_relationship(relationships))
+
+   def neighborhood(self, entity, k=1, direction="both", relationships=None, max_entities=None):
+      """Subgraph of the entities within k hops of an entity.
+
+      Parameters:
+         entity (str): The center entity.
+         k (int): Maximum number of hops.
+         direction (str): "out" (follow the relationships forward), "in" (backward) or "both".
+         relationships (iterable of str or callable or None): Only follow the relationships matching this filter.
+         max_entities (int or None): Maximum number of entities in the subgraph.
+
+      Returns:
+         KnowledgeGraph: The subgraph.
+      """
+      entities, edge_ids = self.index.neighborhood(self.canonical_entity(entity), k=k, direction=direction, relationships=relationships, max_entities=max_entities)
+      return self.__subgraph(edge_ids, entities=entities)
+
+   def shortest_path(self, source, target, direction="both", relationships=None):
+      """Shortest path between two entities, a list of entities or None if they aren't connected (see GraphIndex.shortest_path)."""
+      return self.index.shortest_path(self.canonical_entity(source), self.canonical_entity(target), direction=direction, relationships=relationships)
+
+   def all_simple_paths(self, source, target, max_depth=3, limit=100, direction="both", relationships=None):
+      """Simple paths between two entities, at most `limit` paths of at most `max_depth` hops (see GraphIndex.all_simple_paths)."""
+      return self.index.all_simple_paths(self.canonical_entity(source), self.canonical_entity(target), max_depth=max_depth, limit=limit, direction=direction, relationships=relationships)
 
 
 class KnowledgeGraphVisualizer:
-   def __init__(self, knowledge_graph: KnowledgeGraph):
+   def __init__(self, knowledge_graph: KnowledgeGraph, layout: ForceLayout = None):
+      """
+      Parameters:
+         knowledge_graph (KnowledgeGraph): The graph to visualize.
+         layout (ForceLayout or None): The layout engine, its positions are cached and reused between renders.
+      """
       self.knowledge_graph = knowledge_graph
+      self.layout = ForceLayout() if layout is None else layout
+      # Aggregated graph and number of relationships of the knowledge graph already aggregated into it
+      self.__aggregated = nx.DiGraph()
+      self.__aggregated_edges = 0
 
    def aggregate_edge_labels(self, multigraph):
       """Aggregate multiple edges between two nodes into a single edge with a combined label.
@@ -49,7 +234,22 @@ class KnowledgeGraphVisualizer:
 
       return simplified_graph
 
-   def visualize(self, with_labels=True, node_size=6000, highlight_size=12000, node_color="#9ecae1", highlight_color="#6baed6", edge_color="lightgrey", font_color="#0c1a26", font_size=10, highlight_entities=[], num_nodes=None):
+   def aggregated_graph(self) -> nx.DiGraph:
+      """The graph with the multiple edges between two nodes aggregated (see aggregate_edge_labels), cached and only
+      updated with the relationships added to the knowledge graph since the last call."""
+      index = self.knowledge_graph.index
+      number_of_edges = index.number_of_edges()
+      for edge_id in range(self.__aggregated_edges, number_of_edges):
+         u, v, relationship = index.edge(edge_id)
+         if self.__aggregated.has_edge(u, v):
+            self.__aggregated[u][v]['relationship'] += ',\n' + relationship
+         else:
+            self.__aggregated.add_edge(u, v, relationship=relationship)
+      self.__aggregated_edges = number_of_edges
+      return self.__aggregated
+
+   @traced()
+   def visualize(self, with_labels=True, node_size=6000, highlight_size=12000, node_color="#9ecae1", highlight_color="#6baed6", edge_color="lightgrey", font_color="#0c1a26", font_size=10, highlight_entities=[], num_nodes=None, select_by=None, max_detailed_edges=500):
       """
       Visualizes the knowledge graph using matplotlib.
 
@@ -63,31 +263,44 @@ class KnowledgeGraphVisualizer:
          font_color (str): The color of the font for node labels.
          font_size (int): The font size for node labels.
          highlight_entities (list of str): Nodes to highlight.
-         num_nodes (int or None): If specified, limits the graph to the first num_nodes nodes.
+         num_nodes (int or None): If specified, limits the graph to the num_nodes most important nodes (see select_by).
+         select_by (str or None): How the nodes are selected with num_nodes: "centrality" (highest degree) or "distance"
+            (fewest hops from the highlighted entities). Defaults to "distance" if entities are highlighted.
+         max_detailed_edges (int): Above this number of edges, the edges are drawn as plain lines without arrows and
+            labels (they are drawn one by one, which takes minutes for thousands of edges).
       """
+      highlight_entities = [self.knowledge_graph.canonical_entity(entity) for entity in highlight_entities]
+
       # Aggregate edge labels for multigraph
-      simplified_graph = self.aggregate_edge_labels(self.knowledge_graph.graph)
-      # If 'num_nodes' is specified, visualize a subgraph only with the first 'num_nodes' nodes
+      simplified_graph = self.aggregated_graph()
+      # If 'num_nodes' is specified, visualize a subgraph only with the 'num_nodes' most important nodes
       if num_nodes is not None:
          num_nodes = int(num_nodes)
          if 1 < num_nodes and num_nodes < simplified_graph.number_of_nodes():
-            nodes = list(simplified_graph.nodes())[:num_nodes]
+            select_by = select_by or ("distance" if highlight_entities else "centrality")
+            nodes = select_nodes(simplified_graph, num_nodes, highlight_entities=highlight_entities, by=select_by)
             simplified_graph = simplified_graph.subgraph(nodes)
 
       # Highlight any nodes/entities (change color and size) if specified
       color_map = [highlight_color if node in highlight_entities else node_color for node in simplified_graph]
       size_map = [highlight_size if node in highlight_entities else node_size for node in simplified_graph]
       
-      # Generate positions for all nodes
-      pos = nx.spring_layout(simplified_graph) # alternatively: circular_layout
+      # Generate positions for all nodes (cached, only refined if nodes were added since the last render)
+      with span("layout", nodes=simplified_graph.number_of_nodes()):
+         pos = self.layout(simplified_graph)
+      # Imported on first use, so that building graphs (e.g. in a headless worker) doesn't load matplotlib
+      import matplotlib.pyplot as plt
       plt.figure(figsize=(10, 10))
       
       # Draw nodes and edges
-      nx.draw(simplified_graph, pos, with_labels=with_labels, node_size=size_map, node_color=color_map, edge_color=edge_color, font_size=font_size, font_weight="bold", width=3, arrowstyle="-|>", arrowsize=20) # arrows = True, alpha = 0.6
+      detailed = simplified_graph.number_of_edges() <= max_detailed_edges
+      arrow_options = {"arrowstyle": "-|>", "arrowsize": 20} if detailed else {}
+      nx.draw(simplified_graph, pos, with_labels=with_labels, node_size=size_map, node_color=color_map, edge_color=edge_color, font_size=font_size, font_weight="bold", width=3, arrows=detailed, **arrow_options) # alpha = 0.6
       
       # Draw edge labels
-      edge_labels = nx.get_edge_attributes(simplified_graph, 'relationship')
-      nx.draw_networkx_edge_labels(simplified_graph, pos, edge_labels=edge_labels, font_color=font_color)
+      if detailed:
+         edge_labels = nx.get_edge_attributes(simplified_graph, 'relationship')
+         nx.draw_networkx_edge_labels(simplified_graph, pos, edge_labels=edge_labels, font_color=font_color)
       
       # plt.axis('off')
       plt.show()
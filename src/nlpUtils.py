@@ -1,14 +1,240 @@
-from openai import OpenAI
+from responseCache import CompletionCache
+from clients import get_openai_client
+from rateLimiter import RateLimiter
+from numTokens import num_tokens_chat, num_tokens_batch
+from relationshipParser import parse_relationships, iter_relationships, deduplicate_relationships
+from concurrent.futures import ThreadPoolExecutor
+from chunking import chunk_text
+from tracing import span, traced, current_span
+from contextlib import contextmanager
+import functools
+import contextvars
+import threading
+import warnings
+import asyncio
+import json
 import ast
 
-client = OpenAI()
+# Optional on-disk response cache, see enable_completion_cache
+completion_cache = None
 
+# Optional rate limiter shared by all the API calls, see set_rate_limiter
+rate_limiter = None
 
-# TODO: Future Development
-# - Investigate relationships of newly identified entities. 
+# Token usage counters of the current context, see track_token_usage
+usage_trackers = contextvars.ContextVar("usage_trackers", default=())
 
 
-def get_completion(messages, model="gpt-3.5-turbo", max_tokens=256, temperature=1, response_format=None):
+def enable_completion_cache(**kwargs) -> CompletionCache:
+   """Cache the completions of identical requests on disk. 
+
+   Parameters:
+      kwargs: Arguments of CompletionCache, e.g. path, max_entries, max_bytes, ttl, or client (used by all the
+         completions while the cache is enabled, even those bypassing the cache).
+
+   Returns:
+      CompletionCache: The cache, its stats() method reports the hits and misses.
+   """
+   global completion_cache
+   completion_cache = CompletionCache(**kwargs)
+   return completion_cache
+
+
+def completion_client():
+   """The client of the completions: the client of the completion cache if it was given one (e.g. a fake client to run
+   offline), the shared client otherwise (see clients.get_openai_client)."""
+   cache = completion_cache
+   if cache is not None and cache.client is not None:
+      return cache.client
+   return get_openai_client()
+
+
+@functools.lru_cache(maxsize=4)
+def without_retries(client):
+   """A copy of an OpenAI client that doesn't retry failed requests (sharing its connection pool), used with the rate
+   limiter so that 429 errors are retried by the limiter, within its buckets. Clients without with_options (e.g. fake
+   clients) are returned as is."""
+   with_options = getattr(client, "with_options", None)
+   return client if with_options is None else with_options(max_retries=0)
+
+
+def disable_completion_cache():
+   global completion_cache
+   completion_cache = None
+
+
+def set_rate_limiter(limiter: RateLimiter = None):
+   """Limit the requests/tokens per minute of all the completions (with backoff on 429 errors). None removes the limits.
+   While a limiter is set, the requests are sent without the retries of the OpenAI client (see without_retries)."""
+   global rate_limiter
+   rate_limiter = limiter
+
+
+class TokenUsage:
+   """Tokens used by the completions created in a context (as reported by the API), see track_token_usage."""
+
+   def __init__(self):
+      self.requests = 0
+      self.prompt_tokens = 0
+      self.completion_tokens = 0
+      self.__lock = threading.Lock()
+
+   @property
+   def total_tokens(self) -> int:
+      return self.prompt_tokens + self.completion_tokens
+
+   def add(self, usage):
+      """Add the usage of a completion (completion.usage, None if unknown, e.g. a stream closed before its end)."""
+      with self.__lock:
+         self.requests += 1
+         if usage is not None:
+            self.prompt_tokens += usage.prompt_tokens
+            self.completion_tokens += usage.completion_tokens
+
+   def to_dict(self) -> dict:
+      return {"requests": self.requests, "prompt_tokens": self.prompt_tokens, "completion_tokens": self.completion_tokens}
+
+
+@contextmanager
+def track_token_usage():
+   """Count the tokens of the completions created inside the with block, including the ones created by the worker
+   threads it starts with a copy of its context (asyncio.to_thread, run_sync, retrieve_data_async, extract_relationships_chunked).
+   Completions served from the completion cache aren't counted.
+
+   Yields:
+      TokenUsage: The counters.
+   """
+   usage = TokenUsage()
+   reset = usage_trackers.set(usage_trackers.get() + (usage,))
+   try:
+      yield usage
+   finally:
+      usage_trackers.reset(reset)
+
+
+def request_tokens(args: dict) -> int:
+   """Approximate number of tokens a request counts against a tokens-per-minute limit (prompt and max_tokens).
+
+   Parameters:
+      args (dict): Arguments of chat.completions.create.
+
+   Returns:
+      int: The number of tokens.
+   """
+   # Messages from previous completions may be objects rather than dicts, only count their string fields
+   messages = []
+   for message in args["messages"]:
+      if hasattr(message, "model_dump"):
+         message = message.model_dump()
+      messages.append({key: value for key, value in message.items() if isinstance(value, str)})
+
+   return num_tokens_chat(messages, model=args["model"]) + args.get("max_tokens", 0)
+
+
+def request_completion(args: dict):
+   """Call chat.completions.create, subject to the rate limiter if one is set."""
+   client = completion_client()
+   if rate_limiter is not None:
+      client = without_retries(client)
+      return rate_limiter.call(lambda: client.chat.completions.create(**args), tokens=request_tokens(args))
+   return client.chat.completions.create(**args)
+
+
+def record_usage(trace, usage):
+   """Add the usage of a completion (None if unknown) to the usage trackers of the current context and to its span."""
+   for tracker in usage_trackers.get():
+      tracker.add(usage)
+   if usage is not None:
+      trace.set("prompt_tokens", usage.prompt_tokens)
+      trace.set("completion_tokens", usage.completion_tokens)
+
+
+def create_completion(args: dict, use_cache: bool = True, refresh_cache: bool = False):
+   """Create a chat completion, served from the completion cache if it is enabled.
+   Calls to the API are subject to the rate limiter if one is set.
+
+   Parameters:
+      args (dict): Arguments of chat.completions.create.
+      use_cache (bool): Set to False to bypass the cache.
+      refresh_cache (bool): Set to True to ignore the cached completion and replace it with a new one.
+
+   Returns:
+      ChatCompletion: The completion, or an iterator of its chunks if args has stream=True (see stream_completion).
+   """
+   # Streamed completions are never cached
+   if args.get("stream"):
+      return stream_completion(args)
+
+   with span("chat_completion", model=args["model"]) as trace:
+      cache = completion_cache if use_cache else None
+      if cache is not None and not refresh_cache:
+         completion = cache.get(args)
+         if completion is not None:
+            trace.set("cache_hits", 1)
+            return completion
+         trace.set("cache_misses", 1)
+
+      completion = request_completion(args)
+      record_usage(trace, getattr(completion, "usage", None))
+
+      if cache is not None:
+         cache.put(args, completion)
+
+      return completion
+
+
+def stream_completion(args: dict):
+   """Create a streamed chat completion and yield its chunks, the request is sent on the first iteration. The usage
+   is requested in a last chunk (stream_options include_usage) and recorded when the stream ends, the chat_completion
+   span covers the whole stream. Closing the iterator (e.g. a consumer stopping early) closes the stream.
+
+   Parameters:
+      args (dict): Arguments of chat.completions.create.
+
+   Yields:
+      ChatCompletionChunk: The chunks, the last one has no choices and the usage.
+   """
+   args = {**args, "stream": True, "stream_options": {**(args.get("stream_options") or {}), "include_usage": True}}
+
+   def chunks():
+      with span("chat_completion", model=args["model"], stream=True) as trace:
+         stream = request_completion(args)
+         usage = None
+         try:
+            for chunk in stream:
+               usage = getattr(chunk, "usage", None) or usage
+               yield chunk
+         finally:
+            close = getattr(stream, "close", None)
+            if close is not None:
+               close()
+            record_usage(trace, usage)
+
+   # The span is opened and closed in its own context, so it isn't the current span of the consumer between the chunks
+   context = contextvars.copy_context()
+   iterator = chunks()
+   try:
+      while True:
+         try:
+            chunk = context.run(next, iterator)
+         except StopIteration:
+            return
+         yield chunk
+   finally:
+      context.run(iterator.close)
+
+
+def completion_text(chunks):
+   """Yield the text deltas of the chunks of a streamed completion, closing the stream if the iterator is closed early."""
+   try:
+      for chunk in chunks:
+         if chunk.choices:
+            yield chunk.choices[0].delta.content or ""
+   finally:
+      chunks.close()
+
+
+def get_completion(messages, model="gpt-3.5-turbo", max_tokens=256, temperature=1, response_format=None, use_cache=True, refresh_cache=False, stream=False):
    args = {
       "model": model,
       "messages": messages,
@@ -19,11 +245,17 @@ def get_completion(messages, model="gpt-3.5-turbo", max_tokens=256, temperature=
    if response_format is not None:
       args["response_format"] = response_format
 
-   completion = client.chat.completions.create(**args)
+   # With stream=True, return a generator of the text deltas as they arrive instead of the first choice
+   if stream:
+      args["stream"] = True
+      return completion_text(create_completion(args, use_cache=use_cache, refresh_cache=refresh_cache))
+
+   completion = create_completion(args, use_cache=use_cache, refresh_cache=refresh_cache)
 
    return completion.choices[0]
 
 
+@traced()
 def extract_entities(query: str, data: str, model: str = "gpt-3.5-turbo"):
    """Extract entities relevant to the query from the given data using OpenAI's GPT model.
 
@@ -61,6 +293,7 @@ def extract_entities(query: str, data: str, model: str = "gpt-3.5-turbo"):
    return messages, completion.message
 
 
+@traced()
 def extract_relationships_from_entities(query: str, context: list = [], model: str = "gpt-3.5-turbo"):
    """Extract relevant relationships between the query and entities provided in the context
    
@@ -89,6 +322,7 @@ def extract_relationships_from_entities(query: str, context: list = [], model: s
    return messages, completion.message
 
 
+@traced()
 def extract_relationships_directly(query: str, data: str, model: str = "gpt-3.5-turbo"):
    """Extract relationships/connections between the query and relevant entities found in the data
    
@@ -100,6 +334,55 @@ def extract_relationships_directly(query: str, data: str, model: str = "gpt-3.5-
    Returns:
       tuple: A tuple containing the context and the model's output.
    """
+   messages = relationships_directly_messages(query=query, data=data)
+
+   completion = get_completion(messages=messages, model=model)
+
+   # return the context (previous messages) and the LLM output
+   return messages, completion.message
+
+
+@traced()
+def extract_relationships_chunked(query: str, data: str, model: str = "gpt-3.5-turbo", json_model: str = "gpt-3.5-turbo", max_chunk_tokens: int = 2000, max_workers: int = 4) -> list:
+   """Extract the relationships from a text of any length: the text is split into chunks within a token budget
+   (on snippet boundaries), the relationships of the chunks are extracted concurrently, then merged and deduplicated.
+
+   Parameters:
+      query (str): The entity from the input query.
+      data (str): Text with information related to the query.
+      model (str): Model to use for the extraction, defaults to "gpt-3.5-turbo".
+      json_model (str): Model used for the relationship lines that can't be parsed locally.
+      max_chunk_tokens (int): The token budget of the text in each prompt.
+      max_workers (int): Maximum number of chunks processed concurrently.
+
+   Returns:
+      list: The relationships, dicts with 'src', 'relationship' and 'tgt' keys.
+   """
+   chunks = chunk_text(data, max_tokens=max_chunk_tokens, model=model)
+
+   def extract(chunk):
+      _, output = extract_relationships_directly(query=query, data=chunk, model=model)
+      relationships, _ = parse_relationships_text(output.content or "", query=query, model=json_model)
+      return relationships
+
+   with ThreadPoolExecutor(max_workers=max_workers) as executor:
+      # Each chunk runs in a copy of the caller's context, so its token usage is tracked (see track_token_usage)
+      futures = [executor.submit(contextvars.copy_context().run, extract, chunk) for chunk in chunks]
+      results = [future.result() for future in futures]
+
+   return deduplicate_relationships(rel for relationships in results for rel in relationships)
+
+
+def relationships_directly_messages(query: str, data: str) -> list:
+   """Construct the messages of the prompt used to extract the relationships directly (see extract_relationships_directly).
+
+   Parameters:
+      query (str): The entity from the input query.
+      data (str): Text with information related to the query.
+
+   Returns:
+      list: The messages.
+   """
    # System message
    msg_system = """You extract the most important and relevant entities from a text and find how they are connected."""
 
@@ -134,27 +417,265 @@ def extract_relationships_directly(query: str, data: str, model: str = "gpt-3.5-
       {"role": "user", "content": msg_relationships}
    ]
 
-   completion = get_completion(messages=messages, model=model)
+   return messages
 
-   # return the context (previous messages) and the LLM output
-   return messages, completion.message
 
+def stream_relationships_directly(query: str, data: str, model: str = "gpt-3.5-turbo", knowledge_graph=None):
+   """Extract the relationships like extract_relationships_directly, but stream the completion and yield every relationship
+   as soon as its line is complete. If a knowledge graph is given, it grows with each relationship.
 
+   Parameters:
+      query (str): The entity from the input query.
+      data (str): Text with information related to the query.
+      model (str): Model to use, defaults to "gpt-3.5-turbo".
+      knowledge_graph (KnowledgeGraph or None): Graph the entities and relationships are added to as they arrive.
 
-def text_to_json(data: str, max_tokens: int = 4096, model: str = "gpt-3.5-turbo"):
+   Yields:
+      dict: A relationship with 'src', 'relationship' and 'tgt' keys.
+   """
+   messages = relationships_directly_messages(query=query, data=data)
+   chunks = get_completion(messages=messages, model=model, stream=True)
+
+   try:
+      for rel in iter_relationships(chunks, query=query):
+         if knowledge_graph is not None:
+            knowledge_graph.add_entity(rel['src'])
+            knowledge_graph.add_entity(rel['tgt'])
+            knowledge_graph.add_relationship(rel['src'], rel['tgt'], rel['relationship'])
+         yield rel
+   finally:
+      chunks.close()
+
+
+async def astream_relationships_directly(query: str, data: str, model: str = "gpt-3.5-turbo", knowledge_graph=None):
+   """Async iterator version of stream_relationships_directly. The completion is consumed in a worker thread,
+   the knowledge graph (if given) is updated from the event loop. If the consumer stops early (break, aclose,
+   cancellation), the worker thread closes the stream after the relationship it is reading.
+
+   Parameters:
+      query (str): The entity from the input query.
+      data (str): Text with information related to the query.
+      model (str): Model to use, defaults to "gpt-3.5-turbo".
+      knowledge_graph (KnowledgeGraph or None): Graph the entities and relationships are added to as they arrive.
+
+   Yields:
+      dict: A relationship with 'src', 'relationship' and 'tgt' keys.
+   """
+   loop = asyncio.get_running_loop()
+   queue = asyncio.Queue()
+   done = object()
+   # Set when the consumer stops, the producer then stops reading the stream
+   stop = threading.Event()
+
+   def put(item):
+      if not stop.is_set():
+         loop.call_soon_threadsafe(queue.put_nowait, item)
+
+   def produce():
+      relationships = stream_relationships_directly(query=query, data=data, model=model)
+      try:
+         for rel in relationships:
+            if stop.is_set():
+               break
+            put(rel)
+      except Exception as ex:
+         put(ex)
+      finally:
+         relationships.close()
+         put(done)
+
+   producer = loop.run_in_executor(None, contextvars.copy_context().run, produce)
+
+   try:
+      while True:
+         item = await queue.get()
+         if item is done:
+            break
+         if isinstance(item, Exception):
+            raise item
+         if knowledge_graph is not None:
+            knowledge_graph.add_entity(item['src'])
+            knowledge_graph.add_entity(item['tgt'])
+            knowledge_graph.add_relationship(item['src'], item['tgt'], item['relationship'])
+         yield item
+   finally:
+      stop.set()
+
+   await producer
+
+
+# Approximate number of output tokens added to each relationship line by the conversion to JSON
+# ({"src": "", "relationship": "", "tgt": ""},) or to a Python tuple (("", "", ""),)
+JSON_TOKENS_PER_RELATIONSHIP = 20
+LIST_TOKENS_PER_RELATIONSHIP = 10
+
+
+class OutputTruncatedError(ValueError):
+   """The output of the model was cut at the token limit (finish_reason "length")."""
+
+
+def is_relationship(item) -> bool:
+   """Whether an item of a JSON conversion matches the {"src", "relationship", "tgt"} schema (non-empty strings)."""
+   return isinstance(item, dict) and all(isinstance(item.get(key), str) and item[key].strip() for key in ("src", "relationship", "tgt"))
+
+
+def conversion_batches(data: str, max_tokens: int, model: str = "gpt-3.5-turbo", tokens_per_line: int = JSON_TOKENS_PER_RELATIONSHIP, batch_lines: int = 25) -> list:
+   """Split the relationship lines of a text into batches of whole lines whose converted output should fit in max_tokens.
+
+   Parameters:
+      data (str): The relationships, one per line.
+      max_tokens (int): The output token limit of a conversion.
+      model (str): The model used to count the tokens.
+      tokens_per_line (int): Output tokens added to each line by the conversion.
+      batch_lines (int): Maximum number of lines per batch.
+
+   Returns:
+      list: The batches, lists of lines.
+   """
+   lines = [line for line in data.splitlines() if line.strip()]
+   # Keep a margin, the estimate of the output tokens is approximate
+   budget = max_tokens * 0.8
+   batches = []
+   batch = []
+   batch_tokens = 0
+   for line, tokens in zip(lines, num_tokens_batch(lines, model=model)):
+      tokens += tokens_per_line
+      if batch and (len(batch) >= batch_lines or batch_tokens + tokens > budget):
+         batches.append(batch)
+         batch = []
+         batch_tokens = 0
+      batch.append(line)
+      batch_tokens += tokens
+   if batch:
+      batches.append(batch)
+   return batches
+
+
+def convert_in_batches(data: str, convert, max_tokens: int, model: str = "gpt-3.5-turbo", tokens_per_line: int = JSON_TOKENS_PER_RELATIONSHIP, batch_lines: int = 25, max_workers: int = 4, max_retries: int = 2) -> list:
+   """Convert the relationship lines of a text with an LLM in line-aligned batches (see conversion_batches), converted
+   concurrently and merged in order. Only the batches that fail (error, output that doesn't validate) are retried,
+   a batch whose output was truncated is split in two. The batches still failing after the retries are skipped with a
+   warning, unless all of them failed.
+
+   Parameters:
+      data (str): The relationships, one per line.
+      convert (callable): Converts a batch (str) to a list of relationships, raises on invalid output. Called with
+         retry=True for the retries (the cached completion must then be replaced).
+      max_tokens (int): The output token limit of a conversion.
+      model (str): The model used to count the tokens.
+      tokens_per_line (int): Output tokens added to each line by the conversion.
+      batch_lines (int): Maximum number of lines per batch.
+      max_workers (int): Maximum number of batches converted concurrently.
+      max_retries (int): Number of times the failed batches are retried.
+
+   Returns:
+      list: The converted relationships.
+   """
+   pending = list(enumerate(conversion_batches(data, max_tokens, model=model, tokens_per_line=tokens_per_line, batch_lines=batch_lines)))
+   # Converted relationships by position of the batch, retried halves get a sub-position so that the order is kept
+   results = {}
+   error = None
+
+   for attempt in range(max_retries + 1):
+      if not pending:
+         break
+      with ThreadPoolExecutor(max_workers=max_workers) as executor:
+         # Each batch runs in a copy of the caller's context, so its token usage is tracked (see track_token_usage)
+         futures = [(position, batch, executor.submit(contextvars.copy_context().run, convert, "\n".join(batch), attempt > 0)) for position, batch in pending]
+
+      pending = []
+      for position, batch, future in futures:
+         try:
+            results[position] = future.result()
+         except OutputTruncatedError as exception:
+            error = exception
+            if len(batch) > 1:
+               half = len(batch) // 2
+               pending += [((position, 0), batch[:half]), ((position, 1), batch[half:])]
+            else:
+               pending.append((position, batch))
+         except Exception as exception:
+            error = exception
+            pending.append((position, batch))
+
+   current_span().set("failed_batches", len(pending))
+   if pending:
+      if not results:
+         raise error
+      warnings.warn(f"{len(pending)} batches of relationships could not be converted: {error!r}")
+
+   return [rel for position in sorted(results, key=batch_order) for rel in results[position]]
+
+
+def batch_order(position) -> tuple:
+   # Positions are batch indices, nested in tuples for the halves of split batches: 3 < (3, 0) < (3, 1) < 4
+   return (position,) if isinstance(position, int) else batch_order(position[0]) + position[1:]
+
+
+@traced()
+def parse_relationships_text(data: str, query: str = None, max_tokens: int = 4096, model: str = "gpt-3.5-turbo"):
+   """Parse the relationships returned by the model locally, only the lines that can't be parsed are sent to an LLM.
+
+   Parameters:
+      data (str): Text with the relationships, one per line in the format "{query} - relationship - entity".
+      query (str or None): The query entity, helps parsing entities containing dashes.
+      max_tokens (int): Maximum number of tokens for the LLM.
+      model (str): Model used for the lines that can't be parsed locally.
+
+   Returns:
+      tuple: The list of relationships (dicts with 'src', 'relationship' and 'tgt' keys) and the ParseResult of the local
+         parser, reporting the parse coverage.
+   """
+   result = parse_relationships(data, query=query)
+   relationships = list(result.relationships)
+   current_span().set("unparsed_lines", len(result.unparsed))
+
+   if result.unparsed:
+      converted = json.loads(text_to_json_llm('\n'.join(result.unparsed), max_tokens=max_tokens, model=model))
+      relationships += converted.get("relationships", [])
+
+   return relationships, result
+
+
+@traced()
+def text_to_json(data: str, max_tokens: int = 4096, model: str = "gpt-3.5-turbo", query: str = None, local_parse: bool = True):
+   """Transform text returned from the model, i.e. the relationships, into a JSON string.
+   The relationships are parsed locally, the LLM is only used for the lines that can't be parsed (see parse_relationships_text).
+
+   Parameters:
+      data (str): Text to transform.
+      max_tokens (int): Maximum number of tokens for the LLM.
+      model (str): Model to use, defaults to "gpt-3.5-turbo".
+      query (str or None): The query entity, helps parsing entities containing dashes.
+      local_parse (bool): Set to False to convert the whole text with the LLM.
+
+   Returns:
+      str: The transformed text as a JSON string.
+   """
+   if not local_parse:
+      return text_to_json_llm(data, max_tokens=max_tokens, model=model)
+
+   relationships, _ = parse_relationships_text(data, query=query, max_tokens=max_tokens, model=model)
+   return json.dumps({"relationships": relationships})
+
+
+@traced()
+def text_to_json_llm(data: str, max_tokens: int = 4096, model: str = "gpt-3.5-turbo", batch_lines: int = 25, max_workers: int = 4, max_retries: int = 2):
    """Transform text returned from the model, i.e. the relationships, into a JSON string using an LLM.
+   The lines are converted in concurrent batches (see convert_in_batches), so long lists are neither truncated nor
+   converted serially.
 
    Parameters:
       data (str): Text to transform.
       max_tokens (int): Maximum number of tokens for the LLM.
       model (str): Model to use, defaults to "gpt-3.5-turbo".
+      batch_lines (int): Maximum number of lines converted per request.
+      max_workers (int): Maximum number of batches converted concurrently.
+      max_retries (int): Number of times the failed batches are retried.
 
    Returns:
       str: The transformed text as a JSON string.
    """
-   def get_first_n_lines(str: str, n: int):
-      return '\n'.join(str.splitlines()[:n])
-   
    # Constructing the System message:
    msg_system = """You will be provided with a list of relationships. Convert the list of relationships into a JSON object:"""
    # schema:
@@ -164,47 +685,66 @@ def text_to_json(data: str, max_tokens: int = 4096, model: str = "gpt-3.5-turbo"
    msg_system += """\n\nschema:\n{\n "relationships": {\"src\", \"relationship\", \"tgt\"}[]\n}"""
    msg_system += """\n\nReturn a JSON object."""
 
-   # Prompt
-   msg_list = data
-
-   messages=[
-      {"role": "system", "content": msg_system},
-      {"role": "user", "content": msg_list}
-   ]
-
-   # enable JSON mode - the model is constrained to only generate strings that parse into valid JSON object
-   completion = get_completion(
-      messages=messages, 
-      model=model, 
-      max_tokens=max_tokens, 
-      response_format={"type": "json_object"}
-   )
-
-   # Check if the model output token limit is exceeded. If so re-run the convertion
-   if completion.finish_reason == "length":
-      # Get the first 20 connections if the output exceeds the model token limit
-      msg_list = get_first_n_lines(data, 20)
+   def convert(batch: str, retry: bool) -> list:
       messages=[
          {"role": "system", "content": msg_system},
-         {"role": "user", "content": msg_list}
+         {"role": "user", "content": batch}
       ]
+
+      # enable JSON mode - the model is constrained to only generate strings that parse into valid JSON object
       completion = get_completion(
          messages=messages, 
          model=model, 
          max_tokens=max_tokens, 
-         response_format={"type": "json_object"}
+         response_format={"type": "json_object"},
+         refresh_cache=retry
       )
+      if completion.finish_reason == "length":
+         raise OutputTruncatedError("The JSON output exceeds the token limit")
+
+      relationships = json.loads(completion.message.content).get("relationships")
+      if not isinstance(relationships, list) or not all(is_relationship(rel) for rel in relationships):
+         raise ValueError("The JSON output doesn't match the schema")
+      return relationships
 
-   return completion.message.content
+   relationships = convert_in_batches(data, convert, max_tokens=max_tokens, model=model, tokens_per_line=JSON_TOKENS_PER_RELATIONSHIP, batch_lines=batch_lines, max_workers=max_workers, max_retries=max_retries)
+   return json.dumps({"relationships": relationships})
 
 
-def text_to_list(data: str, max_tokens: int = 4096, model: str = "gpt-3.5-turbo"):
+@traced()
+def text_to_list(data: str, max_tokens: int = 4096, model: str = "gpt-3.5-turbo", query: str = None, local_parse: bool = True):
+   """Transform text from the model, i.e. the relationships, into a list of tuples.
+   The relationships are parsed locally, the LLM is only used for the lines that can't be parsed (see parse_relationships_text).
+
+   Parameters:
+      data (str): Text to transform.
+      max_tokens (int): Maximum number of tokens for the LLM.
+      model (str): Model to use, defaults to "gpt-3.5-turbo".
+      query (str or None): The query entity, helps parsing entities containing dashes.
+      local_parse (bool): Set to False to convert the whole text with the LLM.
+
+   Returns:
+      list: The transformed text as a list of tuples.
+   """
+   if not local_parse:
+      return text_to_list_llm(data, max_tokens=max_tokens, model=model)
+
+   relationships, _ = parse_relationships_text(data, query=query, max_tokens=max_tokens, model=model)
+   return [(rel['src'], rel['relationship'], rel['tgt']) for rel in relationships]
+
+
+@traced()
+def text_to_list_llm(data: str, max_tokens: int = 4096, model: str = "gpt-3.5-turbo", batch_lines: int = 25, max_workers: int = 4, max_retries: int = 2):
    """Transform text from the model, i.e. the relationships, into a list of tuples using an LLM.
+   The lines are converted in concurrent batches, see convert_in_batches.
 
    Parameters:
       data (str): Text to transform.
       max_tokens (int): Maximum number of tokens for the LLM.
       model (str): Model to use, defaults to "gpt-3.5-turbo".
+      batch_lines (int): Maximum number of lines converted per request.
+      max_workers (int): Maximum number of batches converted concurrently.
+      max_retries (int): Number of times the failed batches are retried.
 
    Returns:
       list: The transformed text as a list of tuples.
@@ -213,32 +753,35 @@ def text_to_list(data: str, max_tokens: int = 4096, model: str = "gpt-3.5-turbo"
    msg_system = """You will be provided with a list of relationships. Convert the list of relationships into a list of tuples. Each tuple should have 3 elements of type string."""
    msg_system += """ Only output a Python list."""
 
-   # Prompt
-   msg_list = data
-
-   messages=[
-      {"role": "system", "content": msg_system},
-      {"role": "user", "content": msg_list}
-   ]
-
-   completion = get_completion(
-      messages=messages, 
-      model=model, 
-      max_tokens=max_tokens
-   )
-
-   # Parse and clean the LLM output
-   relationships = completion.message.content
-   try:
-      # Remove substrings around Python code and parse the output
-      relationships = relationships.replace("```python", "").replace("```", "").strip()
-      relationships = ast.literal_eval(relationships)
+   def convert(batch: str, retry: bool) -> list:
+      messages=[
+         {"role": "system", "content": msg_system},
+         {"role": "user", "content": batch}
+      ]
 
-      # Validate that the parsed output is indeed a list
+      completion = get_completion(
+         messages=messages, 
+         model=model, 
+         max_tokens=max_tokens,
+         refresh_cache=retry
+      )
+      if completion.finish_reason == "length":
+         raise OutputTruncatedError("The list output exceeds the token limit")
+
+      # Parse and clean the LLM output
+      relationships = completion.message.content
+      try:
+         # Remove substrings around Python code and parse the output
+         relationships = relationships.replace("```python", "").replace("```", "").strip()
+         relationships = ast.literal_eval(relationships)
+      except (ValueError, SyntaxError) as e:
+         raise ValueError("Failed to parse LLM output into a Python list.") from e
+
+      # Validate that the parsed output is indeed a list of 3-tuples of strings
       if not isinstance(relationships, list):
          raise ValueError("Parsed output is not a list.")
-      
-      return relationships
-   except (ValueError, SyntaxError) as e:
-      raise ValueError("Failed to parse LLM output into a Python list.") from e
+      if not all(isinstance(rel, (tuple, list)) and len(rel) == 3 and all(isinstance(item, str) for item in rel) for rel in relationships):
+         raise ValueError("Parsed output is not a list of 3-tuples of strings.")
+      return [tuple(rel) for rel in relationships]
 
+   return convert_in_batches(data, convert, max_tokens=max_tokens, model=model, tokens_per_line=LIST_TOKENS_PER_RELATIONSHIP, batch_lines=batch_lines, max_workers=max_workers, max_retries=max_retries)
@@ -1,48 +1,181 @@
 # Helper functions to find the length in tokens of a query before calling the OpenAI API
 
+from functools import lru_cache
 import tiktoken
+import os
 
-def num_tokens_str(string: str, model: str = "gpt-4"):
+# Tokens of the wrapper of every message: <im_start>{role/name}\n{content}<im_end>\n
+TOKENS_PER_MESSAGE = 4
+# Every reply is primed with <im_start>assistant
+TOKENS_PER_REPLY = 2
+# Average number of UTF-8 bytes per token of English text, used by the estimates
+BYTES_PER_TOKEN = 4
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model: str = "gpt-4"):
+   """The encoding of a model, loaded once per model.
+
+   Parameters:
+      model (str): The model name.
+
+   Returns:
+      tiktoken.Encoding: The encoding of the model, 'cl100k_base' if the model is unknown.
+   """
+   try:
+      return tiktoken.encoding_for_model(model)
+   except KeyError:
+      # default to 'cl100k_base' encoding on failure
+      return tiktoken.get_encoding("cl100k_base")
+
+
+@lru_cache(maxsize=1024)
+def num_tokens_cached(value: str, model: str = "gpt-4") -> int:
+   """Number of tokens of a message value, memoized: the roles and the messages of a context that is sent again with
+   every request (and counted for the rate limiter each time) are only encoded once."""
+   return len(get_encoding(model).encode(value))
+
+
+def estimate_tokens(string: str) -> int:
+   """Cheap upper-leaning estimate of the number of tokens of a string, without encoding it (one token per
+   BYTES_PER_TOKEN UTF-8 bytes). Good enough for budget checks, not for exact limits."""
+   return -(-len(string.encode("utf-8")) // BYTES_PER_TOKEN)
+
+
+def num_tokens_str(string: str, model: str = "gpt-4", estimate: bool = False):
    """Calculate the number of tokens in a text string.
-   
+
    Parameters:
       string (str): The input text to tokenize.
       model (str): The model used for encoding, default is 'gpt-4'.
+      estimate (bool): Estimate the number of tokens from the length of the string instead of encoding it.
 
    Returns:
       int: The number of tokens in the input string.
    """
-   try:
-      encoding = tiktoken.encoding_for_model(model)
-   except KeyError:
-      # default to 'cl100k_base' encoding on failure
-      encoding = tiktoken.get_encoding("cl100k_base")
+   if estimate:
+      return estimate_tokens(string)
+   return len(get_encoding(model).encode(string))
+
+
+def num_tokens_message(message: dict, model: str = "gpt-4", estimate: bool = False) -> int:
+   """Number of tokens of a message, including its wrapper."""
+   if estimate:
+      return TOKENS_PER_MESSAGE + sum(estimate_tokens(value) for value in message.values())
+   return TOKENS_PER_MESSAGE + sum(num_tokens_cached(value, model) for value in message.values())
 
-   num_tokens = len(encoding.encode(string))
-   return num_tokens
 
-def num_tokens_chat(messages: list, model: str ="gpt-4"):
+def num_tokens_chat(messages: list, model: str ="gpt-4", estimate: bool = False):
    """Calculate approximately the number of tokens in a list of messages.
-   
+
    Parameters:
       messages (list): A list of message dictionaries with 'role' and 'content'.
       model (str): The model used for encoding, default is 'gpt-4'.
+      estimate (bool): Estimate the number of tokens from the length of the strings instead of encoding them.
 
    Returns:
       int: The approximate total number of tokens across all messages.
    """
-   try:
-      encoding = tiktoken.encoding_for_model(model)
-   except KeyError:
-      # default to 'cl100k_base' encoding on failure
-      encoding = tiktoken.get_encoding("cl100k_base")
+   return sum(num_tokens_message(message, model, estimate) for message in messages) + TOKENS_PER_REPLY
+
+
+def num_tokens_batch(strings: list, model: str = "gpt-4", num_threads: int = None) -> list:
+   """Calculate the number of tokens of many strings at once, encoded in parallel threads by tiktoken
+   (the encoder releases the GIL).
+
+   Parameters:
+      strings (list): The strings.
+      model (str): The model used for encoding.
+      num_threads (int or None): Number of threads of the encoder, the number of CPUs (at most 8) by default.
+         Threads only add overhead on a single CPU, the strings are then encoded in a loop.
+
+   Returns:
+      list: The number of tokens of each string, same as num_tokens_str.
+   """
+   encoding = get_encoding(model)
+   num_threads = num_threads or min(8, os.cpu_count() or 1)
+   if num_threads < 2 or len(strings) < 2:
+      return [len(encoding.encode(string)) for string in strings]
+   return [len(tokens) for tokens in encoding.encode_batch(list(strings), num_threads=num_threads)]
+
+
+def num_tokens_chat_batch(conversations: list, model: str = "gpt-4", num_threads: int = None) -> list:
+   """Calculate the number of tokens of many lists of messages at once. The long values of all the messages are
+   encoded in one batch, the short ones (roles, names) are memoized.
+
+   Parameters:
+      conversations (list): The lists of messages.
+      model (str): The model used for encoding.
+      num_threads (int or None): Number of threads of the encoder, see num_tokens_batch.
+
+   Returns:
+      list: The number of tokens of each list of messages, same as num_tokens_chat.
+   """
+   totals = []
+   long_values = []
+   owners = []
+   for i, messages in enumerate(conversations):
+      total = TOKENS_PER_REPLY
+      for message in messages:
+         total += TOKENS_PER_MESSAGE
+         for value in message.values():
+            if len(value) <= 16:
+               total += num_tokens_cached(value, model)
+            else:
+               long_values.append(value)
+               owners.append(i)
+      totals.append(total)
+
+   for i, tokens in zip(owners, num_tokens_batch(long_values, model=model, num_threads=num_threads)):
+      totals[i] += tokens
+   return totals
+
+
+class ChatTokenCounter:
+   """Token count of a conversation that grows by appending messages (e.g. a context passed from one extraction step
+   to the next): each message is encoded once, when it is appended.
+
+   `counter = ChatTokenCounter(messages, model); counter.append(message); counter.total`
+   """
+
+   def __init__(self, messages: list = (), model: str = "gpt-4", estimate: bool = False):
+      """
+      Parameters:
+         messages (list): The initial messages.
+         model (str): The model used for encoding.
+         estimate (bool): Estimate the number of tokens instead of encoding the messages.
+      """
+      self.model = model
+      self.estimate = estimate
+      self.messages = []
+      self.tokens = 0
+      self.extend(messages)
+
+   def append(self, message: dict) -> int:
+      """Add a message, return the new total."""
+      self.messages.append(message)
+      self.tokens += num_tokens_message(message, self.model, self.estimate)
+      return self.total
+
+   def extend(self, messages: list) -> int:
+      for message in messages:
+         self.append(message)
+      return self.total
+
+   def sync(self, messages: list) -> int:
+      """Count a list of messages that starts with the messages already counted (compared by identity), only the new
+      ones are encoded. The count restarts from scratch if the list doesn't extend the counted messages."""
+      counted = len(self.messages)
+      if len(messages) < counted or any(a is not b for a, b in zip(messages, self.messages)):
+         self.messages = []
+         self.tokens = 0
+         counted = 0
+      return self.extend(messages[counted:])
 
-   num_tokens = 0
-   for message in messages:
-      # Add tokens for the message wrapper and content.
-      num_tokens += 4  # Every message follows <im_start>{role/name}\n{content}<im_end>\n
-      for key, value in message.items():
-         num_tokens += len(encoding.encode(value))
+   @property
+   def total(self) -> int:
+      """Number of tokens of the conversation, same as num_tokens_chat of its messages."""
+      return self.tokens + TOKENS_PER_REPLY
 
-   num_tokens += 2  # Every reply is primed with <im_start>assistant
-   return num_tokens
+   def __len__(self):
+      return len(self.messages)
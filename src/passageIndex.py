@@ -0,0 +1,305 @@
+# Index of text passages embedded as vectors, to send only the passages most relevant to an entity to the model
+
+from numTokens import num_tokens_batch
+from chunking import split_text
+from clients import get_openai_client
+import numpy as np
+import threading
+import zlib
+import json
+import re
+import os
+
+WORD = re.compile(r"\w+")
+
+
+class HashingEmbedder:
+   """Local embedder (no model, no network): the words and word bigrams of a text are hashed into a fixed number of
+   signed buckets, with sublinear term frequencies. Texts sharing rare words and phrases get similar vectors.
+   Any callable mapping a list of texts to a 2D array can be used instead, e.g. OpenAIEmbedder."""
+
+   def __init__(self, dim: int = 2048, ngrams: int = 2):
+      """
+      Parameters:
+         dim (int): Number of dimensions of the vectors.
+         ngrams (int): Longest word n-grams hashed (1 for words only).
+      """
+      self.dim = dim
+      self.ngrams = ngrams
+
+   def features(self, text: str) -> list:
+      words = WORD.findall(text.casefold())
+      features = [zlib.crc32(word.encode("utf-8")) for word in words]
+      for n in range(2, self.ngrams + 1):
+         features += [zlib.crc32(" ".join(words[i:i + n]).encode("utf-8")) for i in range(len(words) - n + 1)]
+      return features
+
+   def __call__(self, texts: list) -> np.ndarray:
+      """Embed texts.
+
+      Parameters:
+         texts (list): The texts.
+
+      Returns:
+         np.ndarray: The vectors, shape (len(texts), dim), float32.
+      """
+      hashes = [self.features(text) for text in texts]
+      rows = np.repeat(np.arange(len(texts)), [len(features) for features in hashes])
+      hashes = np.fromiter((h for features in hashes for h in features), dtype=np.uint64, count=len(rows))
+      # The lowest bits select the bucket, the highest bit the sign (so that collisions tend to cancel out)
+      buckets = (hashes % self.dim).astype(np.int64)
+      signs = np.where(hashes >> np.uint64(31), -1.0, 1.0)
+      counts = np.bincount(rows * self.dim + buckets, weights=signs, minlength=len(texts) * self.dim).reshape(len(texts), self.dim)
+      return (np.sign(counts) * np.log1p(np.abs(counts))).astype(np.float32)
+
+
+class OpenAIEmbedder:
+   """Embedder using the OpenAI embeddings API, e.g. `PassageIndex(embedder=OpenAIEmbedder())`."""
+
+   def __init__(self, model: str = "text-embedding-3-small", client=None, batch_size: int = 256):
+      """
+      Parameters:
+         model (str): The embedding model.
+         client (OpenAI or None): The client, the shared client (clients.get_openai_client) if None.
+         batch_size (int): Number of texts embedded per request.
+      """
+      self.model = model
+      self.client = client
+      self.batch_size = batch_size
+
+   def __call__(self, texts: list) -> np.ndarray:
+      client = self.client or get_openai_client()
+      vectors = []
+      for start in range(0, len(texts), self.batch_size):
+         response = client.embeddings.create(model=self.model, input=texts[start:start + self.batch_size])
+         vectors += [item.embedding for item in response.data]
+      return np.array(vectors, dtype=np.float32)
+
+
+def normalize_rows(vectors: np.ndarray) -> np.ndarray:
+   """Scale the rows to unit length (zero rows are left as is), so that dot products are cosine similarities."""
+   norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+   return vectors / np.maximum(norms, 1e-12)
+
+
+class PassageIndex:
+   """Passages of text (chunks of retrieved or scraped text) and their normalized embeddings, stored in one contiguous
+   matrix, so that a top-k cosine search is a single matrix-vector product. The matrix grows by doubling its capacity.
+
+   With a path, the index is persisted in a directory: the vectors in a memory-mapped .npy file (the corpus doesn't
+   have to fit in memory) and the passages in a JSONL file, appended as they are added. Thread-safe."""
+
+   def __init__(self, embedder=None, path: str = None, passage_tokens: int = 128, model: str = "gpt-4", initial_capacity: int = 1024, batch_size: int = 1024):
+      """
+      Parameters:
+         embedder (callable or None): Maps a list of texts to their vectors, HashingEmbedder() by default. Must not
+            change for a persisted index.
+         path (str or None): Directory of the persisted index, loaded if it exists.
+         passage_tokens (int): Maximum number of tokens of the passages the added texts are split into.
+         model (str): The model used to count the tokens.
+         initial_capacity (int): Number of vectors allocated at first.
+         batch_size (int): Number of passages embedded at once.
+      """
+      self.embedder = embedder or HashingEmbedder()
+      self.path = path
+      self.passage_tokens = passage_tokens
+      self.model = model
+      self.initial_capacity = initial_capacity
+      self.batch_size = batch_size
+      self.passages = []
+      self.sources = []
+      self.size = 0
+      self.__matrix = None
+      self.__lock = threading.Lock()
+
+      if path is not None:
+         os.makedirs(path, exist_ok=True)
+         self.__load()
+
+   @property
+   def vectors(self) -> np.ndarray:
+      """The normalized vectors of the passages, shape (number of passages, dim)."""
+      if self.__matrix is None:
+         return np.zeros((0, 0), dtype=np.float32)
+      return self.__matrix[:self.size]
+
+   def __files(self) -> tuple:
+      return os.path.join(self.path, "vectors.npy"), os.path.join(self.path, "passages.jsonl")
+
+   def __load(self):
+      vectors_path, passages_path = self.__files()
+      if not os.path.exists(passages_path):
+         return
+      with open(passages_path, encoding="utf-8") as file:
+         for line in file:
+            try:
+               item = json.loads(line)
+            except ValueError:
+               # A crash while writing can leave a partial last line, the passage is lost
+               break
+            self.passages.append(item["text"])
+            self.sources.append(item["source"])
+      if self.passages:
+         self.__matrix = np.load(vectors_path, mmap_mode="r+")
+         # The vectors are written before the passages, a crash can only leave extra vectors
+         self.size = len(self.passages)
+
+   def __reserve(self, count: int, dim: int):
+      # Grow the matrix to hold count more vectors (doubling its capacity)
+      needed = self.size + count
+      if self.__matrix is not None and needed <= self.__matrix.shape[0]:
+         return
+      capacity = max(self.initial_capacity, needed, 2 * (self.__matrix.shape[0] if self.__matrix is not None else 0))
+
+      if self.path is None:
+         matrix = np.zeros((capacity, dim), dtype=np.float32)
+      else:
+         vectors_path, _ = self.__files()
+         temporary_path = vectors_path + ".tmp"
+         matrix = np.lib.format.open_memmap(temporary_path, mode="w+", dtype=np.float32, shape=(capacity, dim))
+      if self.size:
+         matrix[:self.size] = self.__matrix[:self.size]
+
+      if self.path is not None:
+         matrix.flush()
+         del matrix
+         os.replace(temporary_path, vectors_path)
+         matrix = np.load(vectors_path, mmap_mode="r+")
+      self.__matrix = matrix
+
+   def add_passages(self, passages: list, source: str = None) -> int:
+      """Add passages as they are (not chunked).
+
+      Parameters:
+         passages (list): The passages.
+         source (str or None): Where the passages come from, e.g. the entity or the URL.
+
+      Returns:
+         int: The number of passages added.
+      """
+      passages = [passage for passage in passages if passage.strip()]
+      for start in range(0, len(passages), self.batch_size):
+         self.__add(passages[start:start + self.batch_size], source)
+      return len(passages)
+
+   def __add(self, passages: list, source: str):
+      vectors = normalize_rows(np.asarray(self.embedder(passages), dtype=np.float32))
+
+      with self.__lock:
+         if self.__matrix is not None and vectors.shape[1] != self.__matrix.shape[1]:
+            raise ValueError(f"The embedder returned {vectors.shape[1]} dimensions, the index has {self.__matrix.shape[1]}")
+         self.__reserve(len(passages), vectors.shape[1])
+         self.__matrix[self.size:self.size + len(passages)] = vectors
+
+         if self.path is not None:
+            self.__matrix.flush()
+            _, passages_path = self.__files()
+            with open(passages_path, "a", encoding="utf-8") as file:
+               file.writelines(json.dumps({"text": passage, "source": source}) + "\n" for passage in passages)
+
+         self.passages += passages
+         self.sources += [source] * len(passages)
+         self.size += len(passages)
+
+   def add_text(self, text: str, source: str = None, separator: str = "\n\n") -> int:
+      """Split a text (e.g. returned by dataRetrieval.retrieve_data, or a scraped page) into passages and add them:
+      one passage per snippet, snippets longer than passage_tokens are split on sentence boundaries.
+
+      Parameters:
+         text (str): The text.
+         source (str or None): Where the text comes from.
+         separator (str): The separator between the snippets of the text.
+
+      Returns:
+         int: The number of passages added.
+      """
+      return self.add_passages(split_text(text, max_tokens=self.passage_tokens, model=self.model, separator=separator), source=source)
+
+   def search(self, query: str, k: int = 5, source: str = None) -> list:
+      """Find the passages most similar to a query (cosine similarity of the embeddings).
+
+      Parameters:
+         query (str): The query, e.g. the entity.
+         k (int): Number of passages returned.
+         source (str or None): Only search the passages of this source.
+
+      Returns:
+         list: The passages as (score, passage, source) tuples, the most similar first.
+      """
+      return self.search_many([query], k=k, source=source)[0]
+
+   def search_many(self, queries: list, k: int = 5, source: str = None) -> list:
+      """Find the passages most similar to each of several queries, with a single matrix product.
+
+      Returns:
+         list: For each query, a list of (score, passage, source) tuples, the most similar first.
+      """
+      with self.__lock:
+         vectors = self.vectors
+         size = self.size
+      if size == 0:
+         return [[] for _ in queries]
+
+      scores = normalize_rows(np.asarray(self.embedder(queries), dtype=np.float32)) @ vectors.T
+      if source is not None:
+         scores[:, [i for i in range(size) if self.sources[i] != source]] = -np.inf
+
+      results = []
+      for row in scores:
+         count = min(k, int(np.isfinite(row).sum()))
+         top = np.argpartition(-row, count - 1)[:count] if 0 < count < size else np.flatnonzero(np.isfinite(row))
+         top = top[np.argsort(-row[top], kind="stable")]
+         results.append([(float(row[i]), self.passages[i], self.sources[i]) for i in top])
+      return results
+
+   def select(self, query: str, max_tokens: int, source: str = None, candidates: int = 100, separator_tokens: int = 0) -> list:
+      """The passages most similar to a query that fit in a token budget.
+
+      Parameters:
+         query (str): The query, e.g. the entity.
+         max_tokens (int): The token budget of the passages.
+         source (str or None): Only select passages of this source.
+         candidates (int): Number of most similar passages considered.
+         separator_tokens (int): Number of tokens of the separator between the passages, counted in the budget.
+
+      Returns:
+         list: The passages, the most similar first.
+      """
+      results = self.search(query, k=candidates, source=source)
+      # Identical passages (e.g. the same snippet retrieved for several entities) are only selected once
+      passages = list(dict.fromkeys(passage for _, passage, _ in results))
+      selected = []
+      total = 0
+      for passage, tokens in zip(passages, num_tokens_batch(passages, model=self.model)):
+         tokens += separator_tokens if selected else 0
+         if total + tokens <= max_tokens:
+            selected.append(passage)
+            total += tokens
+      return selected
+
+   def __len__(self):
+      return self.size
+
+
+def relevant_text(query: str, data: str, max_tokens: int, index: PassageIndex = None, separator: str = "\n\n") -> str:
+   """Reduce a retrieved text to its passages most relevant to the query, within a token budget.
+
+   Parameters:
+      query (str): The entity.
+      data (str): The text, e.g. returned by dataRetrieval.retrieve_data.
+      max_tokens (int): The token budget.
+      index (PassageIndex or None): Index the text is added to (with the query as source), the passages are then
+         selected among all the passages of the index, including texts added earlier (e.g. scraped pages). A temporary
+         index of the text is used if None.
+      separator (str): The separator between the passages.
+
+   Returns:
+      str: The selected passages, or the whole text if it fits in the budget and no index is given.
+   """
+   if index is None:
+      index = PassageIndex()
+      if num_tokens_batch([data], model=index.model)[0] <= max_tokens:
+         return data
+   index.add_text(data, source=query, separator=separator)
+   separator_tokens = num_tokens_batch([separator], model=index.model)[0]
+   return separator.join(index.select(query, max_tokens=max_tokens, separator_tokens=separator_tokens))
@@ -0,0 +1,125 @@
+# Token-bucket rate limiting with adaptive backoff for API calls
+
+from tracing import current_span
+import threading
+import random
+import time
+
+
+def is_rate_limit_error(ex: Exception) -> bool:
+   """Check if an exception is a HTTP 429 (Too Many Requests) error from OpenAI, requests or httpx."""
+   status_code = getattr(ex, "status_code", None)
+   if status_code is None:
+      status_code = getattr(getattr(ex, "response", None), "status_code", None)
+   return status_code == 429
+
+
+class TokenBucket:
+   """Bucket refilled continuously at `rate` units per second, holding at most `capacity` units."""
+
+   def __init__(self, capacity: float, rate: float):
+      self.capacity = capacity
+      self.rate = rate
+      self.level = capacity
+      self.updated_at = time.monotonic()
+
+   def refill(self, now: float):
+      self.level = min(self.capacity, self.level + (now - self.updated_at) * self.rate)
+      self.updated_at = now
+
+   def wait_time(self, amount: float) -> float:
+      """Seconds until `amount` units are available (amounts over the capacity are clamped)."""
+      missing = min(amount, self.capacity) - self.level
+      return max(0.0, missing / self.rate)
+
+   def take(self, amount: float):
+      self.level -= min(amount, self.capacity)
+
+
+class RateLimiter:
+   """Limit the requests and tokens per minute of the calls made through it.
+   On a 429 response the call is retried with exponential backoff and the allowed rate is reduced,
+   it then recovers gradually with each successful call."""
+
+   def __init__(self, requests_per_minute: float = None, tokens_per_minute: float = None, max_retries: int = 6, initial_backoff: float = 1.0, max_backoff: float = 60.0, min_rate_factor: float = 0.1):
+      """
+      Parameters:
+         requests_per_minute (float or None): Maximum number of requests per minute, unlimited if None.
+         tokens_per_minute (float or None): Maximum number of tokens per minute, unlimited if None.
+         max_retries (int): Maximum number of retries of a rate limited call.
+         initial_backoff (float): Seconds to wait after the first 429, doubled on every retry.
+         max_backoff (float): Maximum seconds to wait between retries.
+         min_rate_factor (float): Lower bound of the fraction of the configured rates used after 429s.
+      """
+      self.max_retries = max_retries
+      self.initial_backoff = initial_backoff
+      self.max_backoff = max_backoff
+      self.min_rate_factor = min_rate_factor
+      self.rate_factor = 1.0
+      self.retries = 0
+      self.__lock = threading.Lock()
+      self.__buckets = {}
+      if requests_per_minute:
+         self.__buckets["requests"] = TokenBucket(requests_per_minute, requests_per_minute / 60)
+      if tokens_per_minute:
+         self.__buckets["tokens"] = TokenBucket(tokens_per_minute, tokens_per_minute / 60)
+      self.__rates = {name: bucket.rate for name, bucket in self.__buckets.items()}
+
+   def __set_rate_factor(self, rate_factor: float):
+      self.rate_factor = min(1.0, max(self.min_rate_factor, rate_factor))
+      for name, bucket in self.__buckets.items():
+         bucket.rate = self.__rates[name] * self.rate_factor
+
+   def acquire(self, tokens: int = 0):
+      """Block until a request using `tokens` tokens is allowed.
+
+      Parameters:
+         tokens (int): The number of tokens of the request, e.g. from numTokens.num_tokens_chat plus max_tokens.
+      """
+      amounts = {"requests": 1, "tokens": tokens}
+      while True:
+         with self.__lock:
+            now = time.monotonic()
+            wait = 0.0
+            for name, bucket in self.__buckets.items():
+               bucket.refill(now)
+               wait = max(wait, bucket.wait_time(amounts[name]))
+            if wait == 0.0:
+               for name, bucket in self.__buckets.items():
+                  bucket.take(amounts[name])
+               return
+         time.sleep(wait)
+
+   def call(self, function, tokens: int = 0):
+      """Call `function` once the rate limits allow it, retrying with backoff on 429 errors.
+
+      Parameters:
+         function (callable): The API call, without arguments.
+         tokens (int): The number of tokens of the request.
+
+      Returns:
+         The result of the function.
+      """
+      trace = current_span()
+      for attempt in range(self.max_retries + 1):
+         start = time.monotonic()
+         self.acquire(tokens)
+         trace.add("rate_limit_wait_s", time.monotonic() - start)
+         try:
+            result = function()
+         except Exception as ex:
+            if not is_rate_limit_error(ex) or attempt == self.max_retries:
+               raise
+            # Slow down every caller sharing the limiter, then wait before retrying (with jitter)
+            with self.__lock:
+               self.retries += 1
+               self.__set_rate_factor(self.rate_factor / 2)
+            trace.add("retries")
+            backoff = min(self.max_backoff, self.initial_backoff * 2 ** attempt)
+            time.sleep(backoff * random.uniform(0.5, 1.0))
+            continue
+
+         with self.__lock:
+            if self.rate_factor < 1.0:
+               self.__set_rate_factor(self.rate_factor * 1.1)
+         return result
@@ -0,0 +1,162 @@
+# Local parser of the relationships returned by the model in the "{query} - relationship - entity" format
+
+import re
+
+# List markers: "1.", "1)", "(1)", "-", "*", "•"
+LIST_MARKER = re.compile(r"^(?:\d+[.)]|\(\d+\)|[-*•·])\s+")
+# Separators: en/em dashes and arrows (spaces optional), hyphens and pipes (surrounded by spaces)
+SEPARATOR = re.compile(r"\s*(?:[–—→]|->|=>)\s*|\s+(?:-{1,2}|\|)\s+")
+# Characters stripped around an element of a relationship (and trailing punctuation of a line)
+STRIP_CHARS = " \t\"'`*_,;"
+# Last words whose period is part of the entity name, e.g. "X Corp.", rather than the end of a sentence
+ABBREVIATIONS = {"inc", "corp", "co", "ltd", "plc", "llc", "bros", "jr", "sr", "st", "mt", "dr", "prof", "no", "vs", "etc"}
+# Initials and initialisms ending with a period, e.g. "John F." or "U.S."
+INITIALISM = re.compile(r"(?:^|\s)[A-Za-z](?:\.[A-Za-z])*\.$")
+
+
+class ParseResult:
+   """Relationships parsed from a text, and the lines that couldn't be parsed."""
+
+   def __init__(self):
+      self.relationships = []
+      self.unparsed = []
+      self.ignored = 0
+
+   @property
+   def coverage(self) -> float:
+      """Fraction of the candidate lines (lines with a separator, see is_candidate_line) parsed into relationships."""
+      candidates = len(self.relationships) + len(self.unparsed)
+      return len(self.relationships) / candidates if candidates else 1.0
+
+   def __repr__(self):
+      return f"ParseResult(relationships={len(self.relationships)}, unparsed={len(self.unparsed)}, ignored={self.ignored}, coverage={self.coverage:.2f})"
+
+
+def strip_line(line: str) -> str:
+   """Remove the emphasis, list marker and surrounding punctuation of a line."""
+   line = line.strip().strip("*_")
+   return LIST_MARKER.sub("", line, count=1).strip(STRIP_CHARS)
+
+
+def is_candidate_line(line: str) -> bool:
+   """Check if a line may contain a relationship, i.e. it is not a heading (ending with ':') or a code fence and has a
+   separator. Other lines, e.g. blank lines or the "- Tesla" entity lists of the step-by-step prompts, are ignored."""
+   stripped = line.strip()
+   if not stripped or stripped.endswith(":") or stripped.startswith("```"):
+      return False
+   return SEPARATOR.search(strip_line(line)) is not None
+
+
+def strip_final_period(line: str) -> str:
+   """Remove the period ending a line, unless it belongs to an abbreviation or initials ending the target entity."""
+   if not line.endswith(".") or INITIALISM.search(line):
+      return line
+   last_word = line[:-1].rsplit(None, 1)[-1] if line[:-1].strip() else ""
+   if last_word.casefold() in ABBREVIATIONS:
+      return line
+   return line[:-1]
+
+
+def parse_relationship_line(line: str, query: str = None):
+   """Parse a single "src - relationship - tgt" line, e.g. "1. Elon Musk - founded - SpaceX".
+
+   Parameters:
+      line (str): The line to parse.
+      query (str or None): The query entity. If the line starts with it, the remaining elements after the relationship
+         are joined into the target, which allows separators within the target entity.
+
+   Returns:
+      dict or None: A dict with 'src', 'relationship' and 'tgt' keys, None if the line doesn't follow the format.
+   """
+   line = strip_final_period(strip_line(line))
+
+   parts = [part.strip(STRIP_CHARS) for part in SEPARATOR.split(line)]
+
+   if len(parts) > 3 and query is not None and parts[0].casefold() == query.casefold():
+      parts = parts[:2] + [" - ".join(parts[2:])]
+
+   if len(parts) != 3 or not all(parts):
+      return None
+
+   return {"src": parts[0], "relationship": parts[1], "tgt": parts[2]}
+
+
+def parse_relationships(text: str, query: str = None) -> ParseResult:
+   """Parse the relationships of a text with one relationship per line (numbered or bulleted lists, various dash styles).
+
+   Parameters:
+      text (str): The text returned by the model.
+      query (str or None): The query entity, see parse_relationship_line.
+
+   Returns:
+      ParseResult: The parsed relationships, the unparsed candidate lines and the parse coverage.
+   """
+   result = ParseResult()
+
+   for line in text.splitlines():
+      if not is_candidate_line(line):
+         result.ignored += 1
+         continue
+
+      relationship = parse_relationship_line(line, query=query)
+      if relationship is None:
+         result.unparsed.append(line.strip())
+      else:
+         result.relationships.append(relationship)
+
+   return result
+
+
+def deduplicate_relationships(relationships) -> list:
+   """Remove duplicate relationships, compared case-insensitively and ignoring extra whitespace. The first occurrence is kept.
+
+   Parameters:
+      relationships (iterable of dicts): The relationships with 'src', 'relationship' and 'tgt' keys.
+
+   Returns:
+      list: The unique relationships.
+   """
+   unique = {}
+   for rel in relationships:
+      key = tuple(" ".join(rel[field].split()).casefold() for field in ("src", "relationship", "tgt"))
+      unique.setdefault(key, rel)
+   return list(unique.values())
+
+
+def iter_relationships(chunks, query: str = None, result: ParseResult = None):
+   """Parse the relationships incrementally from a stream of text chunks, each one is yielded as soon as its line is complete.
+
+   Parameters:
+      chunks (iterable of str): The text chunks, e.g. the deltas of a streamed completion.
+      query (str or None): The query entity, see parse_relationship_line.
+      result (ParseResult or None): If given, collects the parsed relationships, unparsed lines and coverage.
+
+   Yields:
+      dict: A relationship with 'src', 'relationship' and 'tgt' keys.
+   """
+   result = result if result is not None else ParseResult()
+   buffer = ""
+
+   def parse(line):
+      if not is_candidate_line(line):
+         result.ignored += 1
+         return None
+      relationship = parse_relationship_line(line, query=query)
+      if relationship is None:
+         result.unparsed.append(line.strip())
+      else:
+         result.relationships.append(relationship)
+      return relationship
+
+   for chunk in chunks:
+      buffer += chunk
+      # Only complete lines are parsed, the last (partial) line stays in the buffer
+      *lines, buffer = buffer.split("\n")
+      for line in lines:
+         relationship = parse(line)
+         if relationship is not None:
+            yield relationship
+
+   relationship = parse(buffer)
+   if relationship is not None:
+      yield relationship
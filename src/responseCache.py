@@ -0,0 +1,479 @@
+# Persistent, content-addressed caches for API responses
+
+from clients import get_openai_client
+from concurrent.futures import Future
+from collections import OrderedDict
+import threading
+import warnings
+import hashlib
+import asyncio
+import sqlite3
+import json
+import time
+import os
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "knowledge-graph")
+
+
+def request_key(request: dict) -> str:
+   """Hash a request into a stable cache key.
+
+   Parameters:
+      request (dict): The request arguments, must be JSON serializable (pydantic models are dumped).
+
+   Returns:
+      str: The SHA-256 hex digest of the canonical JSON representation of the request.
+   """
+   def default(value):
+      return value.model_dump() if hasattr(value, "model_dump") else str(value)
+
+   canonical = json.dumps(request, sort_keys=True, separators=(",", ":"), default=default)
+   return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class DiskCache:
+   """Key-value store in a SQLite file with LRU eviction bounded by entries and/or bytes, and an optional TTL.
+   Safe to share between threads (one connection per thread) and processes (SQLite locking in WAL mode)."""
+
+   def __init__(self, path: str, max_entries: int = 10000, max_bytes: int = None, ttl: float = None):
+      """
+      Parameters:
+         path (str): The SQLite file, created if it doesn't exist.
+         max_entries (int or None): Maximum number of entries kept, least recently used entries are evicted first.
+         max_bytes (int or None): Maximum total size of the stored values in bytes.
+         ttl (float or None): Time to live of an entry in seconds, entries never expire if None.
+      """
+      self.path = path
+      self.max_entries = max_entries
+      self.max_bytes = max_bytes
+      self.ttl = ttl
+      self.hits = 0
+      self.misses = 0
+      self.__local = threading.local()
+      self.__lock = threading.Lock()
+
+      directory = os.path.dirname(os.path.abspath(path))
+      os.makedirs(directory, exist_ok=True)
+
+      with self.__connection() as connection:
+         connection.execute("PRAGMA journal_mode=WAL")
+         connection.execute("""CREATE TABLE IF NOT EXISTS entries (
+            key TEXT PRIMARY KEY,
+            value BLOB NOT NULL,
+            size INTEGER NOT NULL,
+            created_at REAL NOT NULL,
+            accessed_at REAL NOT NULL
+         )""")
+         connection.execute("CREATE INDEX IF NOT EXISTS entries_accessed_at ON entries (accessed_at)")
+
+   def __connection(self) -> sqlite3.Connection:
+      # SQLite connections can't be shared between threads, keep one per thread
+      connection = getattr(self.__local, "connection", None)
+      if connection is None:
+         connection = sqlite3.connect(self.path, timeout=30)
+         self.__local.connection = connection
+      return connection
+
+   def __count(self, hit: bool):
+      with self.__lock:
+         if hit:
+            self.hits += 1
+         else:
+            self.misses += 1
+
+   def get(self, key: str, max_age: float = None):
+      """Get a value from the cache.
+
+      Parameters:
+         key (str): The key of the entry.
+         max_age (float or None): Ignore entries older than max_age seconds, defaults to the TTL of the cache.
+
+      Returns:
+         bytes or None: The cached value, None on a miss or if the entry expired.
+      """
+      max_age = self.ttl if max_age is None else max_age
+      now = time.time()
+
+      with self.__connection() as connection:
+         row = connection.execute("SELECT value, created_at FROM entries WHERE key = ?", (key,)).fetchone()
+         if row is not None and max_age is not None and now - row[1] > max_age:
+            # Only drop entries past the TTL of the cache, a smaller max_age just skips them
+            if self.ttl is not None and now - row[1] > self.ttl:
+               connection.execute("DELETE FROM entries WHERE key = ?", (key,))
+            row = None
+         if row is not None:
+            connection.execute("UPDATE entries SET accessed_at = ? WHERE key = ?", (now, key))
+
+      self.__count(hit=row is not None)
+      return None if row is None else row[0]
+
+   def set(self, key: str, value: bytes):
+      """Store a value in the cache and evict the least recently used entries over the limits.
+
+      Parameters:
+         key (str): The key of the entry.
+         value (bytes): The value to store.
+      """
+      now = time.time()
+
+      with self.__connection() as connection:
+         connection.execute(
+            "INSERT OR REPLACE INTO entries (key, value, size, created_at, accessed_at) VALUES (?, ?, ?, ?, ?)",
+            (key, value, len(value), now, now)
+         )
+         if self.max_entries is not None:
+            connection.execute(
+               "DELETE FROM entries WHERE key IN (SELECT key FROM entries ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+               (self.max_entries,)
+            )
+         if self.max_bytes is not None:
+            connection.execute(
+               """DELETE FROM entries WHERE key IN (
+                  SELECT key FROM (SELECT key, SUM(size) OVER (ORDER BY accessed_at DESC, key) AS total FROM entries) WHERE total > ?
+               )""",
+               (self.max_bytes,)
+            )
+
+   def delete(self, key: str):
+      with self.__connection() as connection:
+         connection.execute("DELETE FROM entries WHERE key = ?", (key,))
+
+   def clear(self):
+      with self.__connection() as connection:
+         connection.execute("DELETE FROM entries")
+
+   def __len__(self):
+      return self.__connection().execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+   def stats(self) -> dict:
+      """
+      Returns:
+         dict: The hits and misses of this instance, and the number and total size of the stored entries.
+      """
+      entries, size = self.__connection().execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+      return {"hits": self.hits, "misses": self.misses, "entries": entries, "bytes": size}
+
+
+class CompletionCache:
+   """On-disk cache of OpenAI chat completions keyed by a hash of the full request
+   (model, messages, temperature, max_tokens, response_format, ...)."""
+
+   def __init__(self, path: str = os.path.join(DEFAULT_CACHE_DIR, "completions.sqlite"), client=None, max_entries: int = 10000, max_bytes: int = None, ttl: float = None):
+      """
+      Parameters:
+         path (str): The SQLite file of the cache.
+         client (OpenAI or None): Client used on a cache miss by create() and by nlpUtils.create_completion while the
+            cache is enabled, can be a fake client exposing chat.completions.create. The shared client if None.
+         max_entries (int or None): Maximum number of cached completions.
+         max_bytes (int or None): Maximum total size of the cached completions in bytes.
+         ttl (float or None): Time to live of a cached completion in seconds.
+      """
+      self.client = client
+      self.store = DiskCache(path, max_entries=max_entries, max_bytes=max_bytes, ttl=ttl)
+
+   def get(self, args: dict):
+      """
+      Parameters:
+         args (dict): Arguments of chat.completions.create.
+
+      Returns:
+         ChatCompletion or None: The cached completion of the request, None on a miss.
+      """
+      cached = self.store.get(request_key(args))
+      if cached is None:
+         return None
+      # Imported on first use, the openai types take most of the import time of the pipeline modules
+      from openai.types.chat import ChatCompletion
+      return ChatCompletion.model_validate_json(cached)
+
+   def put(self, args: dict, completion):
+      self.store.set(request_key(args), completion.model_dump_json().encode("utf-8"))
+
+   def create(self, args: dict, client=None, refresh: bool = False):
+      """Return the cached completion for the request or create (and cache) a new one.
+
+      Parameters:
+         args (dict): Arguments of chat.completions.create.
+         client (OpenAI or None): Client used on a cache miss, defaults to the client of the cache, then to the shared
+            client (clients.get_openai_client).
+         refresh (bool): Ignore the cached completion and replace it with a new one.
+
+      Returns:
+         ChatCompletion: The completion.
+      """
+      if not refresh:
+         completion = self.get(args)
+         if completion is not None:
+            return completion
+
+      client = client or self.client or get_openai_client()
+      completion = client.chat.completions.create(**args)
+      self.put(args, completion)
+
+      return completion
+
+   def stats(self) -> dict:
+      return self.store.stats()
+
+
+class MemoryCache:
+   """In-memory key-value store with LRU eviction bounded by entries and an optional TTL, thread-safe.
+   The creation time of the entries is kept, see SearchCache."""
+
+   def __init__(self, max_entries: int = 1000, ttl: float = None):
+      """
+      Parameters:
+         max_entries (int): Maximum number of entries kept, least recently used entries are evicted first.
+         ttl (float or None): Time to live of an entry in seconds, entries never expire if None.
+      """
+      self.max_entries = max_entries
+      self.ttl = ttl
+      self.__entries = OrderedDict()
+      self.__lock = threading.Lock()
+
+   def get_entry(self, key: str) -> tuple:
+      """
+      Returns:
+         tuple or None: The value and its creation time, None on a miss or if the entry expired.
+      """
+      with self.__lock:
+         entry = self.__entries.get(key)
+         if entry is None:
+            return None
+         if self.ttl is not None and time.time() - entry[1] > self.ttl:
+            del self.__entries[key]
+            return None
+         self.__entries.move_to_end(key)
+         return entry
+
+   def get(self, key: str):
+      entry = self.get_entry(key)
+      return None if entry is None else entry[0]
+
+   def set(self, key: str, value, created_at: float = None):
+      with self.__lock:
+         self.__entries[key] = (value, time.time() if created_at is None else created_at)
+         self.__entries.move_to_end(key)
+         while len(self.__entries) > self.max_entries:
+            self.__entries.popitem(last=False)
+
+   def delete(self, key: str):
+      with self.__lock:
+         self.__entries.pop(key, None)
+
+   def clear(self):
+      with self.__lock:
+         self.__entries.clear()
+
+   def __len__(self):
+      return len(self.__entries)
+
+
+class SearchCache:
+   """Cache of search API responses (JSON) keyed by endpoint and query parameters, in memory and optionally on disk.
+   - Fresh entries (younger than ttl) are served from the cache.
+   - Stale entries (younger than ttl + stale_ttl) are served immediately while the response is fetched again in a
+     background thread (stale-while-revalidate).
+   - Concurrent lookups of the same missing key, from threads or event loops, share a single request (single-flight):
+     the first one fetches the response, the others wait for its result (or exception).
+   Errors are never cached."""
+
+   def __init__(self, ttl: float = 3600, stale_ttl: float = 86400, max_entries: int = 1000, path: str = None, max_disk_entries: int = 10000):
+      """
+      Parameters:
+         ttl (float): Time in seconds during which a response is served without fetching it again.
+         stale_ttl (float): Additional time during which a stale response is served while it's revalidated, 0 disables it.
+         max_entries (int): Maximum number of responses kept in memory.
+         path (str or None): SQLite file of the disk tier (see DiskCache), shared between processes and runs.
+         max_disk_entries (int): Maximum number of responses kept on disk.
+      """
+      self.ttl = ttl
+      self.stale_ttl = stale_ttl
+      self.memory = MemoryCache(max_entries=max_entries, ttl=ttl + stale_ttl)
+      self.disk = DiskCache(path, max_entries=max_disk_entries, ttl=ttl + stale_ttl) if path else None
+      self.counts = {"hits": 0, "stale_hits": 0, "misses": 0, "coalesced": 0, "revalidations": 0, "errors": 0}
+      self.__in_flight = {}
+      self.__lock = threading.Lock()
+
+   @staticmethod
+   def key(endpoint: str, params: dict) -> str:
+      """The cache key of a request (the headers, e.g. the subscription key, aren't part of it)."""
+      return request_key({"endpoint": endpoint, "params": params})
+
+   def __count(self, name: str):
+      with self.__lock:
+         self.counts[name] += 1
+
+   def __lookup(self, key: str) -> tuple:
+      # Memory first, then disk (promoted to memory)
+      entry = self.memory.get_entry(key)
+      if entry is None and self.disk is not None:
+         cached = self.disk.get(key)
+         if cached is not None:
+            stored = json.loads(cached)
+            entry = (stored["value"].encode("utf-8"), stored["created_at"])
+            self.memory.set(key, *entry)
+      return entry
+
+   def __store(self, key: str, response):
+      value = json.dumps(response)
+      now = time.time()
+      self.memory.set(key, value.encode("utf-8"), created_at=now)
+      if self.disk is not None:
+         self.disk.set(key, json.dumps({"created_at": now, "value": value}).encode("utf-8"))
+
+   def __cached(self, key: str):
+      """The cached response and whether it is fresh, or (None, False)."""
+      entry = self.__lookup(key)
+      if entry is None:
+         return None, False
+      return json.loads(entry[0]), time.time() - entry[1] <= self.ttl
+
+   def __join(self, key: str) -> tuple:
+      """The in-flight request of a key and whether the caller leads it (and must fetch the response)."""
+      with self.__lock:
+         future = self.__in_flight.get(key)
+         if future is not None:
+            self.counts["coalesced"] += 1
+            return future, False
+         future = self.__in_flight[key] = Future()
+         return future, True
+
+   def __settle(self, key: str, future: Future, response=None, error: BaseException = None, store: bool = True):
+      # The request is always resolved and removed from the requests in flight, otherwise its key would block forever
+      try:
+         if error is None and store:
+            try:
+               self.__store(key, response)
+            except Exception as store_error:
+               # Storing is best-effort (e.g. a locked disk tier), the response is still returned, just not cached
+               warnings.warn(f"Search response not cached: {store_error!r}")
+      finally:
+         with self.__lock:
+            self.__in_flight.pop(key, None)
+         if error is None:
+            future.set_result(response)
+         else:
+            self.__count("errors")
+            future.set_exception(error)
+
+   def __recheck(self, key: str, future: Future):
+      """The fresh response stored by a leader that settled between the lookup and the join of the caller (leading the
+      request), None if it must be fetched."""
+      try:
+         response, fresh = self.__cached(key)
+      except Exception:
+         # e.g. a locked disk tier, the response is fetched
+         response, fresh = None, False
+      if response is None or not fresh:
+         return None
+      self.__count("hits")
+      self.__settle(key, future, response, store=False)
+      return response
+
+   def __revalidate(self, key: str, fetch):
+      future, leader = self.__join(key)
+      if not leader:
+         return
+      self.__count("revalidations")
+
+      def run():
+         try:
+            response = fetch()
+         except Exception as error:
+            self.__settle(key, future, error=error)
+         else:
+            self.__settle(key, future, response)
+
+      threading.Thread(target=run, daemon=True).start()
+
+   def fetch(self, key: str, fetch):
+      """Return the response of a request from the cache, or fetch it.
+
+      Parameters:
+         key (str): The key of the request, see SearchCache.key.
+         fetch (callable): Function without arguments returning the JSON response of the request.
+
+      Returns:
+         The response (a new copy on every call).
+      """
+      response, fresh = self.__cached(key)
+      if response is not None:
+         if fresh:
+            self.__count("hits")
+         else:
+            self.__count("stale_hits")
+            self.__revalidate(key, fetch)
+         return response
+
+      future, leader = self.__join(key)
+      if not leader:
+         return json.loads(json.dumps(future.result()))
+      response = self.__recheck(key, future)
+      if response is not None:
+         return response
+
+      self.__count("misses")
+      try:
+         response = fetch()
+      except Exception as error:
+         self.__settle(key, future, error=error)
+         raise
+      self.__settle(key, future, response)
+      return response
+
+   async def afetch(self, key: str, fetch, refetch=None):
+      """Asynchronous version of SearchCache.fetch, requests in flight are shared with the synchronous lookups and
+      the other event loops.
+
+      Parameters:
+         key (str): The key of the request, see SearchCache.key.
+         fetch (callable): Coroutine function without arguments returning the JSON response of the request.
+         refetch (callable or None): Synchronous function fetching the response, used to revalidate a stale entry in the
+            background (the coroutine may depend on resources of the calling event loop). Stale entries are treated as
+            misses if None.
+
+      Returns:
+         The response (a new copy on every call).
+      """
+      response, fresh = self.__cached(key)
+      if response is not None and (fresh or refetch is not None):
+         if fresh:
+            self.__count("hits")
+         else:
+            self.__count("stale_hits")
+            self.__revalidate(key, refetch)
+         return response
+
+      future, leader = self.__join(key)
+      if not leader:
+         return json.loads(json.dumps(await asyncio.wrap_future(future)))
+      response = self.__recheck(key, future)
+      if response is not None:
+         return response
+
+      self.__count("misses")
+      try:
+         response = await fetch()
+      except BaseException as error:
+         self.__settle(key, future, error=error)
+         raise
+      self.__settle(key, future, response)
+      return response
+
+   def clear(self):
+      self.memory.clear()
+      if self.disk is not None:
+         self.disk.clear()
+
+   def stats(self) -> dict:
+      """
+      Returns:
+         dict: The hits, stale hits, misses, coalesced lookups, background revalidations and errors, and the number of
+            responses in memory (and the stats of the disk tier).
+      """
+      with self.__lock:
+         stats = {**self.counts, "entries": len(self.memory)}
+      if self.disk is not None:
+         stats["disk"] = self.disk.stats()
+      return stats
@@ -0,0 +1,305 @@
+# Lightweight tracing of the pipeline: spans around the stages and API calls, with pluggable exporters
+
+from collections import defaultdict
+import contextvars
+import functools
+import itertools
+import threading
+import inspect
+import json
+import time
+import re
+import os
+
+# The tracer used by span() and traced(), None when tracing is disabled (see enable_tracing)
+tracer = None
+
+# The innermost open span of the current context, the parent of the spans opened in it
+current = contextvars.ContextVar("current_span", default=None)
+
+span_ids = itertools.count(1)
+
+
+def percentile(values: list, q: float) -> float:
+   """The q-th percentile (0-100) of values, linearly interpolated between the closest ranks."""
+   values = sorted(values)
+   if not values:
+      return float("nan")
+   position = (len(values) - 1) * q / 100
+   lower = int(position)
+   upper = min(lower + 1, len(values) - 1)
+   return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+class Span:
+   """A timed operation with attributes. Numeric attributes (e.g. tokens, cache hits, retries) are aggregated by the
+   summary and Prometheus exporters. Used as a context manager, the span becomes the parent of the spans opened inside."""
+
+   __slots__ = ("tracer", "name", "span_id", "parent_id", "attributes", "start_time", "duration", "_start", "_token")
+
+   def __init__(self, tracer, name: str, attributes: dict):
+      self.tracer = tracer
+      self.name = name
+      self.span_id = next(span_ids)
+      self.parent_id = None
+      self.attributes = attributes
+      self.start_time = None
+      self.duration = None
+
+   def set(self, key: str, value):
+      self.attributes[key] = value
+
+   def add(self, key: str, amount=1):
+      self.attributes[key] = self.attributes.get(key, 0) + amount
+
+   def __enter__(self):
+      parent = current.get()
+      self.parent_id = parent.span_id if parent is not None else None
+      self._token = current.set(self)
+      self.start_time = time.time()
+      self._start = time.perf_counter()
+      return self
+
+   def __exit__(self, exc_type, exc_value, traceback):
+      self.duration = time.perf_counter() - self._start
+      current.reset(self._token)
+      if exc_type is not None:
+         self.attributes["error"] = exc_type.__name__
+      self.tracer.export(self)
+      return False
+
+   def to_dict(self) -> dict:
+      return {"name": self.name, "span_id": self.span_id, "parent_id": self.parent_id, "start_time": self.start_time, "duration_ms": round(self.duration * 1000, 3), "attributes": self.attributes}
+
+
+class NoSpan:
+   """The span returned when tracing is disabled, does nothing."""
+
+   def set(self, key, value):
+      pass
+
+   def add(self, key, amount=1):
+      pass
+
+   def __enter__(self):
+      return self
+
+   def __exit__(self, exc_type, exc_value, traceback):
+      return False
+
+
+NO_SPAN = NoSpan()
+
+
+class Tracer:
+   """Creates the spans and sends the finished ones to the exporters (objects with an export(span) method)."""
+
+   def __init__(self, exporters=()):
+      self.exporters = list(exporters)
+
+   def span(self, name: str, **attributes) -> Span:
+      return Span(self, name, attributes)
+
+   def export(self, span: Span):
+      for exporter in self.exporters:
+         exporter.export(span)
+
+
+def enable_tracing(*exporters) -> Tracer:
+   """Trace the pipeline stages and API calls.
+
+   Parameters:
+      exporters: The exporters the finished spans are sent to, e.g. SummaryExporter(), JSONLinesExporter("spans.jsonl"),
+         PrometheusExporter().
+
+   Returns:
+      Tracer: The tracer.
+   """
+   global tracer
+   tracer = Tracer(exporters)
+   return tracer
+
+
+def disable_tracing():
+   global tracer
+   tracer = None
+
+
+def span(name: str, **attributes):
+   """Open a span, e.g. `with span("retrieve_data", query=query) as s: ... s.set("results", 7)`.
+   Returns a no-op span if tracing is disabled."""
+   if tracer is None:
+      return NO_SPAN
+   return tracer.span(name, **attributes)
+
+
+def current_span():
+   """The innermost open span, to add attributes to it from nested code (a no-op span if there is none)."""
+   if tracer is None:
+      return NO_SPAN
+   return current.get() or NO_SPAN
+
+
+def traced(name: str = None):
+   """Decorator tracing every call of a function (or coroutine function) in a span, named after the function by default.
+   Only a global lookup is added to the calls when tracing is disabled."""
+   def decorator(function):
+      span_name = name or function.__name__
+
+      if inspect.iscoroutinefunction(function):
+         @functools.wraps(function)
+         async def async_wrapper(*args, **kwargs):
+            if tracer is None:
+               return await function(*args, **kwargs)
+            with tracer.span(span_name):
+               return await function(*args, **kwargs)
+         return async_wrapper
+
+      @functools.wraps(function)
+      def wrapper(*args, **kwargs):
+         if tracer is None:
+            return function(*args, **kwargs)
+         with tracer.span(span_name):
+            return function(*args, **kwargs)
+      return wrapper
+
+   return decorator
+
+
+def format_number(value) -> str:
+   """Format a metric value without losing precision (integers without a decimal point)."""
+   return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def numeric_attributes(span: Span):
+   """The numeric attributes of a span (booleans count as 0 or 1)."""
+   return ((key, value) for key, value in span.attributes.items() if isinstance(value, (int, float)))
+
+
+class JSONLinesExporter:
+   """Append every finished span to a JSON lines file."""
+
+   def __init__(self, path: str):
+      self.path = path
+      self.__file = open(path, "a", encoding="utf-8")
+      self.__lock = threading.Lock()
+
+   def export(self, span: Span):
+      line = json.dumps(span.to_dict(), default=str)
+      with self.__lock:
+         self.__file.write(line + "\n")
+         self.__file.flush()
+
+   def close(self):
+      self.__file.close()
+
+
+class SummaryExporter:
+   """Aggregate the spans in process by name: count, errors, total time, p50/p95 latencies and the sums of the numeric
+   attributes."""
+
+   def __init__(self):
+      self.durations = defaultdict(list)
+      self.errors = defaultdict(int)
+      self.totals = defaultdict(lambda: defaultdict(float))
+      self.__lock = threading.Lock()
+
+   def export(self, span: Span):
+      with self.__lock:
+         self.durations[span.name].append(span.duration)
+         if "error" in span.attributes:
+            self.errors[span.name] += 1
+         totals = self.totals[span.name]
+         for key, value in numeric_attributes(span):
+            totals[key] += value
+
+   def summary(self) -> dict:
+      """The aggregated stats by span name, the slowest stages (by total time) first."""
+      with self.__lock:
+         names = sorted(self.durations, key=lambda name: -sum(self.durations[name]))
+         return {
+            name: {
+               "count": len(self.durations[name]),
+               "errors": self.errors[name],
+               "total_s": round(sum(self.durations[name]), 3),
+               "p50_ms": round(percentile(self.durations[name], 50) * 1000, 3),
+               "p95_ms": round(percentile(self.durations[name], 95) * 1000, 3),
+               **{key: round(value, 3) for key, value in self.totals[name].items()}
+            }
+            for name in names
+         }
+
+   def report(self) -> str:
+      """The summary as a text table."""
+      lines = [f"{'span':<40}{'count':>8}{'errors':>8}{'total s':>10}{'p50 ms':>10}{'p95 ms':>10}  attributes"]
+      for name, stats in self.summary().items():
+         attributes = ", ".join(f"{key}={format_number(value)}" for key, value in stats.items() if key not in ("count", "errors", "total_s", "p50_ms", "p95_ms"))
+         lines.append(f"{name:<40}{stats['count']:>8}{stats['errors']:>8}{stats['total_s']:>10.3f}{stats['p50_ms']:>10.1f}{stats['p95_ms']:>10.1f}  {attributes}")
+      return "\n".join(lines)
+
+   def reset(self):
+      with self.__lock:
+         self.durations.clear()
+         self.errors.clear()
+         self.totals.clear()
+
+
+class PrometheusExporter:
+   """Aggregate the spans into Prometheus metrics: a histogram of the durations and a counter per numeric attribute,
+   labeled by span name. render() returns the text exposition format, e.g. served by a /metrics endpoint or written to
+   the textfile collector of node_exporter with write()."""
+
+   BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+   def __init__(self, prefix: str = "knowledge_graph", buckets: tuple = BUCKETS):
+      self.prefix = prefix
+      self.buckets = buckets
+      self.bucket_counts = defaultdict(lambda: [0] * len(self.buckets))
+      self.counts = defaultdict(int)
+      self.sums = defaultdict(float)
+      self.counters = defaultdict(lambda: defaultdict(float))
+      self.__lock = threading.Lock()
+
+   def export(self, span: Span):
+      with self.__lock:
+         counts = self.bucket_counts[span.name]
+         for i, bound in enumerate(self.buckets):
+            if span.duration <= bound:
+               counts[i] += 1
+         self.counts[span.name] += 1
+         self.sums[span.name] += span.duration
+         if "error" in span.attributes:
+            self.counters["errors"][span.name] += 1
+         for key, value in numeric_attributes(span):
+            self.counters[re.sub(r"[^a-zA-Z0-9_]", "_", key)][span.name] += value
+
+   @staticmethod
+   def __label(value: str) -> str:
+      return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+   def render(self) -> str:
+      histogram = f"{self.prefix}_span_duration_seconds"
+      lines = [f"# HELP {histogram} Duration of the spans in seconds.", f"# TYPE {histogram} histogram"]
+      with self.__lock:
+         for name in sorted(self.counts):
+            label = self.__label(name)
+            for bound, count in zip(self.buckets, self.bucket_counts[name]):
+               lines.append(f'{histogram}_bucket{{span="{label}",le="{bound:g}"}} {count}')
+            lines.append(f'{histogram}_bucket{{span="{label}",le="+Inf"}} {self.counts[name]}')
+            lines.append(f'{histogram}_sum{{span="{label}"}} {self.sums[name]:.6f}')
+            lines.append(f'{histogram}_count{{span="{label}"}} {self.counts[name]}')
+
+         for key in sorted(self.counters):
+            counter = f"{self.prefix}_span_{key}_total"
+            lines += [f"# HELP {counter} Sum of the '{key}' attribute of the spans.", f"# TYPE {counter} counter"]
+            for name, value in sorted(self.counters[key].items()):
+               lines.append(f'{counter}{{span="{self.__label(name)}"}} {format_number(value)}')
+
+      return "\n".join(lines) + "\n"
+
+   def write(self, path: str):
+      """Write the metrics to a file, atomically (for the node_exporter textfile collector)."""
+      temporary_path = path + ".tmp"
+      with open(temporary_path, "w", encoding="utf-8") as file:
+         file.write(self.render())
+      os.replace(temporary_path, path)
@@ -0,0 +1,12 @@
+import pytest
+
+
+@pytest.fixture(scope="session")
+def encoding():
+   """The gpt-4 encoding, the tests counting tokens are skipped if its BPE file can't be loaded (no network and no
+   TIKTOKEN_CACHE_DIR)."""
+   from numTokens import get_encoding
+   try:
+      return get_encoding("gpt-4")
+   except Exception as error:
+      pytest.skip(f"tiktoken encoding unavailable: {error}")
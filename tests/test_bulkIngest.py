@@ -0,0 +1,29 @@
+import json
+
+import bulkIngest
+from bulkIngest import ingest, iter_files
+
+
+def write_files(directory, count):
+   for i in range(count):
+      records = [{"query": f"Entity {i}", "relationships": [{"src": f"Entity {i}", "relationship": "founded", "tgt": f"Company {i}"}]}]
+      (directory / f"{i:03d}.jsonl").write_text("\n".join(json.dumps(record) for record in records) + "\n")
+
+
+def test_single_path_is_not_iterated_as_characters(tmp_path):
+   write_files(tmp_path, 3)
+   expected = [str(tmp_path / f"{i:03d}.jsonl") for i in range(3)]
+   assert list(iter_files(str(tmp_path))) == expected
+   assert list(iter_files(tmp_path)) == expected
+   _, stats = ingest(str(tmp_path), workers=0)
+   assert stats["files"] == 3 and stats["relationships"] == 3
+
+
+def test_progress_is_reported_once_per_hundred_files(tmp_path, capsys, monkeypatch):
+   write_files(tmp_path, 201)
+   # Several chunks per file, each one reports the progress
+   iter_parsed = bulkIngest.iter_parsed
+   monkeypatch.setattr(bulkIngest, "iter_parsed", lambda paths, workers=None, window=None: iter_parsed(paths, workers=0, chunk_bytes=32))
+   bulkIngest.main([str(tmp_path)])
+   progress = [line for line in capsys.readouterr().err.splitlines() if line.endswith("/s)")]
+   assert [line.split(",")[0] for line in progress] == ["100 files", "200 files"]
@@ -0,0 +1,71 @@
+from clients import run_coroutine, get_http_client, on_event_loop, close_clients
+import clients
+import contextvars
+import threading
+import asyncio
+import pytest
+
+request_id = contextvars.ContextVar("request_id", default=None)
+
+
+async def shared_client():
+   assert on_event_loop()
+   return get_http_client()
+
+
+def test_http_client_is_shared_between_calls_and_threads():
+   clients = [run_coroutine(shared_client())]
+   thread = threading.Thread(target=lambda: clients.append(run_coroutine(shared_client())))
+   thread.start()
+   thread.join()
+   assert clients[0] is clients[1]
+   assert not clients[0].is_closed
+
+
+def test_run_coroutine_inside_a_running_loop():
+   async def caller():
+      return run_coroutine(shared_client())
+
+   assert asyncio.run(caller()) is run_coroutine(shared_client())
+
+
+def test_run_coroutine_copies_the_context():
+   async def read():
+      return request_id.get()
+
+   token = request_id.set("abc")
+   try:
+      assert run_coroutine(read()) == "abc"
+   finally:
+      request_id.reset(token)
+
+
+def test_run_coroutine_raises_the_exception():
+   async def fail():
+      raise KeyError("missing")
+
+   with pytest.raises(KeyError):
+      run_coroutine(fail())
+
+
+def test_close_clients():
+   client = run_coroutine(shared_client())
+   close_clients()
+   assert client.is_closed
+   # Created again on next use
+   assert not run_coroutine(shared_client()).is_closed
+
+
+def test_http_client_per_event_loop():
+   async def client():
+      return asyncio.get_running_loop(), get_http_client()
+
+   async def twice():
+      return await client(), await client()
+
+   (loop, first), (_, again) = asyncio.run(twice())
+   assert first is again
+   assert first is not run_coroutine(shared_client())
+   # A new loop gets its own client, the client of the closed loop is dropped
+   assert asyncio.run(client())[1] is not first
+   assert loop not in clients.loop_http_clients
@@ -0,0 +1,35 @@
+from clients import create_openai_client, use_openai_client, get_http_client
+from fakeServer import FakeAPIServer
+import dataRetrieval
+import contextvars
+import threading
+import asyncio
+
+request_id = contextvars.ContextVar("request_id", default=None)
+
+
+def test_generation_runs_in_its_executor_with_the_context(monkeypatch):
+   monkeypatch.setattr(dataRetrieval, "generate_additional_data", lambda query, model: (threading.current_thread().name, request_id.get()))
+
+   async def generate():
+      request_id.set("abc")
+      return await dataRetrieval.generate_additional_data_async("Tesla")
+
+   thread, value = asyncio.run(generate())
+   assert thread.startswith("generate-additional-data")
+   assert value == "abc"
+
+
+def test_retrieve_data_async_reuses_the_client_of_its_loop():
+   with FakeAPIServer(latency=0.0, search_latency=0.0, tokens_per_second=None) as server, server.patched_environment():
+      async def retrieve():
+         clients = []
+         for query in ("Tesla", "SpaceX"):
+            assert await dataRetrieval.retrieve_data_async(query)
+            clients.append(get_http_client())
+         return clients
+
+      with use_openai_client(create_openai_client()):
+         first, second = asyncio.run(retrieve())
+   assert first is second
+   assert server.counts["search"] == 2 and server.counts["entities"] == 2 and server.counts["chat"] == 2
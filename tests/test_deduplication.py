@@ -0,0 +1,37 @@
+from deduplication import deduplicate_passages
+
+
+def test_repeated_sentence_removal_keeps_separators(encoding):
+   first = "Tesla was founded in 2003 by a group of engineers.\nIt makes electric cars and home batteries."
+   second = "Key facts.\n\nTesla was founded in 2003 by a group of engineers.\nElon Musk joined as chairman in 2004.\nSites:\n- Austin\n- Berlin"
+   kept, stats = deduplicate_passages([first, second])
+   assert kept == [first, "Key facts.\nElon Musk joined as chairman in 2004.\nSites:\n- Austin\n- Berlin"]
+   assert stats["repeated_sentences"] == 1
+
+
+def test_passage_without_repeated_sentences_is_unchanged(encoding):
+   passage = "Line one is here.\n\nLine two follows.  Line three, after two spaces."
+   kept, stats = deduplicate_passages([passage])
+   assert kept == [passage]
+   assert stats["repeated_sentences"] == 0
+
+
+def test_sentence_repeated_within_a_passage_is_kept():
+   passage = "The company was founded in 2003 in California. It grew fast. The company was founded in 2003 in California."
+   kept, stats = deduplicate_passages([passage])
+   assert kept == [passage]
+   assert stats["repeated_sentences"] == 0
+   assert stats["tokens_saved"] == 0
+
+
+def test_tokens_saved_falls_back_to_an_estimate(monkeypatch):
+   import deduplication
+
+   def unavailable(texts, model="gpt-4"):
+      raise ConnectionError("encoding not available offline")
+
+   monkeypatch.setattr(deduplication, "num_tokens_batch", unavailable)
+   first = "Tesla was founded in 2003 by a group of engineers."
+   kept, stats = deduplicate_passages([first, first + " It makes electric cars and home batteries."])
+   assert kept == [first, "It makes electric cars and home batteries."]
+   assert stats["tokens_saved"] > 0
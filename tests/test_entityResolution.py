@@ -0,0 +1,86 @@
+from entityResolution import EntityResolver, normalize_entity
+from knowledgeGraph import KnowledgeGraph
+import pytest
+
+
+@pytest.mark.parametrize("name, key", [
+   ("Tesla, Inc.", "tesla"),
+   ("Tesla Inc", "tesla"),
+   ("TESLA", "tesla"),
+   ("The Boring Company", "boring"),
+   ("Nestlé S.A.", "nestle"),
+   ("J.P. Morgan", "jp morgan"),
+   ("Tesla's", "tesla"),
+   ("AT&T", "at and t"),
+   ("The Company", "the company")
+])
+def test_normalize_entity(name, key):
+   assert normalize_entity(name) == key
+
+
+def test_normalization_variants_are_merged():
+   resolver = EntityResolver()
+   assert resolver.resolve("Tesla, Inc.") == "Tesla, Inc."
+   for name in ("Tesla Inc", "Tesla", "tesla inc.", "Tesla Incorporated"):
+      assert resolver.resolve(name) == "Tesla, Inc."
+   assert resolver.surface_forms["Tesla, Inc."] == {"Tesla, Inc.", "Tesla Inc", "Tesla", "tesla inc.", "Tesla Incorporated"}
+
+
+def test_fuzzy_variants_are_merged():
+   resolver = EntityResolver()
+   resolver.resolve("Microsoft Corporation")
+   assert resolver.resolve("Microsoft Corp.") == "Microsoft Corporation"
+   assert resolver.lookup("Mircosoft") is None
+
+
+@pytest.mark.parametrize("first, second", [
+   ("iPhone 14", "iPhone 15"),
+   ("Boeing 737", "Boeing 747"),
+   ("Apple", "Applied Materials"),
+   ("SpaceX", "Space")
+])
+def test_near_misses_are_not_merged(first, second):
+   resolver = EntityResolver()
+   assert resolver.resolve(first) == first
+   assert resolver.resolve(second) == second
+   assert resolver.lookup(first) == first
+
+
+def test_lookup_does_not_register():
+   resolver = EntityResolver()
+   resolver.resolve("Tesla")
+   assert resolver.lookup("Tesla, Inc.") == "Tesla"
+   assert resolver.lookup("SpaceX") is None
+   assert "SpaceX" not in resolver.aliases
+   assert resolver.surface_forms["Tesla"] == {"Tesla"}
+
+
+def test_add_alias():
+   resolver = EntityResolver()
+   resolver.resolve("Tesla")
+   resolver.add_alias("Tesla Motors", "Tesla, Inc.")
+   assert resolver.resolve("Tesla Motors") == "Tesla"
+   # The normalized alias is registered too
+   assert resolver.resolve("TESLA MOTORS INC") == "Tesla"
+   assert resolver.surface_forms["Tesla"] == {"Tesla", "Tesla, Inc.", "Tesla Motors", "TESLA MOTORS INC"}
+
+
+def test_add_alias_of_a_new_entity():
+   resolver = EntityResolver()
+   resolver.add_alias("Google", "Alphabet Inc.")
+   assert resolver.resolve("Google") == "Alphabet Inc."
+   assert resolver.resolve("Alphabet") == "Alphabet Inc."
+
+
+@pytest.mark.parametrize("backend", ["networkx", "compact"])
+def test_surface_forms_are_kept_on_the_nodes(backend):
+   knowledge_graph = KnowledgeGraph([
+      {"src": "Elon Musk", "relationship": "CEO of", "tgt": "Tesla, Inc."},
+      {"src": "Tesla Inc", "relationship": "located in", "tgt": "Austin"},
+      {"src": "Elon Musk", "relationship": "founded", "tgt": "SpaceX"}
+   ], backend=backend, resolver=EntityResolver())
+   assert sorted(knowledge_graph.store.nodes()) == ["Austin", "Elon Musk", "SpaceX", "Tesla, Inc."]
+   assert knowledge_graph.aliases("Tesla") == {"Tesla, Inc.", "Tesla Inc"}
+   assert knowledge_graph.canonical_entity("tesla inc.") == "Tesla, Inc."
+   if backend == "networkx":
+      assert knowledge_graph.graph.nodes["Tesla, Inc."]["aliases"] == {"Tesla, Inc.", "Tesla Inc"}
@@ -0,0 +1,93 @@
+from entityResolution import EntityResolver
+from knowledgeGraph import KnowledgeGraph, KnowledgeGraphVisualizer
+import pytest
+
+RELATIONSHIPS = [
+   {"src": "Elon Musk", "relationship": "founded", "tgt": "SpaceX"},
+   {"src": "Elon Musk", "relationship": "CEO of", "tgt": "Tesla, Inc."},
+   {"src": "Tesla Inc", "relationship": "Located in", "tgt": "Austin"},
+   {"src": "SpaceX", "relationship": "located in", "tgt": "Hawthorne"},
+   {"src": "Peter Thiel", "relationship": "invested in", "tgt": "SpaceX"},
+   {"src": "Peter Thiel", "relationship": "founded", "tgt": "PayPal"}
+]
+
+BACKENDS = pytest.mark.parametrize("backend", ["networkx", "compact"])
+
+
+def build(backend, resolver=True):
+   knowledge_graph = KnowledgeGraph(backend=backend, resolver=EntityResolver() if resolver else None)
+   for rel in RELATIONSHIPS:
+      knowledge_graph.add_relationships([rel], source_query=rel["src"])
+   return knowledge_graph
+
+
+def relationships(knowledge_graph):
+   return sorted((source, target, relationship) for source, target, relationship in knowledge_graph.edges())
+
+
+@BACKENDS
+def test_filter_relationships(backend):
+   knowledge_graph = build(backend)
+   located = knowledge_graph.filter_relationships(["LOCATED  in"])
+   assert relationships(located) == [("SpaceX", "Hawthorne", "located in"), ("Tesla, Inc.", "Austin", "Located in")]
+   founded = knowledge_graph.filter_relationships(lambda label: label.startswith("found"))
+   assert relationships(founded) == [("Elon Musk", "SpaceX", "founded"), ("Peter Thiel", "PayPal", "founded")]
+   assert relationships(knowledge_graph.filter_relationships(["acquired"])) == []
+
+
+@BACKENDS
+def test_neighborhood(backend):
+   knowledge_graph = build(backend)
+   assert set(knowledge_graph.neighborhood("SpaceX", k=1).store.nodes()) == {"SpaceX", "Elon Musk", "Hawthorne", "Peter Thiel"}
+   assert set(knowledge_graph.neighborhood("SpaceX", k=1, direction="out").store.nodes()) == {"SpaceX", "Hawthorne"}
+   assert set(knowledge_graph.neighborhood("Tesla Inc", k=2).store.nodes()) == {"Tesla, Inc.", "Austin", "Elon Musk", "SpaceX"}
+   assert set(knowledge_graph.neighborhood("SpaceX", k=2, relationships=["founded"]).store.nodes()) == {"SpaceX", "Elon Musk"}
+   assert knowledge_graph.neighborhood("Unknown").store.number_of_nodes() == 0
+
+
+@BACKENDS
+def test_subgraph_keeps_attributes_and_resolver(backend):
+   knowledge_graph = build(backend)
+   neighborhood = knowledge_graph.neighborhood("Tesla", k=1)
+   assert {(source, attributes["source_query"]) for source, _, _, attributes in neighborhood.edges(data=True)} == {("Elon Musk", "Elon Musk"), ("Tesla, Inc.", "Tesla Inc")}
+   assert neighborhood.aliases("Tesla Inc") == {"Tesla, Inc.", "Tesla Inc"}
+   located = knowledge_graph.filter_relationships(["located in"])
+   assert {attributes["source_query"] for _, _, _, attributes in located.edges(data=True)} == {"Tesla Inc", "SpaceX"}
+
+
+@BACKENDS
+def test_paths(backend):
+   knowledge_graph = build(backend)
+   assert knowledge_graph.shortest_path("Tesla Inc", "PayPal") == ["Tesla, Inc.", "Elon Musk", "SpaceX", "Peter Thiel", "PayPal"]
+   assert knowledge_graph.shortest_path("Elon Musk", "Elon Musk") == ["Elon Musk"]
+   assert knowledge_graph.shortest_path("Elon Musk", "Peter Thiel", direction="out") is None
+   assert knowledge_graph.shortest_path("Elon Musk", "Unknown") is None
+   assert knowledge_graph.all_simple_paths("Elon Musk", "Hawthorne", max_depth=2) == [["Elon Musk", "SpaceX", "Hawthorne"]]
+   assert knowledge_graph.all_simple_paths("Elon Musk", "PayPal", max_depth=2) == []
+
+
+@BACKENDS
+def test_index_is_maintained_as_edges_are_added(backend):
+   knowledge_graph = build(backend, resolver=False)
+   index = knowledge_graph.index
+   assert index.degree("SpaceX") == 3
+   knowledge_graph.add_relationships([{"src": "Gwynne Shotwell", "relationship": "president of", "tgt": "SpaceX"}])
+   assert index.degree("SpaceX") == 4
+   assert index.degree("Gwynne Shotwell") == 1
+   assert index.number_of_edges() == len(RELATIONSHIPS) + 1
+   assert knowledge_graph.shortest_path("Gwynne Shotwell", "Hawthorne") == ["Gwynne Shotwell", "SpaceX", "Hawthorne"]
+   aggregated = KnowledgeGraphVisualizer(knowledge_graph).aggregated_graph()
+   assert aggregated.number_of_edges() == len(RELATIONSHIPS) + 1
+
+
+def test_compact_index_matches_the_networkx_index():
+   indexes = [build(backend).index for backend in ("networkx", "compact")]
+   assert type(indexes[1]).__name__ == "CompactGraphIndex"
+
+   def incident_edges(index, entity, direction):
+      return sorted((index.edge(edge_id), neighbor) for edge_id, neighbor in index.incident_edges(entity, direction))
+
+   for entity in ("Elon Musk", "SpaceX", "Tesla, Inc.", "PayPal"):
+      assert indexes[0].degree(entity) == indexes[1].degree(entity)
+      for direction in ("out", "in", "both"):
+         assert incident_edges(indexes[0], entity, direction) == incident_edges(indexes[1], entity, direction)
@@ -0,0 +1,39 @@
+from graphStore import GraphStore
+from knowledgeGraph import KnowledgeGraph
+import pytest
+
+RELATIONSHIPS = [
+   {"src": "Elon Musk", "relationship": "founded", "tgt": "SpaceX"},
+   {"src": "Elon Musk", "relationship": "CEO of", "tgt": "Tesla"}
+]
+
+
+@pytest.fixture
+def store(tmp_path):
+   store = GraphStore(str(tmp_path / "graph.sqlite"))
+   store.upsert(RELATIONSHIPS, query="Elon Musk", timestamp=100.0)
+   store.upsert(RELATIONSHIPS[1:], query="Tesla", timestamp=200.0)
+   yield store
+   store.close()
+
+
+@pytest.mark.parametrize("backend", ["networkx", "compact"])
+def test_load_keeps_provenance(store, backend):
+   knowledge_graph = store.load(KnowledgeGraph(backend=backend))
+   edges = sorted((source, target, relationship, attributes["source_query"], attributes["updated_at"]) for source, target, relationship, attributes in knowledge_graph.edges(data=True))
+   assert edges == [
+      ("Elon Musk", "SpaceX", "founded", "Elon Musk", 100.0),
+      ("Elon Musk", "Tesla", "CEO of", "Elon Musk", 100.0),
+      ("Elon Musk", "Tesla", "CEO of", "Tesla", 200.0)
+   ]
+
+
+def test_load_filters_and_neighborhood_keep_provenance(store):
+   for knowledge_graph in (store.load(query="Tesla"), store.load(entity="Tesla", k=1)):
+      queries = {attributes["source_query"] for _, _, _, attributes in knowledge_graph.edges(data=True)}
+      assert "Tesla" in queries
+
+
+def test_load_without_provenance(store):
+   knowledge_graph = store.load(provenance=False)
+   assert all(attributes == {} for _, _, _, attributes in knowledge_graph.edges(data=True))
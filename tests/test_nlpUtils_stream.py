@@ -0,0 +1,85 @@
+from clients import create_openai_client, use_openai_client
+from fakeServer import FakeAPIServer
+import nlpUtils
+import tracing
+import asyncio
+import time
+import pytest
+
+
+class CollectingExporter:
+   def __init__(self):
+      self.spans = []
+
+   def export(self, span):
+      self.spans.append(span)
+
+   def completions(self):
+      return [span for span in self.spans if span.name == "chat_completion"]
+
+
+@pytest.fixture
+def server():
+   with FakeAPIServer(latency=0.0, tokens_per_second=None) as server:
+      with use_openai_client(create_openai_client(base_url=server.url + "/v1", api_key="fake-key", max_retries=0)):
+         yield server
+
+
+@pytest.fixture
+def slow_server():
+   # About 5 seconds to stream the relationships
+   with FakeAPIServer(latency=0.0, tokens_per_second=20) as server:
+      with use_openai_client(create_openai_client(base_url=server.url + "/v1", api_key="fake-key", max_retries=0)):
+         yield server
+
+
+@pytest.fixture
+def exporter():
+   exporter = CollectingExporter()
+   tracing.enable_tracing(exporter)
+   yield exporter
+   tracing.disable_tracing()
+
+
+def test_streamed_usage_is_recorded(server, exporter):
+   with nlpUtils.track_token_usage() as usage:
+      relationships = list(nlpUtils.stream_relationships_directly("Tesla", "Tesla makes electric cars."))
+   assert len(relationships) == server.entities_per_query
+   assert usage.requests == 1
+   assert usage.prompt_tokens > 0 and usage.completion_tokens > 0
+   completion, = exporter.completions()
+   assert completion.attributes["completion_tokens"] == usage.completion_tokens
+
+
+def test_streamed_text_matches_the_completion(server):
+   messages = [{"role": "user", "content": "Describe Tesla."}]
+   streamed = "".join(nlpUtils.get_completion(messages, stream=True))
+   assert streamed == nlpUtils.get_completion(messages, use_cache=False).message.content
+
+
+def test_chat_completion_span_covers_the_stream(server, exporter):
+   with tracing.span("caller") as caller:
+      chunks = nlpUtils.get_completion([{"role": "user", "content": "Describe Tesla."}], stream=True)
+      next(chunks)
+      # The span of the completion stays open until the stream ends, without becoming the current span of the caller
+      assert exporter.completions() == []
+      assert tracing.current_span() is caller
+      list(chunks)
+   completion, = exporter.completions()
+   assert completion.parent_id == caller.span_id
+
+
+def test_consumer_stopping_early_closes_the_stream(slow_server, exporter):
+   async def first_relationship():
+      relationships = nlpUtils.astream_relationships_directly("Tesla", "Tesla makes electric cars.")
+      relationship = await relationships.__anext__()
+      await relationships.aclose()
+      return relationship
+
+   start = time.perf_counter()
+   assert asyncio.run(first_relationship())["src"] == "Tesla"
+   # The worker thread stops after the relationship it is reading instead of draining the stream
+   while not exporter.completions() and time.perf_counter() - start < 5:
+      time.sleep(0.05)
+   assert exporter.completions()
+   assert time.perf_counter() - start < 2.5
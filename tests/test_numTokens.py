@@ -0,0 +1,78 @@
+from numTokens import num_tokens_str, num_tokens_chat, num_tokens_batch, num_tokens_chat_batch, ChatTokenCounter
+import tiktoken
+import pytest
+
+MESSAGES = [
+   {"role": "system", "content": "You are a helpful assistant that extracts relationships between entities."},
+   {"role": "user", "name": "analyst", "content": "Tesla - founded by - Elon Musk\nTesla - headquartered in - Austin, Texas."},
+   {"role": "assistant", "content": "Relationships:\n- Tesla\n- SpaceX, Inc.\n\n日本語のテキストと emoji 🚀"},
+   {"role": "user", "content": ""},
+   {"role": "user", "name": "reviewer", "content": "  leading and trailing whitespace \t\n"}
+]
+
+
+def baseline_num_tokens_str(string: str, model: str = "gpt-4") -> int:
+   # Implementation before the encoders were memoized: a new lookup and one encode per string
+   try:
+      encoding = tiktoken.encoding_for_model(model)
+   except KeyError:
+      encoding = tiktoken.get_encoding("cl100k_base")
+   return len(encoding.encode(string))
+
+
+def baseline_num_tokens_chat(messages: list, model: str = "gpt-4") -> int:
+   num_tokens = 0
+   for message in messages:
+      num_tokens += 4
+      for value in message.values():
+         num_tokens += baseline_num_tokens_str(value, model)
+   return num_tokens + 2
+
+
+@pytest.mark.parametrize("model", ["gpt-4", "gpt-3.5-turbo", "unknown-model"])
+def test_num_tokens_str_matches_baseline(encoding, model):
+   for message in MESSAGES:
+      for value in message.values():
+         assert num_tokens_str(value, model) == baseline_num_tokens_str(value, model)
+
+
+@pytest.mark.parametrize("model", ["gpt-4", "unknown-model"])
+def test_num_tokens_chat_matches_baseline(encoding, model):
+   assert num_tokens_chat(MESSAGES, model) == baseline_num_tokens_chat(MESSAGES, model)
+   # The memoized values give the same count again
+   assert num_tokens_chat(MESSAGES, model) == baseline_num_tokens_chat(MESSAGES, model)
+   assert num_tokens_chat([], model) == baseline_num_tokens_chat([], model)
+
+
+@pytest.mark.parametrize("num_threads", [None, 1, 4])
+def test_num_tokens_batch_matches_baseline(encoding, num_threads):
+   strings = [value for message in MESSAGES for value in message.values()]
+   assert num_tokens_batch(strings, num_threads=num_threads) == [baseline_num_tokens_str(string) for string in strings]
+   assert num_tokens_batch([], num_threads=num_threads) == []
+
+
+@pytest.mark.parametrize("num_threads", [None, 1, 4])
+def test_num_tokens_chat_batch_matches_baseline(encoding, num_threads):
+   conversations = [MESSAGES, MESSAGES[:1], [], MESSAGES[1:3]]
+   expected = [baseline_num_tokens_chat(messages) for messages in conversations]
+   assert num_tokens_chat_batch(conversations, num_threads=num_threads) == expected
+
+
+def test_chat_token_counter_matches_num_tokens_chat(encoding):
+   counter = ChatTokenCounter()
+   assert counter.total == num_tokens_chat([])
+   for i, message in enumerate(MESSAGES, 1):
+      counter.append(message)
+      assert counter.total == num_tokens_chat(MESSAGES[:i]) == baseline_num_tokens_chat(MESSAGES[:i])
+   assert len(counter) == len(MESSAGES)
+
+
+def test_chat_token_counter_sync(encoding):
+   messages = list(MESSAGES[:2])
+   counter = ChatTokenCounter(messages)
+   messages.append(MESSAGES[2])
+   assert counter.sync(messages) == baseline_num_tokens_chat(messages)
+   # A list that doesn't extend the counted messages is counted from scratch
+   assert counter.sync(MESSAGES[3:]) == baseline_num_tokens_chat(MESSAGES[3:])
+   counter.extend(MESSAGES[:1])
+   assert counter.total == baseline_num_tokens_chat(MESSAGES[3:] + MESSAGES[:1])
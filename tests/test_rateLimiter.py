@@ -0,0 +1,109 @@
+from clients import create_openai_client, use_openai_client
+from rateLimiter import TokenBucket, RateLimiter
+from fakeServer import FakeAPIServer
+import rateLimiter
+import nlpUtils
+import pytest
+
+
+class FakeClock:
+   """Monotonic clock whose sleep advances the time instead of waiting."""
+
+   def __init__(self):
+      self.now = 100.0
+      self.sleeps = []
+
+   def monotonic(self):
+      return self.now
+
+   def sleep(self, seconds):
+      self.sleeps.append(seconds)
+      self.now += seconds
+
+
+class RateLimitError(Exception):
+   status_code = 429
+
+
+@pytest.fixture
+def clock(monkeypatch):
+   clock = FakeClock()
+   monkeypatch.setattr(rateLimiter, "time", clock)
+   return clock
+
+
+def test_token_bucket(clock):
+   bucket = TokenBucket(capacity=10, rate=2)
+   assert bucket.wait_time(10) == 0
+   bucket.take(8)
+   assert bucket.wait_time(4) == pytest.approx(1.0)
+   # Amounts over the capacity are clamped
+   assert bucket.wait_time(50) == pytest.approx(4.0)
+   bucket.refill(clock.now + 100)
+   assert bucket.level == 10
+
+
+def test_acquire_waits_for_the_buckets(clock):
+   limiter = RateLimiter(requests_per_minute=60, tokens_per_minute=600)
+   limiter.acquire(tokens=600)
+   assert clock.sleeps == []
+   limiter.acquire(tokens=300)
+   # 300 tokens at 10 tokens per second
+   assert sum(clock.sleeps) == pytest.approx(30.0)
+
+
+def test_call_retries_rate_limit_errors_and_recovers(clock):
+   limiter = RateLimiter(requests_per_minute=60, max_retries=3, initial_backoff=1.0)
+   attempts = []
+
+   def function():
+      attempts.append(clock.now)
+      if len(attempts) <= 2:
+         raise RateLimitError()
+      return "ok"
+
+   assert limiter.call(function) == "ok"
+   assert len(attempts) == 3
+   assert limiter.retries == 2
+   # Halved twice, then increased by the successful call
+   assert limiter.rate_factor == pytest.approx(0.25 * 1.1)
+
+
+def test_call_gives_up_after_max_retries(clock):
+   limiter = RateLimiter(max_retries=2)
+   attempts = []
+
+   def function():
+      attempts.append(1)
+      raise RateLimitError()
+
+   with pytest.raises(RateLimitError):
+      limiter.call(function)
+   assert len(attempts) == 3
+
+
+def test_call_raises_other_errors_without_retrying(clock):
+   limiter = RateLimiter(max_retries=5)
+   attempts = []
+
+   def function():
+      attempts.append(1)
+      raise ValueError("bad request")
+
+   with pytest.raises(ValueError):
+      limiter.call(function)
+   assert len(attempts) == 1 and limiter.retries == 0
+
+
+def test_client_retries_are_disabled_with_a_limiter(encoding):
+   with FakeAPIServer(latency=0.0, error_rate=1.0) as server:
+      with use_openai_client(create_openai_client(base_url=server.url + "/v1", api_key="fake-key", max_retries=3)):
+         nlpUtils.set_rate_limiter(RateLimiter(max_retries=1, initial_backoff=0.01))
+         try:
+            with pytest.raises(Exception) as error:
+               nlpUtils.get_completion([{"role": "user", "content": "Describe Tesla."}], use_cache=False)
+         finally:
+            nlpUtils.set_rate_limiter(None)
+   assert rateLimiter.is_rate_limit_error(error.value)
+   # One request per attempt of the limiter, none retried by the client
+   assert server.counts["chat"] == 2
@@ -0,0 +1,37 @@
+from relationshipParser import parse_relationships, parse_relationship_line, iter_relationships
+import pytest
+
+OUTPUT = """Step 1, the entities related to Elon Musk:
+- Tesla
+- SpaceX
+
+Step 2, the relationships:
+1. Elon Musk - founded - SpaceX.
+2. Elon Musk – CEO of – Tesla
+3. Elon Musk -> owner of -> X Corp.
+Not a relationship - at all
+"""
+
+
+@pytest.mark.parametrize("line, target", [
+   ("Tesla - partnered with - Panasonic Inc.", "Panasonic Inc."),
+   ("Elon Musk - founded - X Corp.", "X Corp."),
+   ("Tesla - incorporated in - the U.S.", "the U.S."),
+   ("Tesla - founded by - Elon Musk.", "Elon Musk"),
+   ("Tesla - makes - electric cars.", "electric cars")
+])
+def test_final_period(line, target):
+   assert parse_relationship_line(line)["tgt"] == target
+
+
+def test_lines_without_separator_are_ignored():
+   result = parse_relationships(OUTPUT, query="Elon Musk")
+   assert [rel["tgt"] for rel in result.relationships] == ["SpaceX", "Tesla", "X Corp."]
+   # Only the line with a separator that doesn't parse is sent to the LLM fallback
+   assert result.unparsed == ["Not a relationship - at all"]
+   assert result.coverage == 3 / 4
+
+
+def test_streamed_parse_matches():
+   chunks = [OUTPUT[i:i + 7] for i in range(0, len(OUTPUT), 7)]
+   assert list(iter_relationships(chunks, query="Elon Musk")) == parse_relationships(OUTPUT, query="Elon Musk").relationships
@@ -0,0 +1,114 @@
+from openai.types.chat import ChatCompletion
+from responseCache import CompletionCache
+import responseCache
+import nlpUtils
+import pytest
+
+
+class FakeClient:
+   """Client exposing chat.completions.create, answering with the number of the request."""
+
+   def __init__(self):
+      self.requests = []
+      self.chat = self
+      self.completions = self
+
+   def create(self, **args):
+      self.requests.append(args)
+      return ChatCompletion.model_validate({
+         "id": f"completion-{len(self.requests)}",
+         "object": "chat.completion",
+         "created": 0,
+         "model": args["model"],
+         "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": f"answer {len(self.requests)}"}}]
+      })
+
+
+class FakeClock:
+   def __init__(self):
+      self.now = 1000.0
+
+   def time(self):
+      return self.now
+
+
+def request(content: str) -> dict:
+   return {"model": "gpt-4", "messages": [{"role": "user", "content": content}], "temperature": 0}
+
+
+@pytest.fixture
+def clock(monkeypatch):
+   clock = FakeClock()
+   monkeypatch.setattr(responseCache, "time", clock)
+   return clock
+
+
+@pytest.fixture
+def client():
+   return FakeClient()
+
+
+@pytest.fixture
+def cache(tmp_path, client, clock):
+   cache = nlpUtils.enable_completion_cache(path=str(tmp_path / "completions.sqlite"), client=client, max_entries=2, ttl=60)
+   yield cache
+   nlpUtils.disable_completion_cache()
+
+
+def content(completion) -> str:
+   return completion.choices[0].message.content
+
+
+def test_miss_then_hit(cache, client):
+   assert content(nlpUtils.create_completion(request("a"))) == "answer 1"
+   assert content(nlpUtils.create_completion(request("a"))) == "answer 1"
+   assert len(client.requests) == 1
+   assert cache.stats()["hits"] == 1 and cache.stats()["misses"] == 1
+   # Any difference in the request is a different key
+   assert content(nlpUtils.create_completion({**request("a"), "temperature": 1})) == "answer 2"
+
+
+def test_bypass_uses_injected_client(cache, client):
+   nlpUtils.create_completion(request("a"))
+   assert content(nlpUtils.create_completion(request("a"), use_cache=False)) == "answer 2"
+   assert len(client.requests) == 2
+
+
+def test_ttl_expiry(cache, client, clock):
+   nlpUtils.create_completion(request("a"))
+   clock.now += 59
+   assert content(nlpUtils.create_completion(request("a"))) == "answer 1"
+   clock.now += 2
+   assert content(nlpUtils.create_completion(request("a"))) == "answer 2"
+   assert len(client.requests) == 2
+
+
+def test_refresh(cache, client):
+   nlpUtils.create_completion(request("a"))
+   assert content(nlpUtils.create_completion(request("a"), refresh_cache=True)) == "answer 2"
+   # The refreshed completion replaced the cached one
+   assert content(nlpUtils.create_completion(request("a"))) == "answer 2"
+   assert len(client.requests) == 2
+
+
+def test_lru_eviction(cache, client, clock):
+   for name in ("a", "b"):
+      nlpUtils.create_completion(request(name))
+      clock.now += 1
+   # "a" becomes the most recently used, adding "c" evicts "b"
+   nlpUtils.create_completion(request("a"))
+   clock.now += 1
+   nlpUtils.create_completion(request("c"))
+   assert len(cache.store) == 2
+   assert cache.get(request("a")) is not None
+   assert cache.get(request("b")) is None
+   assert cache.get(request("c")) is not None
+   assert len(client.requests) == 3
+
+
+def test_create(tmp_path, client, clock):
+   cache = CompletionCache(path=str(tmp_path / "completions.sqlite"), client=client)
+   assert content(cache.create(request("a"))) == "answer 1"
+   assert content(cache.create(request("a"))) == "answer 1"
+   assert content(cache.create(request("a"), refresh=True)) == "answer 2"
+   assert len(client.requests) == 2
@@ -0,0 +1,136 @@
+from responseCache import SearchCache
+from fakeServer import FakeAPIServer
+import responseCache
+import dataRetrieval
+import threading
+import httpx
+import warnings
+import asyncio
+import time
+import pytest
+
+
+class FakeClock:
+   def __init__(self):
+      self.now = 1000.0
+
+   def time(self):
+      return self.now
+
+
+@pytest.fixture
+def server():
+   with FakeAPIServer(search_latency=0.2) as server, server.patched_environment():
+      yield server
+
+
+@pytest.fixture
+def clock(monkeypatch):
+   clock = FakeClock()
+   monkeypatch.setattr(responseCache, "time", clock)
+   return clock
+
+
+@pytest.fixture
+def cache(tmp_path):
+   cache = dataRetrieval.enable_search_cache(ttl=60, stale_ttl=600, path=str(tmp_path / "search.sqlite"))
+   yield cache
+   dataRetrieval.disable_search_cache()
+
+
+def wait_for(condition, timeout: float = 5.0):
+   deadline = time.monotonic() + timeout
+   while not condition():
+      assert time.monotonic() < deadline, "timed out"
+      time.sleep(0.01)
+
+
+def test_hit(server, cache):
+   first = dataRetrieval.bing_web_search("Tesla", num_results=5)
+   assert dataRetrieval.bing_web_search("Tesla", num_results=5) == first
+   assert server.counts["search"] == 1
+   assert cache.stats()["hits"] == 1 and cache.stats()["misses"] == 1
+   # Other parameters are another request
+   dataRetrieval.bing_web_search("Tesla", num_results=6)
+   assert server.counts["search"] == 2
+
+
+def test_disk_tier_is_shared(server, cache, tmp_path):
+   dataRetrieval.bing_entity_search("Tesla")
+   other = SearchCache(ttl=60, path=str(tmp_path / "search.sqlite"))
+   endpoint, headers, params = dataRetrieval.bing_request("/v7.0/entities", "Tesla")
+   other.fetch(other.key(endpoint, params), lambda: pytest.fail("fetched again"))
+   assert server.counts["entities"] == 1
+
+
+def test_ttl_and_stale_while_revalidate(server, cache, clock):
+   dataRetrieval.bing_web_search("Tesla", num_results=5)
+   clock.now += 30
+   dataRetrieval.bing_web_search("Tesla", num_results=5)
+   assert server.counts["search"] == 1
+
+   # Stale: served from the cache while it's fetched again in the background
+   clock.now += 60
+   dataRetrieval.bing_web_search("Tesla", num_results=5)
+   assert cache.stats()["stale_hits"] == 1
+   wait_for(lambda: server.counts["search"] == 2 and cache.stats()["revalidations"] == 1)
+   wait_for(lambda: not cache._SearchCache__in_flight)
+   dataRetrieval.bing_web_search("Tesla", num_results=5)
+   assert cache.stats()["hits"] == 2
+
+   # Expired (past ttl + stale_ttl): fetched again in the foreground
+   clock.now += 1000
+   dataRetrieval.bing_web_search("Tesla", num_results=5)
+   assert cache.stats()["misses"] == 2
+   assert server.counts["search"] == 3
+
+
+def test_single_flight(server, cache):
+   barrier = threading.Barrier(8)
+   results = []
+
+   def search():
+      barrier.wait()
+      results.append(dataRetrieval.bing_web_search("SpaceX", num_results=5))
+
+   threads = [threading.Thread(target=search) for _ in range(8)]
+   for thread in threads:
+      thread.start()
+   for thread in threads:
+      thread.join()
+   assert len(results) == 8 and all(result == results[0] for result in results)
+   assert server.counts["search"] == 1
+   assert cache.stats()["coalesced"] + cache.stats()["hits"] == 7
+
+
+def test_single_flight_between_threads_and_event_loops(server, cache):
+   async def search():
+      async with httpx.AsyncClient() as http_client:
+         return await dataRetrieval.bing_web_search_async("SpaceX", num_results=5, http_client=http_client)
+
+   thread = threading.Thread(target=lambda: dataRetrieval.bing_web_search("SpaceX", num_results=5))
+   thread.start()
+   asyncio.run(search())
+   thread.join()
+   assert server.counts["search"] == 1
+
+
+def test_errors_are_not_cached(server, cache):
+   endpoint, headers, params = dataRetrieval.bing_request("/v7.0/unknown", "Tesla")
+   for _ in range(2):
+      with pytest.raises(Exception):
+         dataRetrieval.bing_get(endpoint, headers, params)
+   assert cache.stats()["errors"] == 2 and cache.stats()["misses"] == 2
+   assert len(cache.memory) == 0
+
+
+def test_store_failure_doesnt_block_the_key():
+   cache = SearchCache()
+   # A response that can't be stored (not JSON serializable) is still returned, and the key isn't left in flight
+   with warnings.catch_warnings(record=True) as caught:
+      warnings.simplefilter("always")
+      response = {"value": object()}
+      assert cache.fetch("x", lambda: response) is response
+      assert cache.fetch("x", lambda: {"value": 1}) == {"value": 1}
+   assert any("not cached" in str(warning.message) for warning in caught)
+   assert cache.fetch("x", lambda: pytest.fail("fetched again")) == {"value": 1}